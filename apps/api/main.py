@@ -1,10 +1,19 @@
 
-import os, tempfile, csv, gzip, re, json, subprocess, shlex
+import os, io, time, asyncio, codecs, uuid, socket, hashlib, base64, datetime, decimal, shutil, tempfile, contextlib, itertools, collections, functools, threading, multiprocessing, csv, gzip, re, json, subprocess, shlex
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict, Any, Optional, List
-from fastapi import FastAPI, HTTPException, Body, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Body, UploadFile, File, Form, Request, Response, Header
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
 import requests
+from urllib3.exceptions import HTTPError as Urllib3Error
 import psycopg
 from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool
+import prometheus_client as prom
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
 from unidecode import unidecode
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -12,25 +21,393 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 DBT_RUNNER_URL = os.getenv("DBT_RUNNER_URL")  # Use 'LOCAL' para rodar dbt dentro da API
 STAGING_TABLE = os.getenv("STAGING_TABLE", "staging.raw_vendas_achatado")
 FALLBACK_DELETE = os.getenv("FALLBACK_DELETE_ON_TRUNCATE_ERROR", "true").lower() in ("1","true","yes","y")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))  # >1 normaliza em blocos num pool de processos
+INGEST_BLOCK_ROWS = int(os.getenv("INGEST_BLOCK_ROWS", "50000"))
+INGEST_ENGINE = os.getenv("INGEST_ENGINE", "python")  # python (linha a linha) | arrow (colunar, pyarrow)
+INGEST_COPY_FORMAT = os.getenv("INGEST_COPY_FORMAT", "text")  # text (o Postgres converte) | binary (tipado em Python, com rejeitados)
+REJECTS_TABLE = os.getenv("INGEST_REJECTS_TABLE", "staging.ingest_rejects")
+INGEST_MAX_REJECTS = int(os.getenv("INGEST_MAX_REJECTS", "10000"))  # acima disso a carga binária é abortada
+PROFILES_TABLE = os.getenv("INGEST_PROFILES_TABLE", "staging.source_profiles")
+INGEST_LEARN_PROFILES = os.getenv("INGEST_LEARN_PROFILES", "true").lower() in ("1","true","yes","y")  # 1º import ok de um cabeçalho novo vira perfil auto_*
+PROFILE_CACHE_SECONDS = float(os.getenv("INGEST_PROFILE_CACHE_SECONDS", "60"))  # edição de perfil feita em outra instância demora até isso
+MERGE_KEY = [c.strip() for c in os.getenv("MERGE_KEY", "documento_fiscal,sku,cod_cliente,data").split(",") if c.strip()]
 
-app = FastAPI(title="Engajamento API v6.1.1 (LOCAL dbt)")
+DB_SEARCH_PATH = os.getenv("DB_SEARCH_PATH", '"SllupMarket",public')
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))  # 0 desliga o pool (uma conexão por chamada)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "0"))  # >0 loga as consultas mais lentas que isso
+DB_SLOW_QUERY_EXPLAIN = os.getenv("DB_SLOW_QUERY_EXPLAIN", "true").lower() in ("1","true","yes","y")  # com o plano (EXPLAIN, sem ANALYZE)
+
+# ---------------- Métricas (GET /metrics) e spans ----------------
+# Spans são uma linha JSON no stdout por ingest, comando dbt ou consulta lenta; os mesmos tempos vão para os histogramas.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+STAGE_BUCKETS = (.01, .1, .5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+HTTP_SECONDS = prom.Histogram("sllup_http_request_duration_seconds", "Latência das requisições por rota", ["method","route","status"], buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = prom.Histogram("sllup_db_query_seconds", "Duração de cada execute no banco, por comando SQL", ["op"], buckets=LATENCY_BUCKETS)
+DB_SLOW_QUERIES = prom.Counter("sllup_db_slow_queries_total", "Consultas acima de DB_SLOW_QUERY_MS", ["op"])
+INGEST_STAGE_SECONDS = prom.Histogram("sllup_ingest_stage_seconds", "Tempo de cada etapa do ingest", ["stage","source"], buckets=STAGE_BUCKETS)
+INGESTS = prom.Counter("sllup_ingests_total", "Ingests terminados", ["source","mode","status"])
+INGEST_ROWS = prom.Counter("sllup_ingest_rows_total", "Linhas gravadas no staging", ["source","mode"])
+INGEST_BYTES = prom.Counter("sllup_ingest_bytes_total", "Bytes lidos da origem (compactados, se .gz)", ["source"])
+INGEST_REJECTED = prom.Counter("sllup_ingest_rejected_total", "Registros recusados (copy_format=binary)", ["source"])
+DBT_COMMAND_SECONDS = prom.Histogram("sllup_dbt_command_seconds", "Duração de cada comando dbt do /dbt/run", ["command","status"], buckets=STAGE_BUCKETS)
+DBT_MODEL_SECONDS = prom.Histogram("sllup_dbt_model_seconds", "Duração de cada nó do dbt build (run_results.json)", ["node","status"], buckets=STAGE_BUCKETS)
+
+def log_span(span: str, seconds: float, **fields):
+    print(json.dumps({"span":span, "duration_s":round(seconds, 4), **fields}, ensure_ascii=False, default=str), flush=True)
+
+_SQL_OPS = {"select","insert","update","delete","with","create","alter","drop","truncate","analyze","vacuum","do","set","show","explain","refresh"}
+_sql_op_re = re.compile(r"\s*(\w+)")
+
+class TimedCursor(psycopg.Cursor):
+    """Cursor das conexões da API: cada execute vai para DB_QUERY_SECONDS; acima de DB_SLOW_QUERY_MS vira span com EXPLAIN."""
+    def execute(self, query, params=None, **kwargs):
+        t0=time.perf_counter(); ok=False
+        try:
+            out=super().execute(query, params, **kwargs); ok=True
+            return out
+        finally:
+            dt=time.perf_counter()-t0
+            text=query if isinstance(query, str) else query.decode() if isinstance(query, bytes) else query.as_string(self)
+            m=_sql_op_re.match(text); op=m.group(1).lower() if m and m.group(1).lower() in _SQL_OPS else "other"
+            DB_QUERY_SECONDS.labels(op).observe(dt)
+            if DB_SLOW_QUERY_MS>0 and dt*1000>=DB_SLOW_QUERY_MS:
+                DB_SLOW_QUERIES.labels(op).inc()
+                self._log_slow(text, params, dt, op, ok)
+
+    def _log_slow(self, text, params, dt, op, ok):
+        plan=None
+        if ok and DB_SLOW_QUERY_EXPLAIN and op in ("select","with"):
+            try:  # savepoint: um EXPLAIN que falhe não derruba a transação de quem consultou
+                with self.connection.transaction(), psycopg.Cursor(self.connection) as cur:
+                    plan=cur.execute("EXPLAIN (FORMAT JSON) "+text, params).fetchone()
+                    plan=(plan["QUERY PLAN"] if isinstance(plan, dict) else plan[0])[0]["Plan"]
+            except Exception as e:
+                plan=f"EXPLAIN falhou: {e}"
+        log_span("db.slow_query", dt, op=op, ok=ok, query=text[:4000], params=len(params) if params else 0, plan=plan)
+
+# search_path vai nas options da conexão: nenhum SET extra a cada checkout
+DB_CONN_KWARGS = {"row_factory": dict_row, "cursor_factory": TimedCursor, "options": "-c search_path=" + DB_SEARCH_PATH.replace(" ", "\\ ")}
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> Optional[ConnectionPool]:
+    global _pool
+    if DB_POOL_MAX <= 0: return None
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL não configurado")
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DATABASE_URL, min_size=min(DB_POOL_MIN, DB_POOL_MAX), max_size=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                                   max_idle=DB_POOL_MAX_IDLE, kwargs=DB_CONN_KWARGS, check=ConnectionPool.check_connection, name="api", open=True)
+        return _pool
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    if DATABASE_URL:
+        get_pool()  # abre em background; não bloqueia o start se o banco estiver fora
+        threading.Thread(target=_jobs_heartbeat, name="ingest-jobs-heartbeat", daemon=True).start()
+    yield
+    if _pool is not None: _pool.close()
+
+app = FastAPI(title="Engajamento API v6.1.1 (LOCAL dbt)", lifespan=lifespan)
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    t0=time.perf_counter(); status=500
+    try:
+        response=await call_next(request); status=response.status_code
+        return response
+    finally:  # rota como template (/clientes/{cod}/visao): cardinalidade fixa
+        route=request.scope.get("route")
+        HTTP_SECONDS.labels(request.method, getattr(route, "path", "(sem rota)"), str(status)).observe(time.perf_counter()-t0)
 
 def get_conn():
+    """Context manager de conexão: empresta do pool (commit/rollback na saída) ou abre uma avulsa se DB_POOL_MAX=0."""
+    pool = get_pool()
+    if pool is not None: return pool.connection()
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL não configurado")
-    conn = psycopg.connect(DATABASE_URL, row_factory=dict_row)
-    with conn.cursor() as cur:
-        cur.execute('SET search_path TO "SllupMarket", public;')
-    return conn
+    return psycopg.connect(DATABASE_URL, **DB_CONN_KWARGS)
 
 @app.get("/health")
-def health():
-    return {
+def health(db: bool = False):
+    out = {
         "status":"ok",
         "staging_table":STAGING_TABLE,
         "fallback_delete":FALLBACK_DELETE,
-        "dbt_runner_url": DBT_RUNNER_URL or "LOCAL"
+        "ingest_workers":INGEST_WORKERS,
+        "ingest_engine":INGEST_ENGINE,
+        "dbt_runner_url": DBT_RUNNER_URL or "LOCAL",
+        "parquet_dir": PARQUET_DIR,
+        "pool": _pool.get_stats() if _pool is not None else None,
+        "cache": response_cache.stats(),
     }
+    if db:
+        # ?db=true faz um round-trip real (usado pelo teste de carga de latência)
+        t0 = time.perf_counter()
+        with get_conn() as conn:
+            conn.execute("select 1").fetchall()
+        out["db_ms"] = round((time.perf_counter()-t0)*1000, 2)
+    return out
+
+class ApiCollector:
+    """Métricas lidas na hora do scrape: pool de conexões, cache de respostas e jobs de ingest deste processo."""
+    def describe(self): return []  # sem isso o register() chamaria collect() já no import
+
+    def collect(self):
+        st=_pool.get_stats() if _pool is not None else {}
+        for k,doc in (("pool_size","Conexões abertas"),("pool_available","Conexões livres no pool"),("requests_waiting","Pedidos esperando conexão"),("pool_max","Máximo do pool")):
+            yield GaugeMetricFamily(f"sllup_db_pool_{k.removeprefix('pool_')}", doc, value=st.get(k, 0))
+        for k,doc in (("requests_num","Conexões emprestadas"),("requests_queued","Empréstimos que tiveram de esperar"),("requests_errors","Empréstimos que falharam (timeout)"),
+                      ("connections_num","Conexões criadas"),("connections_errors","Falhas ao conectar"),("connections_lost","Conexões perdidas")):
+            yield CounterMetricFamily(f"sllup_db_pool_{k}", doc, value=st.get(k, 0))
+        yield CounterMetricFamily("sllup_db_pool_wait_seconds", "Tempo total esperando conexão", value=st.get("requests_wait_ms", 0)/1000)
+        cs=response_cache.stats()
+        yield GaugeMetricFamily("sllup_response_cache_items", "Respostas no cache local", value=cs["items"])
+        for k in ("hits_local","hits_redis","misses","invalidations","redis_errors"):
+            yield CounterMetricFamily(f"sllup_response_cache_{k}", f"Cache de respostas: {k}", value=cs.get(k, 0))
+        g=GaugeMetricFamily("sllup_ingest_jobs", "Jobs de ingest deste processo por fase", labels=["phase"])
+        for phase,n in collections.Counter(j.phase for j in list(_jobs.values())).items(): g.add_metric([phase], n)
+        yield g
+
+prom.REGISTRY.register(ApiCollector())
+
+@app.get("/metrics")
+def metrics():
+    return Response(prom.generate_latest(), media_type=prom.CONTENT_TYPE_LATEST)
+
+# ---------------- Cache de respostas ----------------
+# Dois níveis: LRU+TTL em memória (por processo) e, com REDIS_URL, um Redis compartilhado entre
+# instâncias. As chaves levam uma geração; ingest e /dbt/run concluídos incrementam a geração e
+# tudo que foi gravado antes deixa de ser encontrado (sem varrer chaves).
+CACHE_TTL = float(os.getenv("CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "5000"))
+CACHE_GEN_POLL = float(os.getenv("CACHE_GEN_POLL_SECONDS", "1"))  # com Redis: de quanto em quanto tempo relê a geração
+REDIS_URL = os.getenv("REDIS_URL")  # opcional; sem ele, a invalidação vale só para este processo
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "sllup:api:")
+
+class TTLCache:
+    """LRU com expiração por item. Thread-safe; get/set são O(1)."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.data: "collections.OrderedDict[str,Any]" = collections.OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key: str):
+        with self.lock:
+            item=self.data.get(key)
+            if item is None: return None
+            if item[0] < time.monotonic(): del self.data[key]; return None
+            self.data.move_to_end(key); return item[1]
+    def set(self, key: str, value):
+        with self.lock:
+            self.data[key]=(time.monotonic()+self.ttl, value); self.data.move_to_end(key)
+            while len(self.data) > self.maxsize: self.data.popitem(last=False)
+    def clear(self):
+        with self.lock: self.data.clear()
+
+class ResponseCache:
+    def __init__(self):
+        self.local=TTLCache(CACHE_MAX_ITEMS, CACHE_TTL)
+        self.gen=0; self._gen_read_at=0.0
+        self.hits=collections.Counter()
+        self._redis=None; self._redis_lock=threading.Lock()
+        self._inflight: Dict[str,threading.Lock]={}; self._inflight_lock=threading.Lock()
+
+    def redis(self):
+        if not REDIS_URL: return None
+        with self._redis_lock:
+            if self._redis is None:
+                import redis  # opcional: só é necessário com REDIS_URL
+                self._redis=redis.Redis.from_url(REDIS_URL, socket_timeout=0.25, socket_connect_timeout=0.5, health_check_interval=30)
+            return self._redis
+
+    def _redis_call(self, fn, *args):
+        """Falha do Redis nunca derruba a rota: cai para o cache local."""
+        try: return getattr(self.redis(), fn)(*args)
+        except Exception as e:
+            self.hits["redis_errors"]+=1
+            if self.hits["redis_errors"] % 1000 == 1: print(f"[cache] Redis indisponível: {e}", flush=True)
+            return None
+
+    def generation(self) -> int:
+        if REDIS_URL and time.monotonic()-self._gen_read_at > CACHE_GEN_POLL:
+            self._gen_read_at=time.monotonic()
+            g=self._redis_call("get", REDIS_PREFIX+"gen")
+            if g is not None: self.gen=int(g)
+        return self.gen
+
+    def get(self, key: str):
+        v=self.local.get(key)
+        if v is not None: self.hits["hits_local"]+=1; return v
+        if REDIS_URL:
+            raw=self._redis_call("get", REDIS_PREFIX+key)
+            if raw:
+                etag, _, body = raw.partition(b"\n")
+                v=(body, etag.decode()); self.local.set(key, v); self.hits["hits_redis"]+=1; return v
+        self.hits["misses"]+=1
+        return None
+
+    def set(self, key: str, value):
+        self.local.set(key, value)
+        if REDIS_URL: self._redis_call("setex", REDIS_PREFIX+key, max(1, int(CACHE_TTL)), value[1].encode()+b"\n"+value[0])
+
+    def invalidate(self):
+        g=self._redis_call("incr", REDIS_PREFIX+"gen") if REDIS_URL else None
+        self.gen=int(g) if g is not None else self.gen+1
+        self._gen_read_at=time.monotonic()
+        self.local.clear()
+        self.hits["invalidations"]+=1
+
+    def key_lock(self, key: str) -> threading.Lock:
+        # Um cálculo por chave por vez: numa rajada de miss, só a primeira requisição vai ao banco
+        with self._inflight_lock:
+            if len(self._inflight) > 4*CACHE_MAX_ITEMS: self._inflight.clear()
+            return self._inflight.setdefault(key, threading.Lock())
+
+    def stats(self) -> Dict[str,Any]:
+        return {"generation":self.gen, "items":len(self.local.data), "ttl_s":CACHE_TTL, "redis":bool(REDIS_URL), **self.hits}
+
+response_cache = ResponseCache()
+
+def cached_json(request: Request, key: str, compute) -> Response:
+    """Resposta JSON cacheada com ETag: If-None-Match igual devolve 304 sem corpo (e sem banco)."""
+    key=f"{response_cache.generation()}:{key}"
+    entry=response_cache.get(key)
+    if entry is None:
+        with response_cache.key_lock(key):
+            entry=response_cache.get(key)
+            if entry is None:
+                body=json.dumps(jsonable_encoder(compute()), ensure_ascii=False, separators=(",",":")).encode()
+                entry=(body, '"'+hashlib.blake2b(body, digest_size=12).hexdigest()+'"')
+                response_cache.set(key, entry)
+    body, etag = entry
+    headers={"ETag":etag, "Cache-Control":"no-cache"}  # cliente guarda, mas revalida sempre (barato: 304)
+    inm=request.headers.get("if-none-match")
+    if inm and (inm.strip()=="*" or etag in [t.strip().removeprefix("W/") for t in inm.split(",")]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.post("/cache/invalidate")
+def cache_invalidate():
+    """Para cargas/dbt feitos fora da API (psql, dbt CLI)."""
+    response_cache.invalidate()
+    return response_cache.stats()
+
+# ---------------- Clientes / insights ----------------
+def visao_cliente(cod: str) -> Dict[str,Any]:
+    with get_conn() as conn:
+        cliente=conn.execute("SELECT cod_cliente, razao_social, primeira_compra, ultima_compra FROM dim_cliente WHERE cod_cliente=%s", (cod,)).fetchone()
+        if not cliente: raise HTTPException(status_code=404, detail="Cliente não encontrado")
+        rfm=conn.execute("""SELECT recencia_dias, freq, valor, r_score, f_score, m_score, rfm_score, data_referencia
+                            FROM mart_rfm WHERE cod_cliente=%s""", (cod,)).fetchone()
+        totais=conn.execute("""SELECT count(DISTINCT documento_fiscal) AS pedidos, coalesce(sum(qtde),0) AS itens,
+                                      coalesce(sum(total_venda),0) AS total_venda, coalesce(sum(margem),0) AS margem,
+                                      sum(total_venda)/nullif(count(DISTINCT documento_fiscal),0) AS ticket_medio
+                               FROM fato_venda WHERE cod_cliente=%s""", (cod,)).fetchone()
+        mensal=conn.execute("""SELECT date_trunc('month', data)::date AS mes, count(DISTINCT documento_fiscal) AS pedidos,
+                                      sum(total_venda) AS total_venda, sum(margem) AS margem
+                               FROM fato_venda WHERE cod_cliente=%s AND data >= date_trunc('month', current_date) - interval '11 months'
+                               GROUP BY 1 ORDER BY 1""", (cod,)).fetchall()
+        produtos=conn.execute("""SELECT sku, max(produto) AS produto, max(familia) AS familia, sum(qtde) AS qtde, sum(total_venda) AS total_venda
+                                 FROM fato_venda WHERE cod_cliente=%s GROUP BY sku ORDER BY sum(total_venda) DESC NULLS LAST LIMIT 10""", (cod,)).fetchall()
+    return {**cliente, "rfm":rfm, "totais":totais, "mensal_12m":mensal, "top_produtos":produtos}
+
+def churn_insights(dias: int, min_fm: int, limit: int) -> Dict[str,Any]:
+    """Clientes da janela do RFM sem comprar há `dias` ou mais que eram frequentes/valiosos (f_score+m_score >= min_fm)."""
+    with get_conn() as conn:
+        resumo=conn.execute("""SELECT count(*) AS total_clientes, coalesce(sum(valor),0) AS valor_em_risco, max(data_referencia) AS data_referencia
+                               FROM mart_rfm WHERE recencia_dias >= %s AND f_score + m_score >= %s""", (dias, min_fm)).fetchone()
+        clientes=conn.execute("""SELECT r.cod_cliente, c.razao_social, r.ultima_compra, r.recencia_dias, r.freq, r.valor,
+                                        r.r_score, r.f_score, r.m_score, r.rfm_score
+                                 FROM mart_rfm r LEFT JOIN dim_cliente c ON c.cod_cliente = r.cod_cliente
+                                 WHERE r.recencia_dias >= %s AND r.f_score + r.m_score >= %s
+                                 ORDER BY r.valor DESC, r.cod_cliente LIMIT %s""", (dias, min_fm, limit)).fetchall()
+    return {"criterio":{"dias_sem_compra":dias, "min_f_m_score":min_fm}, **resumo, "clientes":clientes}
+
+@app.get("/clientes/{cod}/visao")
+def get_visao_cliente(cod: str, request: Request):
+    return cached_json(request, f"visao:{cod}", lambda: visao_cliente(cod))
+
+@app.get("/insights/churn")
+def get_churn(request: Request, dias: int = 90, min_fm: int = 6, limit: int = 100):
+    if dias < 0 or not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="Parâmetros inválidos: dias >= 0 e 1 <= limit <= 1000")
+    return cached_json(request, f"churn:{dias}:{min_fm}:{limit}", lambda: churn_insights(dias, min_fm, limit))
+
+# ---------------- Vendas (explorador) ----------------
+# Paginação keyset em (data, id_fato_venda): a página N custa o mesmo que a primeira (sem OFFSET),
+# usando os índices (data, id_fato_venda), (cod_cliente, data, id_fato_venda) e (sku, data, id_fato_venda)
+# do fato_venda (dbt_project/macros/partitioned_fato_venda.sql). familia/marca filtram sobre o índice por data.
+VENDAS_COLS = ["id_fato_venda","data","documento_fiscal","cod_cliente","razao_social","sku","produto","familia","sub_familia","marca","cor","tam","qtde","preco_unit","total_venda","total_custo","margem"]
+VENDAS_MAX_LIMIT = int(os.getenv("VENDAS_MAX_LIMIT", "1000"))
+VENDAS_EXPORT_BATCH = int(os.getenv("VENDAS_EXPORT_BATCH", "5000"))  # linhas por fetch do cursor de servidor no export
+
+def encode_cursor(row: Dict[str,Any]) -> str:
+    return base64.urlsafe_b64encode(f"{row['data'].isoformat()}|{row['id_fato_venda']}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        d, _, vid = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().partition("|")
+        return datetime.date.fromisoformat(d), vid
+    except Exception:
+        raise HTTPException(status_code=400, detail="cursor inválido")
+
+def vendas_where(data_ini, data_fim, cod_cliente, sku, familia, marca):
+    conds, params = ["data IS NOT NULL"], []
+    if data_ini: conds.append("data >= %s"); params.append(data_ini)
+    if data_fim: conds.append("data <= %s"); params.append(data_fim)
+    for col, val in (("cod_cliente",cod_cliente),("sku",sku),("familia",familia),("marca",marca)):
+        if val: conds.append(f"{col} = %s"); params.append(val)
+    return conds, params
+
+def _vendas_export(sql: str, params: list, fmt: str):
+    """Gera o export em blocos a partir de um cursor de servidor: memória constante, qualquer volume."""
+    with get_conn() as conn:
+        with conn.cursor(name=f"vendas_export_{uuid.uuid4().hex[:8]}") as cur:
+            cur.itersize=VENDAS_EXPORT_BATCH
+            cur.execute(sql, params)
+            if fmt=="csv":
+                buf=io.StringIO(); w=csv.writer(buf, lineterminator="\n")
+                w.writerow(VENDAS_COLS); yield buf.getvalue()
+            while True:
+                rows=cur.fetchmany(VENDAS_EXPORT_BATCH)
+                if not rows: break
+                if fmt=="csv":
+                    buf.seek(0); buf.truncate()
+                    w.writerows([[r[c] for c in VENDAS_COLS] for r in rows]); yield buf.getvalue()
+                else:
+                    yield "".join(json.dumps(jsonable_encoder(r), ensure_ascii=False, separators=(",",":"))+"\n" for r in rows)
+
+@app.get("/vendas")
+def list_vendas(data_ini: Optional[datetime.date] = None, data_fim: Optional[datetime.date] = None, cod_cliente: Optional[str] = None,
+                sku: Optional[str] = None, familia: Optional[str] = None, marca: Optional[str] = None,
+                limit: int = 100, cursor: Optional[str] = None, ordem: str = "desc", format: str = "json"):
+    """Itens de venda filtrados, mais recentes primeiro. Passe o next_cursor da resposta para a página seguinte.
+    format=csv|ndjson exporta tudo o que casar com os filtros, em streaming (ignora limit/cursor)."""
+    if ordem not in ("desc","asc"): raise HTTPException(status_code=400, detail="ordem deve ser desc ou asc")
+    if format not in ("json","csv","ndjson"): raise HTTPException(status_code=400, detail="format deve ser json, csv ou ndjson")
+    if not 1 <= limit <= VENDAS_MAX_LIMIT: raise HTTPException(status_code=400, detail=f"limit deve estar entre 1 e {VENDAS_MAX_LIMIT}")
+    conds, params = vendas_where(data_ini, data_fim, cod_cliente, sku, familia, marca)
+    order=f"data {ordem}, id_fato_venda {ordem}"
+    if format!="json":
+        sql=f"SELECT {', '.join(VENDAS_COLS)} FROM fato_venda WHERE {' AND '.join(conds)} ORDER BY {order}"
+        media={"csv":"text/csv; charset=utf-8", "ndjson":"application/x-ndjson"}[format]
+        return StreamingResponse(_vendas_export(sql, params, format), media_type=media,
+                                 headers={"Content-Disposition":f'attachment; filename="vendas.{format}"'})
+    if cursor:
+        cdata, cid = decode_cursor(cursor)
+        op="<" if ordem=="desc" else ">"
+        # a condição só em data é redundante, mas deixa o planner podar as partições mensais já percorridas
+        conds += [f"data {op}= %s", f"(data, id_fato_venda) {op} (%s, %s)"]; params += [cdata, cdata, cid]
+    sql=f"SELECT {', '.join(VENDAS_COLS)} FROM fato_venda WHERE {' AND '.join(conds)} ORDER BY {order} LIMIT %s"
+    with get_conn() as conn:
+        rows=conn.execute(sql, params+[limit+1]).fetchall()
+    has_more=len(rows) > limit; rows=rows[:limit]
+    return {"items":rows, "count":len(rows), "has_more":has_more, "next_cursor":encode_cursor(rows[-1]) if has_more else None}
 
 # ---------------- Ingest helpers ----------------
 REQ_COLS = ["data","produto","sku","familia","sub_familia","cor","tam","marca","cod_cliente","razao_social","qtde","preco_unit","total_venda","total_custo","margem","documento_fiscal"]
@@ -55,12 +432,22 @@ ALIASES = {
 NUMERIC_COLS = {"qtde","preco_unit","total_venda","total_custo","margem"}
 decimal_re = re.compile(r"^-?\d{1,3}(\.\d{3})*,\d+$|^-?\d+,\d+$")
 
-def normalize_decimal(val: str) -> str:
+DECIMAL_SEPS = ("auto", "comma", "dot")  # auto: só 1.234,56 / 12,5 são lidos como vírgula decimal
+DATE_FORMATS = ("YYYY-MM-DD", "DD/MM/YYYY")
+
+def normalize_decimal(val: str, decimal_sep: str = "auto") -> str:
     if val is None or val == "": return val
     s = val.strip()
-    if decimal_re.match(s): s = s.replace(".", "").replace(",", ".")
+    if decimal_sep == "comma" or (decimal_sep == "auto" and decimal_re.match(s)): s = s.replace(".", "").replace(",", ".")
+    elif decimal_sep == "dot": s = s.replace(",", "")
     return s
 
+def normalize_date(dd: str, date_format: str) -> str:
+    if isinstance(dd,str) and date_format=="DD/MM/YYYY" and "/" in dd:
+        p=dd.split("/")
+        if len(p)==3 and p[0].isdigit() and p[1].isdigit() and p[2]: dd=f"{p[2]}-{int(p[1]):02d}-{int(p[0]):02d}"
+    return dd
+
 def slug(s: str) -> str:
     s = unidecode((s or "").strip().lower()); out=[]; prev=False
     for ch in s:
@@ -82,11 +469,69 @@ def detect_dialect(sample_text: str):
             return Semi
         else: return csv.excel
 
-def _open_text_reader(path, detected=None):
-    if path.endswith(".gz"): f=gzip.open(path, mode="rt", encoding="utf-8", newline="")
-    else: f=open(path, mode="rt", encoding="utf-8", newline="")
-    if detected: return f, csv.reader(f, dialect=detected)
-    return f, csv.reader(f)
+class IngestTrace:
+    """Span de um ingest. No streaming as etapas se intercalam, então cada uma soma só o próprio tempo:
+    download (leitura da rede/disco), sniff, normalize (CPU, inclusive gunzip), copy (envio ao Postgres,
+    com a espera dele) e finalize (delta, partições, commit). Mostra se uma carga lenta é rede, CPU ou banco."""
+    def __init__(self, source: str):
+        self.source=source; self.t0=time.perf_counter(); self.stages=collections.Counter(); self.bytes=0; self.rows_done_at=None
+
+    def reader(self, raw):
+        return io.BufferedReader(_TimedReader(raw, self), 1024*1024)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        t=time.perf_counter(); d=self.stages["download"]
+        try: yield
+        finally: self.stages[name]+=time.perf_counter()-t-(self.stages["download"]-d)
+
+    def rows(self, rows):
+        it=iter(rows)
+        while True:
+            t=time.perf_counter(); d=self.stages["download"]
+            item=next(it, None); now=time.perf_counter(); self.stages["normalize"]+=now-t-(self.stages["download"]-d)
+            if item is None: self.rows_done_at=now; return
+            yield item
+
+    def copy(self, fn):
+        """Roda fn (o copy_into_db) separando o envio ao Postgres do tempo gasto produzindo as linhas."""
+        t=time.perf_counter(); before=self.stages["download"]+self.stages["normalize"]
+        try: return fn()
+        finally:
+            end=time.perf_counter(); done=self.rows_done_at or end
+            self.stages["copy"]+=done-t-(self.stages["download"]+self.stages["normalize"]-before)
+            self.stages["finalize"]+=end-done
+
+    def timings(self) -> Dict[str,float]:
+        return {k:round(v, 4) for k,v in self.stages.items()}
+
+    def finish(self, status: str, mode: str, stats: Optional[Dict[str,Any]] = None, **fields):
+        stats=stats or {}
+        for k,v in self.stages.items(): INGEST_STAGE_SECONDS.labels(k, self.source).observe(v)
+        INGESTS.labels(self.source, mode, status).inc(); INGEST_BYTES.labels(self.source).inc(self.bytes)
+        INGEST_ROWS.labels(self.source, mode).inc(stats.get("rows", 0)); INGEST_REJECTED.labels(self.source).inc(stats.get("rejected", 0))
+        log_span("ingest", time.perf_counter()-self.t0, source=self.source, mode=mode, status=status, rows=stats.get("rows"),
+                 rejected=stats.get("rejected"), bytes=self.bytes, stages_s=self.timings(), **fields)
+
+class _TimedReader(io.RawIOBase):
+    def __init__(self, raw, trace): self.raw=raw; self.trace=trace
+    def readable(self): return True
+    def readinto(self, b):
+        t=time.perf_counter(); data=self.raw.read(len(b)); n=len(data); b[:n]=data
+        self.trace.stages["download"]+=time.perf_counter()-t; self.trace.bytes+=n
+        return n
+
+def open_text_stream(raw, gz: bool = False, trace: Optional[IngestTrace] = None, encoding: str = "utf-8"):
+    """Envolve um stream binário (corpo HTTP, upload) em texto (UTF-8 ou o encoding do perfil), descompactando gzip on-the-fly."""
+    if trace: raw=trace.reader(raw)
+    if gz: raw=gzip.GzipFile(fileobj=raw, mode="rb")
+    return io.TextIOWrapper(raw, encoding=encoding, newline="")
+
+def sniff_stream(ftxt, head: str = "", sample_size: int = 10000):
+    """Lê só um prefixo para o Sniffer e devolve (dialect, linhas) sem reler o arquivo."""
+    sample=head+ftxt.read(sample_size)
+    if sample and not sample.endswith(("\n","\r")): sample+=ftxt.readline()
+    return detect_dialect(sample), itertools.chain(io.StringIO(sample, newline=""), ftxt)
 
 def build_alias_map(header: List[str]):
     norm={slug(h):i for i,h in enumerate(header)}; matched={}
@@ -106,173 +551,1298 @@ def apply_user_header_map(header: List[str], header_map: Optional[Dict[str,str]]
         out[req_col]=idx
     return out
 
-def process_to_filtered_csv(in_path: str, date_format: str, header_map: Optional[Dict[str,str]]):
-    if in_path.endswith(".gz"):
-        with gzip.open(in_path,"rt",encoding="utf-8",newline="") as ftxt: sample_text=ftxt.read(10000)
+def normalize_row(row: List[str], ncols: int, idx_map: Dict[str,int], date_format: str, decimal_sep: str = "auto") -> List[Optional[str]]:
+    if len(row)<ncols: row=row+[""]*(ncols-len(row))
+    r={ col: row[idx_map[col]] for col in REQ_COLS }
+    r["data"]=normalize_date(r["data"], date_format)
+    for c in NUMERIC_COLS: r[c]=normalize_decimal(r[c], decimal_sep)
+    # Campo vazio vira NULL, como no COPY csv (campo vazio sem aspas)
+    return [r[c] if r[c]!="" else None for c in REQ_COLS]
+
+# ---- Normalização em blocos (pool de processos) ----
+CopyBlock = collections.namedtuple("CopyBlock", "rows text")  # bloco já no formato texto do COPY
+_COPY_ESC = str.maketrans({"\\":"\\\\","\t":"\\t","\n":"\\n","\r":"\\r"})
+
+def copy_text_line(row: List[Optional[str]]) -> str:
+    return "\t".join("\\N" if v is None else v.translate(_COPY_ESC) for v in row)
+
+def csv_format(dialect) -> Dict[str,Any]:
+    """Parâmetros do dialect como dict (as classes do Sniffer não são picklable)."""
+    return {k:getattr(dialect,k) for k in ("delimiter","quotechar","doublequote","escapechar","skipinitialspace","quoting")}
+
+def iter_record_blocks(lines, quotechar: Optional[str], block_rows: int):
+    """Agrupa linhas em blocos de texto que terminam sempre em fim de registro (aspas balanceadas)."""
+    buf=[]; inq=False
+    for line in lines:
+        buf.append(line)
+        if quotechar and quotechar in line: inq^=bool(line.count(quotechar)&1)
+        if not inq and len(buf)>=block_rows: yield "".join(buf); buf=[]
+    if buf: yield "".join(buf)
+
+def normalize_block(text: str, fmt: Dict[str,Any], ncols: int, idx_map: Dict[str,int], date_format: str, decimal_sep: str = "auto") -> CopyBlock:
+    out=[copy_text_line(normalize_row(row, ncols, idx_map, date_format, decimal_sep)) for row in csv.reader(io.StringIO(text, newline=""), **fmt) if row]
+    return CopyBlock(len(out), "\n".join(out)+"\n" if out else "")
+
+def normalize_block_arrow(text: str, fmt: Dict[str,Any], ncols: int, idx_map: Dict[str,int], date_format: str, decimal_sep: str = "auto") -> CopyBlock:
+    """Mesma saída de normalize_block, mas colunar: pyarrow.csv + pyarrow.compute sobre o bloco inteiro."""
+    import pyarrow as pa, pyarrow.csv as pacsv, pyarrow.compute as pc
+    if fmt["skipinitialspace"] or fmt["quoting"]==csv.QUOTE_NONE:
+        return normalize_block(text, fmt, ncols, idx_map, date_format, decimal_sep)  # sem equivalente no leitor do Arrow
+    names=[f"c{i}" for i in range(ncols)]
+    try:
+        t=pacsv.read_csv(io.BytesIO(text.encode("utf-8")),
+            read_options=pacsv.ReadOptions(column_names=names),
+            parse_options=pacsv.ParseOptions(delimiter=fmt["delimiter"], quote_char=fmt["quotechar"] or False, double_quote=fmt["doublequote"],
+                                             escape_char=fmt["escapechar"] or False, newlines_in_values=True, ignore_empty_lines=True),
+            convert_options=pacsv.ConvertOptions(column_types={n:pa.string() for n in names}, include_columns=[names[i] for i in sorted(set(idx_map.values()))],
+                                                 strings_can_be_null=False, quoted_strings_can_be_null=False))
+    except pa.ArrowInvalid:
+        return normalize_block(text, fmt, ncols, idx_map, date_format, decimal_sep)  # linhas com nº de colunas irregular
+    if t.num_rows==0: return CopyBlock(0, "")
+    cols=[]
+    for c in REQ_COLS:
+        a=t.column(names[idx_map[c]]).combine_chunks()
+        if c=="data" and date_format=="DD/MM/YYYY":
+            d=pc.dictionary_encode(a)  # poucas datas distintas por bloco: converte só o dicionário
+            a=pc.take(pa.array([normalize_date(u, date_format) for u in d.dictionary.to_pylist()], pa.string()), d.indices)
+        elif c in NUMERIC_COLS:
+            a=pc.utf8_trim_whitespace(a)
+            comma=pc.replace_substring(pc.replace_substring(a, ".", ""), ",", ".")
+            a=comma if decimal_sep=="comma" else pc.replace_substring(a, ",", "") if decimal_sep=="dot" else pc.if_else(pc.match_substring_regex(a, decimal_re.pattern), comma, a)
+        if pc.any(pc.match_substring_regex(a, r"[\\\t\n\r]")).as_py():
+            for k,v in (("\\","\\\\"),("\t","\\t"),("\n","\\n"),("\r","\\r")): a=pc.replace_substring(a, k, v)
+        cols.append(pc.if_else(pc.equal(a, ""), "\\N", a))
+    lines=pc.binary_join_element_wise(*cols, "\t")
+    text=pc.binary_join(pa.ListArray.from_arrays([0, len(lines)], lines), "\n")[0].as_py()
+    return CopyBlock(len(lines), text+"\n")
+
+BLOCK_ENGINES = {"python": normalize_block, "arrow": normalize_block_arrow}
+
+# ---- COPY binário: valores já tipados em Python; registro inválido vai para REJECTS_TABLE em vez de abortar ----
+COPY_FORMATS = ("text", "binary")
+COPY_TYPES = ["date" if c=="data" else "numeric" if c in NUMERIC_COLS else "text" for c in REQ_COLS]
+TypedBlock = collections.namedtuple("TypedBlock", "rows rejects")  # rejects: (índice no bloco, coluna, valor, erro, registro)
+_DATA_IDX = REQ_COLS.index("data")
+_NUMERIC_IDX = [i for i,c in enumerate(REQ_COLS) if c in NUMERIC_COLS]
+
+class RejectedValue(ValueError):
+    def __init__(self, col: str, val: str, msg: str):
+        super().__init__(msg); self.col=col; self.val=val
+
+def typed_row(row: List[Optional[str]]) -> list:
+    """Linha normalizada (strings) -> tipos do staging (date/Decimal); RejectedValue no primeiro valor inválido."""
+    out=list(row); v=out[_DATA_IDX]
+    if v is not None:
+        try: out[_DATA_IDX]=datetime.date.fromisoformat(v)
+        except ValueError: raise RejectedValue("data", v, "data inválida (confira o date_format)") from None
+    for i in _NUMERIC_IDX:
+        v=out[i]
+        if v is None: continue
+        try: d=decimal.Decimal(v)
+        except decimal.InvalidOperation: d=None
+        if d is None or not d.is_finite(): raise RejectedValue(REQ_COLS[i], v, "número inválido")
+        out[i]=d
+    return out
+
+def typed_block(text: str, fmt: Dict[str,Any], ncols: int, idx_map: Dict[str,int], date_format: str, decimal_sep: str = "auto") -> TypedBlock:
+    rows=[]; rejects=[]
+    for i,row in enumerate(r for r in csv.reader(io.StringIO(text, newline=""), **fmt) if r):
+        norm=normalize_row(row, ncols, idx_map, date_format, decimal_sep)
+        try: rows.append(typed_row(norm))
+        except RejectedValue as e: rejects.append((i, e.col, e.val, str(e), norm))
+    return TypedBlock(rows, rejects)
+
+def add_rejects(rejects: list, first: int, items) -> None:
+    """Acumula rejeitados com o nº do registro no arquivo (1 = primeiro após o cabeçalho)."""
+    rejects.extend((first+i, col, val, err, reg) for i,col,val,err,reg in items)
+    if len(rejects)>INGEST_MAX_REJECTS:
+        raise HTTPException(status_code=400, detail={"erro":f"Mais de {INGEST_MAX_REJECTS} registros inválidos; carga abortada (confira date_format e separadores)",
+                                                     "exemplos":[{"linha":n,"coluna":c,"valor":v,"erro":e} for n,c,v,e,_ in rejects[:5]]})
+
+def save_rejects(cur, load_id: str, rejects: list) -> None:
+    with cur.copy(f"COPY {REJECTS_TABLE} (load_id, linha, coluna, valor, erro, registro) FROM STDIN") as cp:
+        for n,col,val,err,reg in rejects: cp.write_row((load_id, n, col, val, err, Jsonb(dict(zip(REQ_COLS, reg)))))
+
+_pools: Dict[int,ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+def get_process_pool(workers: int) -> ProcessPoolExecutor:
+    # spawn: a API roda com threads (uvicorn), fork aqui pode travar
+    with _pools_lock:
+        if workers not in _pools: _pools[workers]=ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pools[workers]
+
+def ordered_pool_map(fn, items, workers: int):
+    """Como executor.map, mas com no máximo 2*workers blocos em voo (memória constante) e ordem preservada."""
+    ex=get_process_pool(workers); pending=collections.deque()
+    try:
+        for it in items:
+            pending.append(ex.submit(fn, it))
+            if len(pending)>=workers*2: yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
+    finally:
+        for f in pending: f.cancel()
+
+# ---- Perfis de origem: dialect, encoding, header_map, date_format e decimal de cada fonte (PROFILES_TABLE) ----
+# Com perfil o ingest pula o Sniffer. O perfil vem pelo id (`profile`) ou pelo fingerprint da linha de
+# cabeçalho, e o primeiro import ok de um cabeçalho novo vira o perfil auto_<fingerprint>.
+_profile_cache: Dict[tuple,tuple] = {}
+
+def header_fingerprint(line: str) -> str:
+    """Identidade de um layout: hash da linha de cabeçalho crua, calculável antes de qualquer sniff."""
+    return hashlib.sha1(line.lstrip("\ufeff").rstrip("\r\n").encode("utf-8")).hexdigest()[:16]
+
+def _profile_lookup(col: str, value: str) -> Optional[Dict[str,Any]]:
+    hit=_profile_cache.get((col, value))
+    if hit and hit[0]>time.monotonic(): return hit[1]
+    with get_conn() as conn:
+        row=conn.execute(f"SELECT * FROM {PROFILES_TABLE} WHERE {col}=%s", (value,)).fetchone()
+    _profile_cache[(col, value)]=(time.monotonic()+PROFILE_CACHE_SECONDS, row)  # ausência também fica em cache
+    return row
+
+def get_profile(profile_id: Optional[str]) -> Optional[Dict[str,Any]]:
+    if not profile_id: return None
+    prof=_profile_lookup("id", profile_id)
+    if not prof: raise HTTPException(status_code=400, detail=f"Perfil de origem não encontrado: {profile_id}")
+    return prof
+
+def find_profile(fingerprint: str) -> Optional[Dict[str,Any]]:
+    """Perfil do cabeçalho, se houver; erro no banco não impede o ingest (cai no Sniffer)."""
+    try:
+        return _profile_lookup("fingerprint", fingerprint)
+    except psycopg.Error as e:
+        print(f"[ingest-profiles] busca por fingerprint falhou: {e}", flush=True)
+        return None
+
+def profile_encoding(prof: Optional[Dict[str,Any]]) -> str:
+    return (prof or {}).get("encoding") or "utf-8"
+
+def open_ingest_stream(raw, gz: bool = False, trace: Optional[IngestTrace] = None, profile: Optional[Dict[str,Any]] = None):
+    """open_text_stream com o perfil da fonte: o explícito ou o do fingerprint do cabeçalho, lido ainda em bytes
+    (peek no buffer) para que o encoding do perfil valha já na decodificação. Devolve (texto, perfil)."""
+    if trace: raw=trace.reader(raw)
+    if gz: raw=gzip.GzipFile(fileobj=raw, mode="rb")
+    if profile is None and hasattr(raw, "peek"):
+        head=raw.peek(64*1024).split(b"\n", 1)[0]
+        try: head=head.decode("utf-8")
+        except UnicodeDecodeError: head=head.decode("latin-1")
+        profile=find_profile(header_fingerprint(head))
+    return open_text_stream(raw, encoding=profile_encoding(profile)), profile
+
+def profile_dialect(params: Dict[str,Any]):
+    return type("perfil", (csv.Dialect,), {**csv_format(csv.excel), **params, "lineterminator": "\n"})
+
+@functools.lru_cache(maxsize=256)
+def resolve_idx_map(header: tuple, header_map_json: Optional[str]) -> Dict[str,int]:
+    """Cabeçalho (+ header_map) -> índice de cada coluna; em cache, o mesmo layout não é re-slugado a cada carga."""
+    header=list(header)
+    return {**build_alias_map(header), **apply_user_header_map(header, json.loads(header_map_json) if header_map_json else None)}
+
+def record_profile_use(proc: Dict[str,Any]) -> Optional[str]:
+    """Conta o uso do perfil aplicado ou, sem perfil, aprende um (sem sobrescrever perfis existentes). Devolve o id aprendido."""
+    with get_conn() as conn:
+        if proc["profile"]:
+            conn.execute(f"UPDATE {PROFILES_TABLE} SET uses=uses+1, last_used_at=now() WHERE id=%s", (proc["profile"],))
+            return None
+        if not INGEST_LEARN_PROFILES: return None
+        header=proc["header"]; fp=proc["fingerprint"]
+        row=conn.execute(f"""INSERT INTO {PROFILES_TABLE} (id, fingerprint, header, dialect, encoding, header_map, date_format, decimal_sep, auto_learned, uses, last_used_at)
+                             VALUES (%s, %s, %s, %s, 'utf-8', %s, %s, 'auto', true, 1, now()) ON CONFLICT DO NOTHING RETURNING id""",
+                         (f"auto_{fp}", fp, Jsonb(header), Jsonb(proc["dialect_params"]), Jsonb({c:header[i] for c,i in proc["idx_map"].items()}),
+                          proc["date_format"])).fetchone()
+    _profile_cache.pop(("fingerprint", fp), None)
+    return row["id"] if row else None
+
+def prepare_ingest(ftxt, date_format: Optional[str], header_map: Optional[Dict[str,str]], workers: Optional[int] = None, engine: Optional[str] = None, copy_format: Optional[str] = None,
+                   profile: Optional[Dict[str,Any]] = None, match_profile: bool = False):
+    """Sniff + cabeçalho + preview numa única passada; as linhas normalizadas saem como gerador.
+
+    Com workers>1 o restante do arquivo é fatiado em blocos de registros completos e normalizado
+    num ProcessPoolExecutor; o gerador passa a entregar CopyBlock na mesma ordem do caminho serial.
+    engine="arrow" normaliza cada bloco de forma colunar com pyarrow (também combinável com workers).
+    copy_format="binary" converte os blocos já nos tipos do staging (TypedBlock), para o COPY binário.
+    Com perfil (dado ou, com match_profile, achado pelo fingerprint do cabeçalho) o Sniffer não roda;
+    date_format e header_map explícitos valem sobre os do perfil.
+    """
+    workers=INGEST_WORKERS if workers is None else workers
+    engine=(engine or INGEST_ENGINE).lower()
+    if engine not in BLOCK_ENGINES: raise HTTPException(status_code=400, detail=f"engine inválido: {engine} (use {', '.join(BLOCK_ENGINES)})")
+    copy_format=(copy_format or INGEST_COPY_FORMAT).lower()
+    if copy_format not in COPY_FORMATS: raise HTTPException(status_code=400, detail=f"copy_format inválido: {copy_format} (use {', '.join(COPY_FORMATS)})")
+    if copy_format=="binary" and engine!="python": raise HTTPException(status_code=400, detail="copy_format=binary só com engine=python")
+    head=ftxt.readline(); fp=header_fingerprint(head)
+    if profile is None and match_profile and head: profile=find_profile(fp)
+    if profile and profile.get("dialect"):
+        dialect=profile_dialect(profile["dialect"]); lines=itertools.chain([head], ftxt)
     else:
-        with open(in_path,"rt",encoding="utf-8",newline="") as ftxt: sample_text=ftxt.read(10000)
-    dialect=detect_dialect(sample_text)
-    fin, rin=_open_text_reader(in_path,dialect); header=next(rin,None)
-    if not header: fin.close(); raise HTTPException(status_code=400, detail="CSV sem cabeçalho")
-    idx_map={**build_alias_map(header), **apply_user_header_map(header, header_map)}
+        dialect, lines=sniff_stream(ftxt, head)
+    prof=profile or {}
+    date_format=date_format or prof.get("date_format") or "YYYY-MM-DD"
+    decimal_sep=prof.get("decimal_sep") or "auto"
+    rin=csv.reader(lines, dialect=dialect); header=next(rin,None)
+    if not header: raise HTTPException(status_code=400, detail="CSV sem cabeçalho")
+    hm={**(prof.get("header_map") or {}), **(header_map or {})}
+    idx_map=resolve_idx_map(tuple(header), json.dumps(hm, sort_keys=True) if hm else None)
     miss=[c for c in REQ_COLS if c not in idx_map]
     if miss:
-        fin.close()
         raise HTTPException(status_code=400, detail={"erro":"Colunas faltantes","faltantes":miss,"cabecalho_disponivel":header,"cabecalho_normalizado":[slug(h) for h in header]})
-    preview=[]; 
+    preview=[]
     for _ in range(5):
         row=next(rin,None)
         if row is None: break
         preview.append(row)
-    fin.close()
-    with tempfile.NamedTemporaryFile(mode="w",delete=False,suffix=".csv",encoding="utf-8",newline="") as tmp_out:
-        out_path=tmp_out.name; w=csv.writer(tmp_out,lineterminator="\n"); w.writerow(REQ_COLS)
-        fin, rin=_open_text_reader(in_path,dialect); _=next(rin,None)
-        count=0
-        for row in rin:
-            if not row: continue
-            if len(row)<len(header): row+=[""]*(len(header)-len(row))
-            r={ col: row[idx_map[col]] for col in REQ_COLS }
-            dd=r["data"]
-            if isinstance(dd,str) and date_format=="DD/MM/YYYY" and "/" in dd:
-                p=dd.split("/")
-                if len(p)==3 and all(p): dd=f"{p[2]}-{int(p[1]):02d}-{int(p[0]):02d}"
-            r["data"]=dd
-            for c in NUMERIC_COLS: r[c]=normalize_decimal(r[c])
-            w.writerow([r[c] for c in REQ_COLS]); count+=1
-            if count%50000==0: tmp_out.flush()
-    return {"out_path":out_path,"header":header,"preview":preview,"count":count,"dialect":getattr(dialect,'__name__',str(dialect)),"staging_table":STAGING_TABLE}
-
-def copy_into_db(out_path: str, mode: str):
+    ncols=len(header)
+    if workers>1 or engine!="python":
+        # csv.reader não lê adiante: `lines` está exatamente no início do próximo registro
+        fn=functools.partial(typed_block if copy_format=="binary" else BLOCK_ENGINES[engine], fmt=csv_format(dialect), ncols=ncols, idx_map=idx_map, date_format=date_format, decimal_sep=decimal_sep)
+        blocks=iter_record_blocks(lines, dialect.quotechar, INGEST_BLOCK_ROWS)
+        rows=itertools.chain((normalize_row(row, ncols, idx_map, date_format, decimal_sep) for row in preview if row),
+                             ordered_pool_map(fn, blocks, workers) if workers>1 else map(fn, blocks))
+    else:
+        rows=(normalize_row(row, ncols, idx_map, date_format, decimal_sep) for row in itertools.chain(preview, rin) if row)
+    return {"rows":rows,"header":header,"preview":preview,"dialect":f"perfil:{profile['id']}" if profile and profile.get("dialect") else getattr(dialect,'__name__',str(dialect)),
+            "staging_table":STAGING_TABLE,"copy_format":copy_format,"date_format":date_format,"decimal_sep":decimal_sep,"profile":profile["id"] if profile else None,
+            "fingerprint":fp,"dialect_params":csv_format(dialect),"idx_map":idx_map}
+
+COPY_COLS = ",".join(REQ_COLS)
+LOAD_MODES = ("full", "append", "merge", "replace_dates", "replace_months")
+DELTA_MODES = ("merge", "replace_dates", "replace_months")  # passam pela tabela temporária _ingest_delta
+
+def resolve_merge_key(merge_key) -> List[str]:
+    if not merge_key: return MERGE_KEY
+    cols=[c.strip() for c in (merge_key.split(",") if isinstance(merge_key, str) else merge_key) if c.strip()]
+    bad=[c for c in cols if c not in REQ_COLS]
+    if bad or not cols: raise HTTPException(status_code=400, detail={"erro":"merge_key inválida","colunas_invalidas":bad,"colunas_validas":REQ_COLS})
+    return cols
+
+# Sentinela de NULL por tipo na chave do merge: campo vazio já vira NULL, então '' nunca é valor real
+_KEY_NULL = {"text":"''", "date":"'-infinity'::date", "numeric":"'NaN'::numeric"}
+
+def merge_key_expr(alias: str, col: str) -> str:
+    """coalesce da coluna da chave com o sentinela: NULL casa com NULL no reenvio (com `=` a linha duplicaria) e
+    a expressão é a mesma do índice raw_vendas_achatado_nk_idx (sql/ddl.sql), que o planner continua usando."""
+    return f"coalesce({alias}.{col}, {_KEY_NULL[COPY_TYPES[REQ_COLS.index(col)]]})"
+
+def merge_delta(cur, key: List[str], copied: int, where: str = "TRUE") -> Dict[str,Any]:
+    """Upsert de _ingest_delta (só as linhas em `where`) em STAGING_TABLE pela chave natural; conta inseridas/atualizadas/iguais."""
+    on=" AND ".join(f"{merge_key_expr('s',k)}={merge_key_expr('d',k)}" for k in key)
+    vals=[c for c in REQ_COLS if c not in key]
+    # Chave repetida no próprio arquivo: vale a última ocorrência
+    cur.execute(f"""CREATE TEMP TABLE _ingest_dedup ON COMMIT DROP AS
+                    SELECT DISTINCT ON ({",".join(key)}) * FROM _ingest_delta WHERE {where} ORDER BY {",".join(key)}, _ord DESC""")
+    dedup=cur.rowcount
+    cur.execute("ANALYZE _ingest_dedup")
+    cur.execute(f"""WITH u AS (
+                      UPDATE {STAGING_TABLE} s SET {", ".join(f"{c}=d.{c}" for c in vals)}, _loaded_at=now()
+                      FROM _ingest_dedup d
+                      WHERE {on} AND ({",".join(f"s.{c}" for c in vals)}) IS DISTINCT FROM ({",".join(f"d.{c}" for c in vals)})
+                      RETURNING d._ord)
+                    SELECT count(DISTINCT _ord) AS n FROM u""")
+    updated=cur.fetchone()["n"]
+    cur.execute(f"""INSERT INTO {STAGING_TABLE} ({COPY_COLS})
+                    SELECT {COPY_COLS} FROM _ingest_dedup d
+                    WHERE NOT EXISTS (SELECT 1 FROM {STAGING_TABLE} s WHERE {on})""")
+    inserted=cur.rowcount
+    cur.execute(f"SELECT count(*) AS n FROM _ingest_dedup WHERE {' OR '.join(f'{k} IS NULL' for k in key)}")
+    null_key=cur.fetchone()["n"]
+    return {"inserted":inserted, "updated":updated, "unchanged":dedup-inserted-updated, "duplicates_in_file":copied-dedup, "null_key":null_key, "merge_key":key}
+
+def merge_null_dates(cur, key: List[str], stats: Dict[str,Any]) -> Dict[str,Any]:
+    """Linhas sem data não pertencem a nenhuma janela (dia/mês): nos modos replace_* vão pelo merge na chave
+    natural, senão cada reenvio do arquivo as duplicaria no staging."""
+    cur.execute("SELECT count(*) AS n FROM _ingest_delta WHERE data IS NULL")
+    n=cur.fetchone()["n"]
+    if not n: return stats
+    m=merge_delta(cur, key, n, where="data IS NULL")
+    return {**stats, "inserted":stats["inserted"]+m["inserted"], "updated":m["updated"], "unchanged":m["unchanged"], "null_date":n}
+
+def replace_dates(cur, key: List[str]) -> Dict[str,Any]:
+    """Substitui por completo os dias presentes no arquivo (janela de datas do delta)."""
+    cur.execute(f"DELETE FROM {STAGING_TABLE} WHERE data IN (SELECT DISTINCT data FROM _ingest_delta WHERE data IS NOT NULL)")
+    deleted=cur.rowcount
+    cur.execute(f"INSERT INTO {STAGING_TABLE} ({COPY_COLS}) SELECT {COPY_COLS} FROM _ingest_delta WHERE data IS NOT NULL ORDER BY _ord")
+    return merge_null_dates(cur, key, {"deleted":deleted, "inserted":cur.rowcount})
+
+def replace_months(cur, key: List[str]) -> Dict[str,Any]:
+    """Substitui por completo os meses presentes no arquivo: TRUNCATE das partições afetadas, sem DELETE."""
+    months=delta_months(cur)
+    parts=ensure_partitions(cur, months)
+    if parts: cur.execute(f"TRUNCATE TABLE {', '.join(parts)}")
+    cur.execute(f"INSERT INTO {STAGING_TABLE} ({COPY_COLS}) SELECT {COPY_COLS} FROM _ingest_delta WHERE data IS NOT NULL ORDER BY _ord")
+    return merge_null_dates(cur, key, {"months":[m.isoformat()[:7] for m in months], "inserted":cur.rowcount})
+
+def staging_partitioned(cur) -> bool:
+    cur.execute("SELECT relkind = 'p' AS p FROM pg_class WHERE oid = to_regclass(%s)", (STAGING_TABLE,))
+    row=cur.fetchone()
+    return bool(row and row["p"])
+
+def delta_months(cur) -> list:
+    cur.execute("SELECT DISTINCT date_trunc('month', data)::date AS m FROM _ingest_delta WHERE data IS NOT NULL ORDER BY 1")
+    return [r["m"] for r in cur.fetchall()]
+
+def ensure_partitions(cur, months) -> List[str]:
+    """Partições mensais do staging para os meses dados (staging.ensure_month_partition, ver sql/ddl.sql)."""
+    parts=[]
+    for m in months:
+        cur.execute("SELECT staging.ensure_month_partition(%s::regclass, %s)::text AS part", (STAGING_TABLE, m))
+        parts.append(cur.fetchone()["part"])
+    return parts
+
+def copy_into_db(rows, mode: str, merge_key: Optional[List[str]] = None, copy_format: str = "text") -> Dict[str,Any]:
+    """Grava as linhas direto no COPY (sem CSV intermediário).
+
+    full copia direto para STAGING_TABLE; os demais modos copiam para uma tabela temporária
+    (sem WAL) e aplicam o delta no staging dentro da mesma transação. Com o staging particionado
+    por mês, as partições dos meses do delta são criadas antes de aplicá-lo; no full, as linhas de
+    meses novos caem na DEFAULT durante o COPY e são separadas ao final.
+
+    copy_format="binary" usa COPY (FORMAT binary) com os valores já tipados: o Postgres não reinterpreta
+    texto, e registros com data/número inválido vão para REJECTS_TABLE em vez de abortar a carga.
+    """
+    mode=mode.lower(); count=0; stats: Dict[str,Any]={}
+    binary=copy_format=="binary"; rejects: list=[]; load_id=str(uuid.uuid4())
     with get_conn() as conn:
         try:
             with conn.cursor() as cur:
-                if mode.lower().startswith("full"):
+                partitioned=staging_partitioned(cur)
+                if mode=="replace_months" and not partitioned:
+                    raise HTTPException(status_code=400, detail=f"mode replace_months exige {STAGING_TABLE} particionado por mês (aplique sql/ddl.sql)")
+                # append num staging particionado também passa pelo delta: meses novos nunca disputam a DEFAULT
+                delta=mode in DELTA_MODES or (mode=="append" and partitioned)
+                if mode.startswith("full"):
                     try: cur.execute(f'TRUNCATE TABLE {STAGING_TABLE};')
                     except Exception:
                         if FALLBACK_DELETE:
                             conn.rollback()
                             with conn.cursor() as cur2: cur2.execute(f'DELETE FROM {STAGING_TABLE};')
                         else: raise
-                copy_sql = f"""COPY {STAGING_TABLE}
-                (data,produto,sku,familia,sub_familia,cor,tam,marca,
-                 cod_cliente,razao_social,qtde,preco_unit,total_venda,
-                 total_custo,margem,documento_fiscal)
-                FROM STDIN WITH (FORMAT csv, HEADER true)"""
-                with open(out_path,"r",encoding="utf-8") as fcsv: cur.copy(copy_sql, fcsv)
+                if delta:
+                    cur.execute(f"CREATE TEMP TABLE _ingest_delta (LIKE {STAGING_TABLE} INCLUDING DEFAULTS) ON COMMIT DROP")
+                    cur.execute("ALTER TABLE _ingest_delta ADD COLUMN _ord bigserial")
+                with cur.copy(f"COPY {'_ingest_delta' if delta else STAGING_TABLE} ({COPY_COLS}) FROM STDIN{' (FORMAT binary)' if binary else ''}") as cp:
+                    if binary: cp.set_types(COPY_TYPES)
+                    for row in rows:
+                        if isinstance(row, CopyBlock): cp.write(row.text); count+=row.rows
+                        elif isinstance(row, TypedBlock):
+                            for r in row.rows: cp.write_row(r)
+                            if row.rejects: add_rejects(rejects, count+len(rejects)+1, row.rejects)
+                            count+=len(row.rows)
+                        elif binary:
+                            try: cp.write_row(typed_row(row)); count+=1
+                            except RejectedValue as e: add_rejects(rejects, count+len(rejects)+1, [(0, e.col, e.val, str(e), row)])
+                        else: cp.write_row(row); count+=1
+                if rejects: save_rejects(cur, load_id, rejects)
+                if delta and partitioned and mode!="replace_months":
+                    ensure_partitions(cur, delta_months(cur))
+                if mode=="merge":
+                    stats=merge_delta(cur, merge_key or MERGE_KEY, count)
+                elif mode=="replace_dates":
+                    stats=replace_dates(cur, merge_key or MERGE_KEY)
+                elif mode=="replace_months":
+                    stats=replace_months(cur, merge_key or MERGE_KEY)
+                elif mode=="append" and delta:
+                    cur.execute(f"INSERT INTO {STAGING_TABLE} ({COPY_COLS}) SELECT {COPY_COLS} FROM _ingest_delta ORDER BY _ord")
+                elif partitioned:
+                    cur.execute("SELECT count(*) AS n FROM staging.split_default_partition(%s::regclass)", (STAGING_TABLE,))
+                    stats={"new_partitions":cur.fetchone()["n"]}
             conn.commit()
+        except psycopg.errors.DataError as e:
+            conn.rollback()
+            raise HTTPException(status_code=400, detail={"erro":"Valor inválido para o staging", "mensagem":e.diag.message_primary, "contexto":e.diag.context})
         except Exception:
             conn.rollback(); raise
+    response_cache.invalidate()
+    if rejects: stats.update(rejected=len(rejects), load_id=load_id)
+    return {"rows":count, **stats}
 
-@app.post("/ingest/url")
-def ingest_from_url(url: str = Body(..., embed=True), mode: str = Body("full", embed=True), date_format: str = Body("YYYY-MM-DD", embed=True), header_map: Optional[Dict[str,str]] = Body(None, embed=True)):
+def mode_label(mode: str) -> str:
+    return mode.lower() if mode.lower() in LOAD_MODES else "full"  # full_* é full (cardinalidade fixa nas métricas)
+
+def ingest_stream(ftxt, mode: str, date_format: Optional[str], header_map: Optional[Dict[str,str]], workers: Optional[int] = None, engine: Optional[str] = None, job=None, merge_key=None, copy_format=None, trace: Optional[IngestTrace] = None, profile: Optional[Dict[str,Any]] = None):
+    if not mode.lower().startswith("full") and mode.lower() not in LOAD_MODES:
+        raise HTTPException(status_code=400, detail=f"mode inválido: {mode} (use {', '.join(LOAD_MODES)})")
+    key=resolve_merge_key(merge_key) if mode.lower() in DELTA_MODES else None  # replace_*: chave das linhas sem data
+    trace=trace or IngestTrace("stream"); label=mode_label(mode)
     try:
-        with requests.get(url, stream=True, timeout=900) as r:
-            r.raise_for_status()
-            suffix = ".csv.gz" if url.lower().endswith(".gz") else ".csv"
-            with tempfile.NamedTemporaryFile(mode="wb", delete=False, suffix=suffix) as tmp_in:
-                for chunk in r.iter_content(chunk_size=1024*1024):
-                    if chunk: tmp_in.write(chunk)
-                in_path = tmp_in.name
+        if job: job.set_phase("sniff")
+        with trace.stage("sniff"): proc=prepare_ingest(ftxt,date_format,header_map,workers,engine,copy_format,profile,match_profile=True)
+        if job: job.set_phase("copy")
+        rows=trace.rows(job.track(proc["rows"]) if job else proc["rows"])
+        stats=trace.copy(lambda: copy_into_db(rows,mode,key,proc["copy_format"]))
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Falha no download: {e}")
-    out_path=None
+        trace.finish("cancelled" if isinstance(e, IngestCancelled) else "error", label, job=job.id if job else None,
+                     error=getattr(e, "detail", None) or f"{type(e).__name__}: {e}")
+        raise
+    trace.finish("ok", label, stats, job=job.id if job else None, copy_format=proc["copy_format"], workers=workers, engine=engine, profile=proc["profile"])
     try:
-        proc=process_to_filtered_csv(in_path,date_format,header_map); out_path=proc["out_path"]; copy_into_db(out_path,mode)
-        return {"ok":True,"rows":proc["count"],"mode":mode,"date_format":date_format,"dialect":proc["dialect"],"preview_header":proc["header"],"preview_rows":proc["preview"],"staging_table":proc["staging_table"]}
-    finally:
-        try:
-            if out_path and os.path.exists(out_path): os.remove(out_path)
-        except Exception: pass
-        try:
-            if in_path and os.path.exists(in_path): os.remove(in_path)
-        except Exception: pass
+        learned=record_profile_use(proc)
+    except psycopg.Error as e:  # a carga já foi commitada; perfil é só otimização
+        print(f"[ingest-profiles] falha ao registrar perfil: {e}", flush=True); learned=None
+    return {"ok":True,**stats,"mode":mode,"copy_format":proc["copy_format"],"stages_s":trace.timings(),"date_format":proc["date_format"],"decimal_sep":proc["decimal_sep"],
+            "profile":proc["profile"],"profile_learned":learned,"dialect":proc["dialect"],"preview_header":proc["header"],"preview_rows":proc["preview"],"staging_table":proc["staging_table"]}
 
-@app.post("/ingest/upload")
-async def ingest_upload(file: UploadFile = File(...), mode: str = Form("full"), date_format: str = Form("YYYY-MM-DD"), header_map_json: Optional[str] = Form(None)):
-    header_map=None
-    if header_map_json:
+def ingest_url_stream(url: str, job=None, profile: Optional[str] = None, **opts):
+    """Download em streaming direto para o pipeline de ingest (sem arquivo temporário)."""
+    prof=get_profile(profile)
+    trace=IngestTrace("url"); t0=time.perf_counter()
+    try:
+        r=requests.get(url, stream=True, timeout=900); r.raise_for_status()
+    except Exception as e:
+        trace.finish("error", mode_label(opts.get("mode") or "full"), error=f"Falha no download: {e}")
+        raise HTTPException(status_code=400, detail=f"Falha no download: {e}")
+    trace.stages["download"]+=time.perf_counter()-t0  # conexão + cabeçalhos
+    with r:
+        r.raw.decode_content=True  # Content-Encoding (gzip/deflate) do transporte
+        raw=r.raw
+        if job:
+            if r.headers.get("Content-Length") and not r.headers.get("Content-Encoding"): job.bytes_total=int(r.headers["Content-Length"])
+            raw=job.count_bytes(raw)
         try:
-            header_map=json.loads(header_map_json)
-            if not isinstance(header_map, dict): raise ValueError("header_map_json deve ser um objeto JSON")
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"header_map_json inválido: {e}")
+            ftxt, prof=open_ingest_stream(raw, gz=url.lower().split("?")[0].endswith(".gz"), trace=trace, profile=prof)
+            with ftxt:
+                return ingest_stream(ftxt, job=job, trace=trace, profile=prof, **opts)
+        except (requests.RequestException, Urllib3Error, OSError, EOFError) as e:
+            raise HTTPException(status_code=400, detail=f"Falha no download: {e}")
+
+def parse_header_map_json(header_map_json: Optional[str]) -> Optional[Dict[str,str]]:
+    if not header_map_json: return None
     try:
-        suffix = ".csv.gz" if file.filename.lower().endswith(".gz") else ".csv"
-        with tempfile.NamedTemporaryFile(mode="wb", delete=False, suffix=suffix) as tmp_in:
-            while True:
-                chunk=await file.read(1024*1024)
-                if not chunk: break
-                tmp_in.write(chunk)
-            in_path=tmp_in.name
+        header_map=json.loads(header_map_json)
+        if not isinstance(header_map, dict): raise ValueError("header_map_json deve ser um objeto JSON")
+        return header_map
     except Exception as e:
+        raise HTTPException(status_code=400, detail=f"header_map_json inválido: {e}")
+
+@app.post("/ingest/url")
+def ingest_from_url(url: str = Body(..., embed=True), mode: str = Body("full", embed=True), date_format: Optional[str] = Body(None, embed=True), header_map: Optional[Dict[str,str]] = Body(None, embed=True), workers: Optional[int] = Body(None, embed=True), engine: Optional[str] = Body(None, embed=True), merge_key: Optional[List[str]] = Body(None, embed=True), copy_format: Optional[str] = Body(None, embed=True), profile: Optional[str] = Body(None, embed=True)):
+    return ingest_url_stream(url, profile=profile, mode=mode, date_format=date_format, header_map=header_map, workers=workers, engine=engine, merge_key=merge_key, copy_format=copy_format)
+
+@app.post("/ingest/upload")
+async def ingest_upload(file: UploadFile = File(...), mode: str = Form("full"), date_format: Optional[str] = Form(None), header_map_json: Optional[str] = Form(None), workers: Optional[int] = Form(None), engine: Optional[str] = Form(None), merge_key: Optional[str] = Form(None), copy_format: Optional[str] = Form(None), profile: Optional[str] = Form(None)):
+    header_map=parse_header_map_json(header_map_json)
+    # O corpo multipart já está no SpooledTemporaryFile do Starlette; lê direto dele, sem outra cópia
+    prof=await run_in_threadpool(get_profile, profile)
+    try:
+        trace=IngestTrace("upload")
+        ftxt, prof=await run_in_threadpool(open_ingest_stream, file.file, (file.filename or "").lower().endswith(".gz"), trace, prof)
+        with ftxt:
+            return await run_in_threadpool(ingest_stream, ftxt, mode, date_format, header_map, workers, engine, None, merge_key, copy_format, trace, prof)
+    except (OSError, EOFError) as e:
         raise HTTPException(status_code=400, detail=f"Falha ao receber upload: {e}")
-    out_path=None
+
+# Aliases de clientes antigos: o mesmo handler, fora do OpenAPI
+for _path in ("/upload", "/ingest/file", "/api/ingest/upload"):
+    app.add_api_route(_path, ingest_upload, methods=["POST"], include_in_schema=False)
+
+@app.get("/ingest/rejects")
+def list_ingest_rejects(load_id: Optional[uuid.UUID] = None, limit: int = 100):
+    """Registros recusados pelas cargas com copy_format=binary (o load_id vem na resposta do ingest)."""
+    with get_conn() as conn:
+        return conn.execute(f"""SELECT * FROM {REJECTS_TABLE} WHERE %(id)s::uuid IS NULL OR load_id=%(id)s
+                                ORDER BY id DESC LIMIT %(n)s""", {"id":load_id, "n":min(limit, 1000)}).fetchall()
+
+PROFILE_ID_RE = re.compile(r"^[a-z0-9][a-z0-9_.-]{0,62}$")
+
+@app.get("/ingest/profiles")
+def list_profiles():
+    with get_conn() as conn:
+        return conn.execute(f"SELECT * FROM {PROFILES_TABLE} ORDER BY auto_learned, id").fetchall()
+
+@app.get("/ingest/profiles/{profile_id}")
+def read_profile(profile_id: str):
+    with get_conn() as conn:
+        row=conn.execute(f"SELECT * FROM {PROFILES_TABLE} WHERE id=%s", (profile_id,)).fetchone()
+    if not row: raise HTTPException(status_code=404, detail="Perfil de origem não encontrado")
+    return row
+
+@app.put("/ingest/profiles/{profile_id}")
+def put_profile(profile_id: str, dialect: Optional[Dict[str,Any]] = Body(None, embed=True), encoding: str = Body("utf-8", embed=True),
+                header_map: Optional[Dict[str,str]] = Body(None, embed=True), date_format: Optional[str] = Body(None, embed=True),
+                decimal_sep: str = Body("auto", embed=True), header_line: Optional[str] = Body(None, embed=True)):
+    """Cria/substitui um perfil. header_line (a 1ª linha do arquivo, como vem) liga o perfil ao layout sem precisar do parâmetro profile."""
+    if not PROFILE_ID_RE.match(profile_id): raise HTTPException(status_code=400, detail="id do perfil: minúsculas, dígitos, '_', '.', '-' (até 63)")
+    try: codecs.lookup(encoding)
+    except LookupError: raise HTTPException(status_code=400, detail=f"encoding desconhecido: {encoding}")
+    if decimal_sep not in DECIMAL_SEPS: raise HTTPException(status_code=400, detail=f"decimal_sep deve ser um de {DECIMAL_SEPS}")
+    if date_format and date_format not in DATE_FORMATS: raise HTTPException(status_code=400, detail=f"date_format deve ser um de {DATE_FORMATS}")
+    if header_map and set(header_map)-set(REQ_COLS): raise HTTPException(status_code=400, detail=f"header_map com colunas desconhecidas: {sorted(set(header_map)-set(REQ_COLS))}")
+    if dialect:
+        try:
+            unknown=set(dialect)-set(csv_format(csv.excel))
+            if unknown: raise ValueError(f"chaves desconhecidas {sorted(unknown)}")
+            dialect=csv_format(profile_dialect(dialect)); csv.reader([], dialect=profile_dialect(dialect))
+        except (TypeError, ValueError, csv.Error) as e:
+            raise HTTPException(status_code=400, detail=f"dialect inválido: {e}")
+    fp=header_fingerprint(header_line) if header_line else None
+    header=next(csv.reader([header_line.lstrip("\ufeff")], dialect=profile_dialect(dialect) if dialect else csv.excel), None) if header_line else None
+    try:
+        with get_conn() as conn:
+            row=conn.execute(f"""INSERT INTO {PROFILES_TABLE} (id, fingerprint, header, dialect, encoding, header_map, date_format, decimal_sep, auto_learned)
+                                 VALUES (%s,%s,%s,%s,%s,%s,%s,%s,false)
+                                 ON CONFLICT (id) DO UPDATE SET fingerprint=EXCLUDED.fingerprint, header=EXCLUDED.header, dialect=EXCLUDED.dialect,
+                                   encoding=EXCLUDED.encoding, header_map=EXCLUDED.header_map, date_format=EXCLUDED.date_format,
+                                   decimal_sep=EXCLUDED.decimal_sep, auto_learned=false, updated_at=now()
+                                 RETURNING *""",
+                             (profile_id, fp, Jsonb(header) if header else None, Jsonb(dialect) if dialect else None, encoding,
+                              Jsonb(header_map) if header_map else None, date_format, decimal_sep)).fetchone()
+    except psycopg.errors.UniqueViolation:
+        raise HTTPException(status_code=409, detail="Já existe outro perfil para esse cabeçalho (apague-o ou edite-o)")
+    _profile_cache.clear()
+    return row
+
+@app.delete("/ingest/profiles/{profile_id}")
+def delete_profile(profile_id: str):
+    with get_conn() as conn:
+        row=conn.execute(f"DELETE FROM {PROFILES_TABLE} WHERE id=%s RETURNING id", (profile_id,)).fetchone()
+    if not row: raise HTTPException(status_code=404, detail="Perfil de origem não encontrado")
+    _profile_cache.clear()
+    return {"ok":True, "id":profile_id}
+
+@app.get("/ingest/header_template")
+def header_template():
+    """header_template.json da raiz do repo: modelo de header_map (coluna canônica -> cabeçalho do ERP)."""
+    path=os.path.join(ROOT_DIR, "header_template.json")
+    if not os.path.exists(path): raise HTTPException(status_code=404, detail="header_template.json não encontrado")
+    with open(path, encoding="utf-8") as f: return json.load(f)
+
+# ---------------- Ingest jobs ----------------
+# Ingest em background: o POST devolve o job_id na hora e um pool limitado de threads executa
+# download -> normalização -> COPY. O estado fica em INGEST_JOBS_TABLE (ver sql/ddl.sql).
+JOBS_TABLE = os.getenv("INGEST_JOBS_TABLE", "staging.ingest_jobs")
+INGEST_MAX_JOBS = int(os.getenv("INGEST_MAX_JOBS", "2"))        # jobs executando ao mesmo tempo
+INGEST_MAX_QUEUED = int(os.getenv("INGEST_MAX_QUEUED", "20"))   # além disso o POST responde 429
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "ingest_spool"))
+JOB_FLUSH_SECONDS = float(os.getenv("INGEST_JOB_FLUSH_SECONDS", "2"))
+JOB_STALE_SECONDS = float(os.getenv("INGEST_JOB_STALE_SECONDS", "60"))  # sem heartbeat há mais que isso: job órfão
+JOB_FINAL = ("done", "error", "cancelled")
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class IngestCancelled(Exception):
+    pass
+
+class _CountingReader(io.RawIOBase):
+    def __init__(self, raw, job): self.raw=raw; self.job=job
+    def readable(self): return True
+    def readinto(self, b):
+        data=self.raw.read(len(b)); n=len(data); b[:n]=data
+        self.job.bytes_read+=n
+        return n
+
+class IngestJob:
+    """Progresso de um job em memória; vai para o banco no máximo a cada JOB_FLUSH_SECONDS."""
+    def __init__(self, id: str, bytes_total: Optional[int] = None):
+        self.id=id; self.phase="queued"; self.rows=0; self.bytes_read=0; self.bytes_total=bytes_total
+        self.cancel=threading.Event(); self._flushed=0.0
+
+    def count_bytes(self, raw):
+        return io.BufferedReader(_CountingReader(raw, self), 1024*1024)
+
+    def track(self, rows):
+        for row in rows:
+            self.rows+=row.rows if isinstance(row, CopyBlock) else len(row.rows)+len(row.rejects) if isinstance(row, TypedBlock) else 1
+            if self.cancel.is_set(): raise IngestCancelled()
+            if time.monotonic()-self._flushed>=JOB_FLUSH_SECONDS: self.flush()
+            yield row
+
+    def set_phase(self, phase: str):
+        self.phase=phase; self.flush()
+        if self.cancel.is_set(): raise IngestCancelled()
+
+    def flush(self):
+        self._flushed=time.monotonic()
+        with get_conn() as conn:
+            row=conn.execute(f"""UPDATE {JOBS_TABLE} SET phase=%s, rows_processed=%s, bytes_read=%s, bytes_total=coalesce(%s, bytes_total),
+                                 updated_at=now(), heartbeat_at=now() WHERE id=%s RETURNING cancel_requested""",
+                             (self.phase, self.rows, self.bytes_read, self.bytes_total, self.id)).fetchone()
+        # o cancelamento pode ter sido pedido por outro processo/instância da API
+        if row and row["cancel_requested"]: self.cancel.set()
+
+    def finish(self, status: str, result: Optional[Dict[str,Any]] = None, error: Any = None):
+        if error is not None and not isinstance(error, str): error=json.dumps(error, ensure_ascii=False, default=str)
+        with get_conn() as conn:
+            conn.execute(f"""UPDATE {JOBS_TABLE} SET status=%s, phase=%s, rows_processed=%s, bytes_read=%s, result=%s, error=%s,
+                             finished_at=now(), updated_at=now(), heartbeat_at=now() WHERE id=%s""",
+                         (status, self.phase, self.rows, self.bytes_read, Jsonb(result) if result is not None else None, error, self.id))
+
+_jobs: Dict[str,IngestJob] = {}
+_job_executor = ThreadPoolExecutor(max_workers=INGEST_MAX_JOBS, thread_name_prefix="ingest-job")
+
+def _run_job(job: IngestJob, source: str, params: Dict[str,Any]):
     try:
-        proc=process_to_filtered_csv(in_path,date_format,header_map); out_path=proc["out_path"]; copy_into_db(out_path,mode)
-        return {"ok":True,"rows":proc["count"],"mode":mode,"date_format":date_format,"dialect":proc["dialect"],"preview_header":proc["header"],"preview_rows":proc["preview"],"staging_table":proc["staging_table"]}
+        with get_conn() as conn:
+            row=conn.execute(f"""UPDATE {JOBS_TABLE} SET status='running', phase='download', started_at=now(), updated_at=now(), heartbeat_at=now()
+                                 WHERE id=%s AND NOT cancel_requested RETURNING id""", (job.id,)).fetchone()
+        if not row: job.finish("cancelled"); return
+        job.phase="download"
+        opts={k:params.get(k) for k in ("mode","date_format","header_map","workers","engine","merge_key","copy_format")}
+        if source=="url":
+            result=ingest_url_stream(params["url"], job=job, profile=params.get("profile"), **opts)
+        else:
+            trace=IngestTrace("upload"); prof=get_profile(params.get("profile"))
+            with (UploadPartsReader(params["upload_id"], job) if params.get("upload_id") else open(params["spool_path"], "rb")) as fbin:
+                ftxt, prof=open_ingest_stream(job.count_bytes(fbin), gz=params.get("filename","").lower().endswith(".gz"), trace=trace, profile=prof)
+                with ftxt:
+                    result=ingest_stream(ftxt, job=job, trace=trace, profile=prof, **opts)
+        job.phase="done"; job.finish("done", result=result)
+    except IngestCancelled:
+        job.finish("cancelled")
+    except HTTPException as e:
+        job.finish("error", error=e.detail)
+    except Exception as e:
+        job.finish("error", error=f"{type(e).__name__}: {e}")
     finally:
+        _jobs.pop(job.id, None)
+        if source=="upload" and params.get("spool_path"):
+            try: os.remove(params["spool_path"])
+            except OSError: pass
+        if source=="upload" and params.get("upload_id"):
+            _finish_upload(params["upload_id"])
+
+def submit_job(source: str, params: Dict[str,Any], bytes_total: Optional[int] = None, job_id: Optional[str] = None) -> Dict[str,Any]:
+    if sum(1 for j in _jobs.values() if j.phase=="queued")>=INGEST_MAX_QUEUED:
+        raise HTTPException(status_code=429, detail="Fila de ingest cheia; tente novamente em instantes")
+    job=IngestJob(job_id or str(uuid.uuid4()), bytes_total)
+    if job_id is None:
+        with get_conn() as conn:
+            conn.execute(f"""INSERT INTO {JOBS_TABLE} (id, source, params, status, phase, bytes_total, owner)
+                             VALUES (%s, %s, %s, 'queued', 'queued', %s, %s)""", (job.id, source, Jsonb(params), bytes_total, JOB_OWNER))
+    _jobs[job.id]=job
+    _job_executor.submit(_run_job, job, source, params)
+    return {"job_id":job.id, "status":"queued", "status_url":f"/ingest/jobs/{job.id}"}
+
+def _jobs_heartbeat():
+    """Mantém vivos os jobs e builds dbt deste processo; retoma jobs órfãos e encerra builds órfãs (API reiniciada)."""
+    while True:
         try:
-            if out_path and os.path.exists(out_path): os.remove(out_path)
-        except Exception: pass
+            with get_conn() as conn:
+                if _jobs: conn.execute(f"UPDATE {JOBS_TABLE} SET heartbeat_at=now() WHERE id = ANY(%s)", (list(_jobs),))
+                # UPDATE ... WHERE heartbeat antigo é atômico: entre várias instâncias só uma retoma cada job
+                orphans=conn.execute(f"""UPDATE {JOBS_TABLE} SET owner=%s, status='queued', phase='queued', rows_processed=0, bytes_read=0,
+                                         started_at=NULL, heartbeat_at=now(), updated_at=now()
+                                         WHERE status IN ('queued','running') AND heartbeat_at < now() - make_interval(secs => %s)
+                                         RETURNING id, source, params, bytes_total, cancel_requested""", (JOB_OWNER, JOB_STALE_SECONDS)).fetchall()
+            for o in orphans:
+                if o["source"]=="upload" and not os.path.exists(o["params"].get("spool_path") or upload_dir(o["params"].get("upload_id") or "-")):
+                    IngestJob(str(o["id"])).finish("error", error="Arquivo do upload perdido no reinício da API; reenvie")
+                elif o["cancel_requested"]:
+                    IngestJob(str(o["id"])).finish("cancelled")
+                else:
+                    submit_job(o["source"], o["params"], o["bytes_total"], job_id=str(o["id"]))
+        except Exception as e:
+            print(f"[ingest-jobs] heartbeat falhou: {e}", flush=True)
+        try: expire_uploads()
+        except OSError as e: print(f"[ingest-uploads] limpeza falhou: {e}", flush=True)
         try:
-            if in_path and os.path.exists(in_path): os.remove(in_path)
-        except Exception: pass
-
-# Aliases
-@app.post("/upload")
-async def upload_alias(file: UploadFile = File(...), mode: str = Form("full"), date_format: str = Form("YYYY-MM-DD"), header_map_json: Optional[str] = Form(None)):
-    return await ingest_upload(file=file, mode=mode, date_format=date_format, header_map_json=header_map_json)
-@app.post("/ingest/file")
-async def ingest_file_alias(file: UploadFile = File(...), mode: str = Form("full"), date_format: str = Form("YYYY-MM-DD"), header_map_json: Optional[str] = Form(None)):
-    return await ingest_upload(file=file, mode=mode, date_format=date_format, header_map_json=header_map_json)
-@app.post("/api/ingest/upload")
-async def api_ingest_upload_alias(file: UploadFile = File(...), mode: str = Form("full"), date_format: str = Form("YYYY-MM-DD"), header_map_json: Optional[str] = Form(None)):
-    return await ingest_upload(file=file, mode=mode, date_format=date_format, header_map_json=header_map_json)
+            for run in list(_dbt_runs.values()):
+                if run.status not in ("done","error"): run.flush()  # já terminada: finish() gravou o fim, o heartbeat não mexe
+            with get_conn() as conn:  # build sem heartbeat: a API caiu no meio (o advisory lock já foi liberado)
+                conn.execute(f"""UPDATE {DBT_RUNS_TABLE} SET status='error', error='API reiniciada durante a build', finished_at=now()
+                                 WHERE status IN ('queued','running') AND heartbeat_at < now() - make_interval(secs => %s)""", (JOB_STALE_SECONDS,))
+        except Exception as e:
+            print(f"[dbt-runs] heartbeat falhou: {e}", flush=True)
+        time.sleep(max(1.0, JOB_STALE_SECONDS/4))
+
+def _job_status(row: Dict[str,Any]) -> Dict[str,Any]:
+    out=dict(row)
+    end=row.get("finished_at") or row.get("updated_at"); start=row.get("started_at")
+    elapsed=(end-start).total_seconds() if start and end else None
+    out["elapsed_s"]=round(elapsed, 1) if elapsed is not None else None
+    out["rows_per_s"]=round(row["rows_processed"]/elapsed, 1) if elapsed else None
+    out["mb_per_s"]=round(row["bytes_read"]/elapsed/1e6, 2) if elapsed else None
+    out["progress"]=round(min(1.0, row["bytes_read"]/row["bytes_total"]), 4) if row.get("bytes_total") else None
+    out["params"]={k:v for k,v in (row.get("params") or {}).items() if k!="spool_path"}
+    return out
+
+@app.post("/ingest/jobs/url", status_code=202)
+def ingest_job_url(url: str = Body(..., embed=True), mode: str = Body("full", embed=True), date_format: Optional[str] = Body(None, embed=True), header_map: Optional[Dict[str,str]] = Body(None, embed=True), workers: Optional[int] = Body(None, embed=True), engine: Optional[str] = Body(None, embed=True), merge_key: Optional[List[str]] = Body(None, embed=True), copy_format: Optional[str] = Body(None, embed=True), profile: Optional[str] = Body(None, embed=True)):
+    get_profile(profile)  # perfil inexistente: 400 agora, não erro no job
+    return submit_job("url", {"url":url, "mode":mode, "date_format":date_format, "header_map":header_map, "workers":workers, "engine":engine, "merge_key":merge_key, "copy_format":copy_format, "profile":profile})
+
+@app.post("/ingest/jobs/upload", status_code=202)
+async def ingest_job_upload(file: UploadFile = File(...), mode: str = Form("full"), date_format: Optional[str] = Form(None), header_map_json: Optional[str] = Form(None), workers: Optional[int] = Form(None), engine: Optional[str] = Form(None), merge_key: Optional[str] = Form(None), copy_format: Optional[str] = Form(None), profile: Optional[str] = Form(None)):
+    header_map=parse_header_map_json(header_map_json)
+    await run_in_threadpool(get_profile, profile)
+    # O request termina antes do job: o corpo precisa ir para um arquivo próprio do job
+    os.makedirs(INGEST_SPOOL_DIR, exist_ok=True)
+    spool_path=os.path.join(INGEST_SPOOL_DIR, f"{uuid.uuid4().hex}.part")
+    try:
+        with open(spool_path, "wb") as out: await run_in_threadpool(shutil.copyfileobj, file.file, out, 1024*1024)
+    except OSError as e:
+        raise HTTPException(status_code=400, detail=f"Falha ao receber upload: {e}")
+    params={"filename":file.filename or "", "spool_path":spool_path, "mode":mode, "date_format":date_format, "header_map":header_map, "workers":workers, "engine":engine, "merge_key":merge_key, "copy_format":copy_format, "profile":profile}
+    return await run_in_threadpool(submit_job, "upload", params, os.path.getsize(spool_path))
+
+@app.get("/ingest/jobs")
+def list_ingest_jobs(limit: int = 20):
+    with get_conn() as conn:
+        rows=conn.execute(f"SELECT * FROM {JOBS_TABLE} ORDER BY created_at DESC LIMIT %s", (min(limit, 200),)).fetchall()
+    return [_job_status(r) for r in rows]
+
+@app.get("/ingest/jobs/{job_id}")
+def get_ingest_job(job_id: uuid.UUID):
+    with get_conn() as conn:
+        row=conn.execute(f"SELECT * FROM {JOBS_TABLE} WHERE id=%s", (job_id,)).fetchone()
+    if not row: raise HTTPException(status_code=404, detail="Job não encontrado")
+    return _job_status(row)
+
+@app.post("/ingest/jobs/{job_id}/cancel")
+def cancel_ingest_job(job_id: uuid.UUID):
+    with get_conn() as conn:
+        row=conn.execute(f"UPDATE {JOBS_TABLE} SET cancel_requested=true, updated_at=now() WHERE id=%s RETURNING status", (job_id,)).fetchone()
+    if not row: raise HTTPException(status_code=404, detail="Job não encontrado")
+    job=_jobs.get(str(job_id))
+    if job: job.cancel.set()  # o COPY em andamento aborta no próximo lote e faz rollback
+    return {"job_id":str(job_id), "status":row["status"], "cancel_requested":True}
+
+# ---------------- Uploads em partes ----------------
+# Protocolo para arquivos grandes, retomável: POST /ingest/uploads (abre a sessão e diz o tamanho das partes)
+# -> PUT /ingest/uploads/{id}/parts/{n} em paralelo, cada uma com X-Part-SHA256 -> GET /ingest/uploads/{id}
+# (partes que faltam, para retomar) -> POST .../complete (vira um job de ingest). Com early=true o job já
+# nasce na abertura e vai lendo as partes em ordem conforme chegam. As partes ficam no disco da instância
+# (INGEST_SPOOL_DIR/uploads): com várias instâncias, a sessão precisa de afinidade.
+UPLOADS_DIR = os.path.join(INGEST_SPOOL_DIR, "uploads")
+UPLOAD_PART_SIZE = int(float(os.getenv("INGEST_UPLOAD_PART_MB", "16"))*2**20)
+UPLOAD_MIN_PART_SIZE = 2**20
+UPLOAD_MAX_PART_SIZE = 256*2**20
+UPLOAD_MAX_PARTS = 10000
+UPLOAD_WRITE_BUFFER = 2**20  # PUT de parte: grava no disco (fora do event loop) a cada 1 MB recebido
+UPLOAD_TTL_SECONDS = float(os.getenv("INGEST_UPLOAD_TTL_HOURS", "24"))*3600  # sessão parada (ou já importada) há mais que isso é apagada
+UPLOAD_PART_WAIT_SECONDS = float(os.getenv("INGEST_UPLOAD_PART_WAIT_SECONDS", "600"))  # early: espera máxima pela próxima parte
+_upload_lock = threading.Lock()
+_upload_arrived = threading.Condition()  # acorda os leitores early a cada parte gravada
+
+def upload_dir(upload_id: str) -> str:
+    return os.path.join(UPLOADS_DIR, str(upload_id))
+
+def upload_part_path(upload_id: str, n: int) -> str:
+    return os.path.join(upload_dir(upload_id), f"{n:05d}.part")
+
+def _upload_meta(upload_id: str) -> Dict[str,Any]:
+    try:
+        with open(os.path.join(upload_dir(upload_id), "upload.json"), encoding="utf-8") as f: return json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload não encontrado (expirado, cancelado ou já importado)")
+
+def _save_upload_meta(meta: Dict[str,Any]):
+    path=os.path.join(upload_dir(meta["upload_id"]), "upload.json")
+    with open(path+".tmp", "w", encoding="utf-8") as f: json.dump(meta, f)
+    os.replace(path+".tmp", path)
+
+def upload_part_length(meta: Dict[str,Any], n: int) -> int:
+    return min(meta["part_size"], meta["size"]-(n-1)*meta["part_size"])
+
+def _upload_status(meta: Dict[str,Any]) -> Dict[str,Any]:
+    d=upload_dir(meta["upload_id"])
+    received=sorted(int(f[:5]) for f in os.listdir(d) if f.endswith(".part"))
+    got=set(received)
+    return {**{k:meta[k] for k in ("upload_id","filename","size","part_size","parts","early","job_id")}, "finished":bool(meta.get("finished")),
+            "received":received, "missing":[] if meta.get("finished") else [n for n in range(1, meta["parts"]+1) if n not in got],
+            "bytes_received":sum(upload_part_length(meta, n) for n in received),
+            "parts_url":f"/ingest/uploads/{meta['upload_id']}/parts/{{n}}", "status_url":f"/ingest/uploads/{meta['upload_id']}"}
+
+class UploadPartsReader(io.RawIOBase):
+    """As partes de um upload, em ordem, como um arquivo só. Parte que ainda não chegou (early) é esperada."""
+    def __init__(self, upload_id: str, job: Optional[IngestJob] = None):
+        self.upload_id=upload_id; self.job=job; self.parts=_upload_meta(upload_id)["parts"]; self.n=1; self.f=None
+    def readable(self): return True
+    def _wait(self, n: int) -> str:
+        path=upload_part_path(self.upload_id, n); deadline=time.monotonic()+UPLOAD_PART_WAIT_SECONDS
+        while not os.path.exists(path):
+            if self.job and self.job.cancel.is_set(): raise IngestCancelled()
+            if not os.path.isdir(upload_dir(self.upload_id)): raise OSError("upload cancelado")
+            if time.monotonic()>deadline: raise OSError(f"a parte {n} não chegou em {UPLOAD_PART_WAIT_SECONDS:.0f}s")
+            with _upload_arrived: _upload_arrived.wait(1.0)
+        return path
+    def readinto(self, b):
+        while self.n<=self.parts:
+            if self.f is None: self.f=open(self._wait(self.n), "rb")
+            k=self.f.readinto(b)
+            if k: return k
+            self.f.close(); self.f=None; self.n+=1
+        return 0
+    def close(self):
+        if self.f: self.f.close(); self.f=None
+        super().close()
+
+def expire_uploads():
+    if not os.path.isdir(UPLOADS_DIR): return
+    for name in os.listdir(UPLOADS_DIR):
+        d=os.path.join(UPLOADS_DIR, name)
+        if time.time()-os.path.getmtime(d)<UPLOAD_TTL_SECONDS: continue
+        try: meta=_upload_meta(name)
+        except (HTTPException, ValueError): meta={}
+        if not meta.get("job_id") or meta.get("finished"): shutil.rmtree(d, ignore_errors=True)  # job rodando: espera ele terminar
+
+def _finish_upload(upload_id: str):
+    """Fim do job do upload: apaga as partes e marca a sessão como importada. O upload.json fica até o TTL,
+    para o complete de um job early que terminou antes dele ainda devolver o job_id."""
+    with _upload_lock:
+        try: meta=_upload_meta(upload_id)
+        except HTTPException: return  # cancelado (DELETE)
+        meta["finished"]=True; _save_upload_meta(meta)
+    d=upload_dir(upload_id)
+    for f in os.listdir(d):
+        if f.endswith((".part", ".tmp")):
+            try: os.remove(os.path.join(d, f))
+            except OSError: pass
+
+def _submit_upload_job(meta: Dict[str,Any]) -> Dict[str,Any]:
+    params={**meta["params"], "filename":meta["filename"], "upload_id":meta["upload_id"]}
+    out=submit_job("upload", params, meta["size"])
+    meta["job_id"]=out["job_id"]; _save_upload_meta(meta)
+    return out
+
+@app.post("/ingest/uploads", status_code=201)
+def create_upload(filename: str = Body(..., embed=True), size: int = Body(..., embed=True), part_size: Optional[int] = Body(None, embed=True), early: bool = Body(False, embed=True),
+                  mode: str = Body("full", embed=True), date_format: Optional[str] = Body(None, embed=True), header_map: Optional[Dict[str,str]] = Body(None, embed=True),
+                  workers: Optional[int] = Body(None, embed=True), engine: Optional[str] = Body(None, embed=True), merge_key: Optional[List[str]] = Body(None, embed=True),
+                  copy_format: Optional[str] = Body(None, embed=True), profile: Optional[str] = Body(None, embed=True)):
+    """Abre um upload em partes de `size` bytes. early=true já cria o job de ingest, que começa pela parte 1 assim que ela chegar.
+    No mode=full o early é ignorado: o TRUNCATE ficaria preso (e uma vaga de INGEST_MAX_JOBS ocupada) durante todo o envio."""
+    if mode.lower()=="full": early=False
+    if size<=0: raise HTTPException(status_code=400, detail="size deve ser o tamanho do arquivo em bytes")
+    part_size=min(max(part_size or UPLOAD_PART_SIZE, -(-size//UPLOAD_MAX_PARTS)), size)
+    if not min(UPLOAD_MIN_PART_SIZE, size)<=part_size<=UPLOAD_MAX_PART_SIZE:
+        raise HTTPException(status_code=400, detail=f"part_size deve ficar entre {UPLOAD_MIN_PART_SIZE} e {UPLOAD_MAX_PART_SIZE} bytes")
+    get_profile(profile)
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    if shutil.disk_usage(UPLOADS_DIR).free<size:
+        raise HTTPException(status_code=507, detail="Sem espaço no spool da API para esse arquivo")
+    upload_id=str(uuid.uuid4()); os.makedirs(upload_dir(upload_id))
+    meta={"upload_id":upload_id, "filename":filename, "size":size, "part_size":part_size, "parts":-(-size//part_size), "early":early, "job_id":None,
+          "params":{"mode":mode, "date_format":date_format, "header_map":header_map, "workers":workers, "engine":engine, "merge_key":merge_key, "copy_format":copy_format, "profile":profile}}
+    _save_upload_meta(meta)
+    if early:
+        try: _submit_upload_job(meta)
+        except HTTPException: shutil.rmtree(upload_dir(upload_id), ignore_errors=True); raise
+    return _upload_status(meta)
+
+@app.put("/ingest/uploads/{upload_id}/parts/{n}")
+async def put_upload_part(upload_id: uuid.UUID, n: int, request: Request, x_part_sha256: Optional[str] = Header(None)):
+    """Corpo cru da parte n (1..parts). Reenviar uma parte é seguro: ela só entra no lugar depois de conferida."""
+    meta=await run_in_threadpool(_upload_meta, str(upload_id))
+    if meta.get("finished"): raise HTTPException(status_code=409, detail=f"Upload encerrado: o job {meta['job_id']} já terminou (ver /ingest/jobs/{meta['job_id']})")
+    if not 1<=n<=meta["parts"]: raise HTTPException(status_code=400, detail=f"parte fora do intervalo 1..{meta['parts']}")
+    if not x_part_sha256: raise HTTPException(status_code=400, detail="Envie o SHA-256 da parte em X-Part-SHA256")
+    expected=upload_part_length(meta, n); path=upload_part_path(str(upload_id), n)
+    tmp=f"{path}.{uuid.uuid4().hex[:8]}.tmp"; h=hashlib.sha256(); got=0; buf=bytearray(); out=None
+    try:
+        out=await run_in_threadpool(open, tmp, "wb")
+        async for chunk in request.stream():
+            got+=len(chunk)
+            if got>expected: raise HTTPException(status_code=400, detail=f"parte {n} maior que {expected} bytes")
+            h.update(chunk); buf+=chunk
+            if len(buf)>=UPLOAD_WRITE_BUFFER: await run_in_threadpool(out.write, bytes(buf)); buf.clear()
+        await run_in_threadpool(out.write, bytes(buf)); await run_in_threadpool(out.close)
+        if got!=expected: raise HTTPException(status_code=400, detail=f"parte {n} com {got} bytes; esperado {expected}")
+        if h.hexdigest()!=x_part_sha256.lower(): raise HTTPException(status_code=400, detail=f"SHA-256 da parte {n} não confere; reenvie")
+        await run_in_threadpool(os.replace, tmp, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload não encontrado (expirado, cancelado ou já importado)")
+    finally:
+        if out is not None and not out.closed: await run_in_threadpool(out.close)
+        await run_in_threadpool(_remove_quiet, tmp)
+    with _upload_arrived: _upload_arrived.notify_all()
+    return {"upload_id":str(upload_id), "part":n, "size":got, "sha256":h.hexdigest()}
+
+def _remove_quiet(path: str):
+    try: os.remove(path)
+    except FileNotFoundError: pass
+
+@app.get("/ingest/uploads/{upload_id}")
+def get_upload(upload_id: uuid.UUID):
+    return _upload_status(_upload_meta(str(upload_id)))
+
+@app.post("/ingest/uploads/{upload_id}/complete", status_code=202)
+def complete_upload(upload_id: uuid.UUID):
+    """Confere que todas as partes chegaram e dispara o job de ingest (no early ele já está rodando ou até terminou)."""
+    with _upload_lock:  # dois complete simultâneos não criam dois jobs
+        meta=_upload_meta(str(upload_id)); st=_upload_status(meta)
+        if st["missing"]:
+            raise HTTPException(status_code=409, detail={"message":f"Faltam {len(st['missing'])} parte(s)", "missing":st["missing"][:1000]})
+        job=_submit_upload_job(meta) if not meta["job_id"] else {"job_id":meta["job_id"], "status_url":f"/ingest/jobs/{meta['job_id']}"}
+    return {**job, "upload_id":str(upload_id)}
+
+@app.delete("/ingest/uploads/{upload_id}")
+def delete_upload(upload_id: uuid.UUID):
+    """Cancela o upload; o job early, se houver, também é cancelado."""
+    meta=_upload_meta(str(upload_id))
+    if meta.get("job_id") and not meta.get("finished"): cancel_ingest_job(uuid.UUID(meta["job_id"]))
+    shutil.rmtree(upload_dir(str(upload_id)), ignore_errors=True)
+    with _upload_arrived: _upload_arrived.notify_all()
+    return {"ok":True, "upload_id":str(upload_id)}
 
 # ---------------- LOCAL DBT ----------------
+# O /dbt/run é um job: o POST devolve o run_id na hora e uma thread roda clean/deps/build. Um advisory
+# lock do Postgres garante uma build por target mesmo com várias instâncias; estado, log e tempos por
+# modelo ficam em DBT_RUNS_TABLE (ver sql/ddl.sql) e o log sai em streaming por /dbt/runs/{id}/logs.
+DBT_STATE_DIR = os.getenv("DBT_STATE_DIR", os.path.join(ROOT_DIR, "dbt_project", "state"))  # manifest do último build ok
+DBT_RUNS_TABLE = os.getenv("DBT_RUNS_TABLE", "staging.dbt_runs")
+DBT_TARGET = os.getenv("DBT_TARGET")  # vazio: target padrão do profiles.yml
+DBT_TARGET_KEY = f"{DBT_TARGET or 'default'}/{os.getenv('DBT_SCHEMA', 'SllupMarket')}"
+DBT_IN_PROCESS = os.getenv("DBT_IN_PROCESS", "false").lower() in ("1","true","yes")  # dbtRunner na API: sem subir um Python por comando
+DBT_LOG_POLL_SECONDS = 1.0  # stream de build que roda em outra instância: lê o log do banco
+
 def _dbt_env():
     env = os.environ.copy()
     return env
 
+def dbt_commands(proj: str, select: Optional[str], full_refresh: bool, clean: bool, logs: List[str]) -> List[str]:
+    """Monta a sequência de comandos: clean só se pedido, deps só se houver pacotes ainda não instalados."""
+    cmds = []
+    if clean:
+        cmds.append("dbt clean")
+    has_packages = any(os.path.exists(os.path.join(proj, f)) for f in ("packages.yml", "dependencies.yml"))
+    if has_packages and (clean or not os.path.isdir(os.path.join(proj, "dbt_packages"))):
+        cmds.append("dbt deps")
+    build = "dbt build --fail-fast"
+    if select:
+        if "state:" in select and not os.path.exists(os.path.join(DBT_STATE_DIR, "manifest.json")):
+            logs.append(f"Sem manifest em {DBT_STATE_DIR} para '{select}': rodando build completo")
+        else:
+            build += f" --select {shlex.quote(select)}"
+            if "state:" in select: build += f" --state {shlex.quote(DBT_STATE_DIR)}"
+    if full_refresh:
+        build += " --full-refresh"
+    if DBT_TARGET:
+        build += f" --target {shlex.quote(DBT_TARGET)}"
+    cmds.append(build)
+    return cmds
+
+def save_dbt_state(proj: str):
+    manifest = os.path.join(proj, "target", "manifest.json")
+    if os.path.exists(manifest):
+        os.makedirs(DBT_STATE_DIR, exist_ok=True)
+        shutil.copyfile(manifest, os.path.join(DBT_STATE_DIR, "manifest.json"))
+
+class DbtRun:
+    """Build em execução neste processo: o log fica em memória para o stream e vai para o banco a cada JOB_FLUSH_SECONDS."""
+    def __init__(self, id: str, params: Dict[str,Any]):
+        self.id=id; self.params=params; self.status="queued"; self.step=None; self.steps=[]; self.lines=[]
+        self.future=None; self._saved=0; self._flushed=0.0; self._lock=threading.Lock()
+
+    def log(self, text: str):
+        self.lines.extend(text.rstrip("\n").split("\n"))
+        if time.monotonic()-self._flushed>=JOB_FLUSH_SECONDS: self.flush()
+
+    def start(self):
+        self.status="running"
+        with get_conn() as conn:
+            conn.execute(f"UPDATE {DBT_RUNS_TABLE} SET status='running', started_at=now(), heartbeat_at=now() WHERE id=%s", (self.id,))
+
+    def flush(self, finished: bool = False, models: Optional[List[Dict[str,Any]]] = None, error: Optional[str] = None):
+        with self._lock:  # o heartbeat também grava: sem o lock, linhas sairiam duplicadas
+            self._flushed=time.monotonic()
+            new=self.lines[self._saved:]; self._saved+=len(new)
+            with get_conn() as conn:
+                conn.execute(f"""UPDATE {DBT_RUNS_TABLE} SET status=%s, step=%s, steps=%s, log=log||%s, models=coalesce(%s, models), error=coalesce(%s, error),
+                                 heartbeat_at=now(), finished_at=CASE WHEN %s THEN now() ELSE finished_at END WHERE id=%s""",
+                             (self.status, self.step, Jsonb(self.steps), "".join(l+"\n" for l in new), Jsonb(models) if models is not None else None,
+                              error, finished, self.id))
+
+    def finish(self, status: str, models: Optional[List[Dict[str,Any]]] = None, error: Optional[str] = None):
+        self.status=status; self.flush(finished=True, models=models, error=error)
+
+_dbt_runs: Dict[str,DbtRun] = {}
+_dbt_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dbt-run")
+
+def dbt_exec(cmd: str, proj: str, log) -> int:
+    """Executa um comando dbt mandando a saída, linha a linha, para log(); devolve o exit code do dbt."""
+    if not DBT_IN_PROCESS:
+        env = {"DBT_USE_COLORS": "false", **os.environ}  # log vai para o banco e para o dashboard: sem códigos ANSI
+        p = subprocess.Popen(shlex.split(cmd), cwd=proj, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, text=True)
+        for line in p.stdout: log(line)
+        return p.wait()
+    from dbt.cli.main import dbtRunner  # só com DBT_IN_PROCESS; o dbt já é dependência do build local
+    args = shlex.split(cmd)[1:] + ["--no-use-colors", "--project-dir", proj] + ([] if os.getenv("DBT_PROFILES_DIR") else ["--profiles-dir", proj])
+    res = dbtRunner(callbacks=[lambda ev: ev.info.level != "debug" and log(ev.info.msg)]).invoke(args)
+    if res.exception is not None: log(f"{type(res.exception).__name__}: {res.exception}")
+    return 0 if res.success else 1 if res.exception is None else 2  # mesmos códigos da CLI
+
+def dbt_model_timings(proj: str, since: float) -> Optional[List[Dict[str,Any]]]:
+    """Tempo e status por nó do target/run_results.json (só se escrito por esta build), mais lentos primeiro."""
+    path = os.path.join(proj, "target", "run_results.json")
+    if not os.path.exists(path) or os.path.getmtime(path) < since: return None
+    with open(path, encoding="utf-8") as f:
+        results = json.load(f).get("results") or []
+    out = [{"node": r["unique_id"], "status": r["status"], "seconds": round(r.get("execution_time") or 0, 3),
+            "rows": (r.get("adapter_response") or {}).get("rows_affected"), "message": r.get("message")} for r in results]
+    return sorted(out, key=lambda m: -m["seconds"])
+
+def _run_dbt(run: DbtRun, lock_conn):
+    proj = os.path.join(ROOT_DIR, "dbt_project")
+    try:
+        run.start()
+        # 1) Remover quaisquer arquivos legados com nome _placeholder.sql
+        removed = []
+        for dirpath, _, filenames in os.walk(os.path.join(proj, "models")):
+            for fn in filenames:
+                if fn == "_placeholder.sql":
+                    try:
+                        os.remove(os.path.join(dirpath, fn))
+                        removed.append(os.path.join(dirpath, fn))
+                    except Exception:
+                        pass
+        if removed:
+            run.log(f"Removidos placeholders legados: {removed}")
+        # 2) build (o parse já acontece dentro do build, com partial parsing entre execuções)
+        notes = []
+        cmds = dbt_commands(proj, run.params.get("select"), run.params.get("full_refresh"), run.params.get("clean"), notes)
+        for n in notes: run.log(n)
+        code = 0; build_at = None
+        for cmd in cmds:
+            run.step = cmd; run.log(f"$ {cmd}")
+            if cmd.startswith("dbt build"): build_at = time.time()
+            t0 = time.perf_counter(); code = None
+            try:
+                code = dbt_exec(cmd, proj, run.log)
+            finally:
+                dt = time.perf_counter() - t0; status = "ok" if code == 0 else "error"
+                DBT_COMMAND_SECONDS.labels(cmd.split()[1], status).observe(dt)
+                log_span("dbt", dt, command=cmd, status=status, exit_code=code, run=run.id)
+                run.steps.append({"cmd": cmd, "seconds": round(dt, 2), "exit_code": code})
+            if code != 0: break
+        models = dbt_model_timings(proj, build_at) if build_at else None
+        for m in models or []: DBT_MODEL_SECONDS.labels(m["node"], m["status"]).observe(m["seconds"])
+        if code == 0:
+            save_dbt_state(proj); run.step = None
+            if PARQUET_DIR: parquet_snapshot_step(run)
+            run.finish("done", models=models)
+        else:
+            run.finish("error", models=models, error=f"'{run.step}' terminou com código {code}")
+    except Exception as e:
+        run.log(f"Falha ao executar '{run.step}': {type(e).__name__}: {e}")
+        run.finish("error", error=f"{type(e).__name__}: {e}")
+    finally:
+        response_cache.invalidate()  # build parcial também pode ter trocado modelos
+        _dbt_runs.pop(run.id, None)
+        lock_conn.close()  # fim da sessão: libera o advisory lock
+
+def dbt_target_lock():
+    """Conexão própria com o advisory lock de sessão do target, para ficar presa até o fim da build
+    (se a API cair, o Postgres libera sozinho). 409 se outra build ou snapshot já o detém."""
+    if not DATABASE_URL:
+        raise HTTPException(status_code=500, detail="DATABASE_URL não configurado")
+    lock_conn = psycopg.connect(DATABASE_URL, autocommit=True, **DB_CONN_KWARGS)
+    try:
+        if not lock_conn.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS ok", (f"dbt:{DBT_TARGET_KEY}",)).fetchone()["ok"]:
+            with get_conn() as conn:
+                row = conn.execute(f"""SELECT id FROM {DBT_RUNS_TABLE} WHERE target=%s AND status IN ('queued','running')
+                                       ORDER BY created_at DESC LIMIT 1""", (DBT_TARGET_KEY,)).fetchone()
+            raise HTTPException(status_code=409, detail={"message": f"Já existe um dbt build em andamento para o target {DBT_TARGET_KEY}",
+                                                         "run_id": str(row["id"]) if row else None})
+    except BaseException:
+        lock_conn.close(); raise
+    return lock_conn
+
+def submit_dbt_run(params: Dict[str,Any]) -> DbtRun:
+    lock_conn = dbt_target_lock()
+    try:
+        run = DbtRun(str(uuid.uuid4()), params)
+        with get_conn() as conn:
+            conn.execute(f"INSERT INTO {DBT_RUNS_TABLE} (id, target, params, owner) VALUES (%s, %s, %s, %s)", (run.id, DBT_TARGET_KEY, Jsonb(params), JOB_OWNER))
+    except BaseException:
+        lock_conn.close(); raise
+    _dbt_runs[run.id] = run
+    run.future = _dbt_executor.submit(_run_dbt, run, lock_conn)
+    return run
+
+DBT_RUN_COLS = "id, target, params, status, step, steps, models, error, owner, created_at, started_at, heartbeat_at, finished_at"
+
+def _dbt_run_row(run_id: str, log: bool = True) -> Optional[Dict[str,Any]]:
+    with get_conn() as conn:
+        return conn.execute(f"SELECT {DBT_RUN_COLS}{', log' if log else ''} FROM {DBT_RUNS_TABLE} WHERE id=%s", (run_id,)).fetchone()
+
+def _dbt_run_status(row: Dict[str,Any], tail: int = 0) -> Dict[str,Any]:
+    out = {k: v for k, v in row.items() if k != "log"}
+    run = _dbt_runs.get(str(row["id"]))
+    if run: out.update(status=run.status, step=run.step, steps=run.steps)  # memória está à frente do banco
+    end = row.get("finished_at") or (datetime.datetime.now(datetime.timezone.utc) if row.get("started_at") else None)
+    out["elapsed_s"] = round((end-row["started_at"]).total_seconds(), 1) if row.get("started_at") else None
+    if tail > 0:
+        lines = run.lines if run else (row.get("log") or "").splitlines()
+        out["tail"] = "\n".join(lines[-tail:])
+    return out
 
-@app.post("/dbt/run")
-def dbt_run_local():
+@app.post("/dbt/run", status_code=202)
+def dbt_run_local(response: Response, select: Optional[str] = Body(None, embed=True), full_refresh: bool = Body(False, embed=True), clean: bool = Body(False, embed=True), wait: bool = Body(False, embed=True)):
     # Força local runner
     if DBT_RUNNER_URL and DBT_RUNNER_URL.strip().upper() != "LOCAL":
         raise HTTPException(status_code=404, detail={"message": "Runner externo não suportado nesta build. Defina DBT_RUNNER_URL=LOCAL."})
-    proj = os.path.join(ROOT_DIR, "dbt_project")
-    if not os.path.isdir(proj):
+    if not os.path.isdir(os.path.join(ROOT_DIR, "dbt_project")):
         raise HTTPException(status_code=500, detail="Diretório dbt_project não encontrado no deploy")
-    logs = []
-    # 1) Remover quaisquer arquivos legados com nome _placeholder.sql
-    removed = []
-    for dirpath, _, filenames in os.walk(os.path.join(proj, "models")):
-        for fn in filenames:
-            if fn == "_placeholder.sql":
-                try:
-                    os.remove(os.path.join(dirpath, fn))
-                    removed.append(os.path.join(dirpath, fn))
-                except Exception:
-                    pass
-    if removed:
-        logs.append(f"Removidos placeholders legados: {removed}")
-    # 2) dbt clean
-    for cmd in ["dbt clean", "dbt deps", "dbt parse", "dbt build --fail-fast"]:
-        logs.append(f"$ {cmd}")
-        try:
-            import subprocess, shlex
-            p = subprocess.Popen(shlex.split(cmd), cwd=proj, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=os.environ.copy(), text=True)
-            for line in p.stdout:
-                logs.append(line.rstrip())
-            code = p.wait()
-            if code != 0:
-                return {"ok": False, "step": cmd, "exit_code": code, "tail": "
-".join(logs[-400:])}
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Falha ao executar '{cmd}': {e}")
-    return {"ok": True, "tail": "
-".join(logs[-400:])}
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Falha ao executar '{cmd}': {e}")
-    return {"ok": True, "tail": "\n".join(logs[-400:])}
+    run = submit_dbt_run({"select": select, "full_refresh": full_refresh, "clean": clean})
+    if wait:  # comportamento antigo (scripts/CI): segura a thread até o fim e responde com o resultado
+        run.future.result(); response.status_code = 200
+        return get_dbt_run(uuid.UUID(run.id), tail=400)
+    return {"run_id": run.id, "status": "queued", "status_url": f"/dbt/runs/{run.id}", "logs_url": f"/dbt/runs/{run.id}/logs"}
+
+@app.get("/dbt/runs")
+def list_dbt_runs(limit: int = 20):
+    with get_conn() as conn:
+        rows = conn.execute(f"SELECT {DBT_RUN_COLS} FROM {DBT_RUNS_TABLE} ORDER BY created_at DESC LIMIT %s", (min(limit, 200),)).fetchall()
+    return [_dbt_run_status(r) for r in rows]
+
+@app.get("/dbt/runs/{run_id}")
+def get_dbt_run(run_id: uuid.UUID, tail: int = 200):
+    row = _dbt_run_row(str(run_id), log=tail > 0)
+    if not row: raise HTTPException(status_code=404, detail="Build dbt não encontrada")
+    return _dbt_run_status(row, tail)
+
+async def _dbt_log_events(run_id: str, offset: int):
+    idle = 0.0
+    while True:
+        run = _dbt_runs.get(run_id)
+        if run:  # status antes das linhas: se já era final, o log em memória está completo
+            status = run.status; lines = run.lines[offset:]
+        else:
+            row = await run_in_threadpool(_dbt_run_row, run_id)
+            status, lines = (row["status"], row["log"].splitlines()[offset:]) if row else ("error", [])
+        for line in lines:
+            offset += 1
+            yield f"id: {offset}\ndata: {line}\n\n"
+        if status in JOB_FINAL:
+            yield f"event: end\ndata: {json.dumps({'status': status})}\n\n"
+            return
+        wait = 0.5 if run else DBT_LOG_POLL_SECONDS
+        idle = 0.0 if lines else idle + wait
+        if idle >= 15:  # comentário SSE: mantém proxies e o cliente acordados em modelos longos
+            yield ": ping\n\n"; idle = 0.0
+        await asyncio.sleep(wait)
+
+@app.get("/dbt/runs/{run_id}/logs")
+async def stream_dbt_run_logs(run_id: uuid.UUID, request: Request, offset: int = 0):
+    """Log da build em Server-Sent Events: um evento por linha (id = nº da linha; reconecte com
+    Last-Event-ID para continuar de onde parou) e, no fim, um evento `end` com o status."""
+    if str(run_id) not in _dbt_runs and not await run_in_threadpool(_dbt_run_row, str(run_id), False):
+        raise HTTPException(status_code=404, detail="Build dbt não encontrada")
+    offset = int(request.headers.get("last-event-id") or offset)
+    return StreamingResponse(_dbt_log_events(str(run_id), offset), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ---------------- Parquet snapshot ----------------
+# Depois de cada build ok, fato e marts vão para Parquet em PARQUET_DIR e o dashboard os lê com DuckDB:
+# as agregações pesadas saem do Postgres, que fica para o COPY do ingest. Tabelas com data viram um
+# arquivo por mês (<tabela>/ano_mes=AAAA-MM/part-0.parquet); só os meses que mudaram são reescritos.
+PARQUET_DIR = os.getenv("PARQUET_DIR")  # vazio: sem snapshot
+PARQUET_TABLES = {  # tabela -> coluna de data que particiona por mês (None: arquivo único)
+    "fato_venda": "data", "mart_vendas_dia_cliente": "data", "mart_vendas_dia_categoria": "data", "mart_vendas_dia_sku": "data",
+    "mart_vendas_mes_cliente": None, "mart_vendas_mes_categoria": None, "mart_vendas_mes_sku": None,
+    "mart_kpis": None, "mart_rfm": None, "dim_cliente": None, "dim_produto": None,
+}
+PARQUET_MANIFEST = "_snapshot.json"  # assinatura (linhas, max(_loaded_at)) de cada partição exportada
+PARQUET_NO_DATE = "sem_data"
+
+class _CopyReader(io.RawIOBase):
+    """Saída de um COPY ... TO STDOUT como arquivo, para o leitor CSV do pyarrow consumir em streaming."""
+    def __init__(self, copy): self.it=iter(copy); self.buf=b""
+    def readable(self): return True
+    def empty(self) -> bool:
+        if not self.buf: self.buf=bytes(next(self.it, b""))
+        return not self.buf
+    def readinto(self, b):
+        if not self.buf and self.empty(): return 0
+        n=min(len(b), len(self.buf)); b[:n]=self.buf[:n]; self.buf=self.buf[n:]
+        return n
+
+def _parquet_type(pa, data_type: str):
+    # numeric vira float64: é leitura analítica (somas, médias); o valor exato continua no Postgres
+    return {"numeric": pa.float64(), "double precision": pa.float64(), "real": pa.float64(), "bigint": pa.int64(), "integer": pa.int64(),
+            "smallint": pa.int64(), "boolean": pa.bool_(), "date": pa.date32(), "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+            "timestamp without time zone": pa.timestamp("us")}.get(data_type, pa.string())
+
+def _parquet_expr(col: str, data_type: str) -> str:
+    if data_type in ("numeric", "real"): return f'"{col}"::float8'
+    if data_type in ("double precision", "bigint", "integer", "smallint", "boolean", "date", "text") or data_type.startswith("timestamp"): return f'"{col}"'
+    return f'"{col}"::text'
+
+def write_parquet(cur, table: str, cols: List[List[str]], where: str, params: tuple, path: str) -> int:
+    """COPY em CSV -> pyarrow em lotes -> Parquet (zstd) num .tmp, trocado de uma vez: leitores nunca veem arquivo pela metade."""
+    import pyarrow as pa, pyarrow.csv as pacsv, pyarrow.parquet as pq
+    schema = pa.schema([(c, _parquet_type(pa, t)) for c, t in cols])
+    # CSV do Postgres: NULL sai vazio sem aspas e a string vazia sai como ""
+    opts = pacsv.ConvertOptions(column_types=schema, strings_can_be_null=True, quoted_strings_can_be_null=False, null_values=[""],
+                                true_values=["t"], false_values=["f"])
+    sel = ", ".join(_parquet_expr(c, t) for c, t in cols)
+    tmp = path + ".tmp"; rows = 0
+    with cur.copy(f"COPY (SELECT {sel} FROM {table} {where}) TO STDOUT (FORMAT csv)", params) as cp, pq.ParquetWriter(tmp, schema, compression="zstd") as w:
+        src = _CopyReader(cp)
+        if not src.empty():
+            reader = pacsv.open_csv(io.BufferedReader(src, 1024*1024), read_options=pacsv.ReadOptions(column_names=schema.names), convert_options=opts)
+            for batch in reader:
+                w.write_batch(batch); rows += batch.num_rows
+    os.replace(tmp, path)
+    return rows
+
+def export_parquet_snapshot(log=print) -> Dict[str,Any]:
+    """Exporta PARQUET_TABLES para PARQUET_DIR num único instante do banco (REPEATABLE READ)."""
+    os.makedirs(PARQUET_DIR, exist_ok=True)
+    mpath = os.path.join(PARQUET_DIR, PARQUET_MANIFEST)
+    try:
+        with open(mpath, encoding="utf-8") as f: old = json.load(f).get("tables") or {}
+    except (OSError, ValueError):
+        old = {}
+    manifest = {}; out = {}
+    with psycopg.connect(DATABASE_URL, **DB_CONN_KWARGS) as conn:
+        conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        conn.execute("SET LOCAL TIME ZONE 'UTC'")  # timestamptz sai como ...+00, que o pyarrow lê direto
+        for table, part in PARQUET_TABLES.items():
+            cols = [[r["column_name"], r["data_type"]] for r in conn.execute(
+                """SELECT column_name, data_type FROM information_schema.columns WHERE table_schema=current_schema() AND table_name=%s
+                   ORDER BY ordinal_position""", (table,)).fetchall()]
+            if not cols:
+                log(f"parquet: {table} não existe; pulando"); continue
+            # sem _loaded_at (mart_kpis, mart_rfm) não há como saber se mudou: reescreve sempre (são pequenas)
+            loaded = any(c == "_loaded_at" for c, _ in cols)
+            key = f"coalesce(to_char(\"{part}\", 'YYYY-MM'), '{PARQUET_NO_DATE}')" if part else "'all'"
+            sigs = {r["k"]: [r["n"], r["m"]] for r in conn.execute(
+                f"SELECT {key} AS k, count(*) AS n, {'max(_loaded_at)::text' if loaded else 'NULL'} AS m FROM {table}{' GROUP BY 1' if part else ''}").fetchall()}
+            prev = old.get(table) or {}
+            keep = loaded and prev.get("columns") == cols
+            tdir = os.path.join(PARQUET_DIR, table); written = rows = 0
+            for k, sig in sigs.items():
+                pdir = os.path.join(tdir, f"ano_mes={k}") if part else tdir
+                path = os.path.join(pdir, "part-0.parquet")
+                if keep and (prev.get("partitions") or {}).get(k) == sig and os.path.exists(path): continue
+                if not part: where, params = "", ()
+                elif k == PARQUET_NO_DATE: where, params = f'WHERE "{part}" IS NULL', ()
+                else: where, params = f"WHERE \"{part}\" >= %s::date AND \"{part}\" < %s::date + interval '1 month' ORDER BY \"{part}\"", (f"{k}-01", f"{k}-01")
+                os.makedirs(pdir, exist_ok=True)
+                rows += write_parquet(conn.cursor(), table, cols, where, params, path); written += 1
+            for k in set(prev.get("partitions") or {}) - set(sigs):  # meses que sumiram do banco (replace_months, full)
+                shutil.rmtree(os.path.join(tdir, f"ano_mes={k}"), ignore_errors=True)
+            manifest[table] = {"columns": cols, "partitions": sigs}
+            out[table] = {"partitions": len(sigs), "written": written, "rows": rows}
+            log(f"parquet: {table}: {written}/{len(sigs)} arquivo(s) reescrito(s), {rows} linha(s)")
+    with open(mpath + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"exported_at": datetime.datetime.now(datetime.timezone.utc).isoformat(), "tables": manifest}, f)
+    os.replace(mpath + ".tmp", mpath)
+    return out
+
+def parquet_snapshot_step(run: DbtRun):
+    """Snapshot como último passo da build; se falhar, a build continua ok (o dashboard cai no Postgres)."""
+    run.step = "parquet snapshot"; run.log("$ parquet snapshot")
+    t0 = time.perf_counter(); code = 1
+    try:
+        export_parquet_snapshot(run.log); code = 0
+    except Exception as e:
+        run.log(f"Falha no snapshot Parquet: {type(e).__name__}: {e}")
+    finally:
+        dt = time.perf_counter() - t0
+        log_span("parquet", dt, status="ok" if code == 0 else "error", run=run.id)
+        run.steps.append({"cmd": "parquet snapshot", "seconds": round(dt, 2), "exit_code": code})
+        run.step = None
+
+@app.post("/snapshot/parquet")
+def snapshot_parquet():
+    """Para builds feitas fora da API (dbt CLI). Segura o mesmo lock do /dbt/run."""
+    if not PARQUET_DIR:
+        raise HTTPException(status_code=400, detail="PARQUET_DIR não configurado")
+    lock_conn = dbt_target_lock()
+    try:
+        t0 = time.perf_counter()
+        out = export_parquet_snapshot()
+        log_span("parquet", time.perf_counter() - t0, status="ok")
+        return {"parquet_dir": PARQUET_DIR, "tables": out}
+    finally:
+        lock_conn.close()
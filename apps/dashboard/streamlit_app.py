@@ -1,21 +1,65 @@
 
-import os, json, requests
+import os, json, time, hashlib, requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import streamlit as st
-import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
 st.set_page_config(page_title="Engajamento B2B", layout="wide")
 st.title("📊 Engajamento B2B – v6.1.1 (LOCAL dbt)")
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 DEFAULT_API = os.getenv("API_BASE_URL", "https://engajamento-api.onrender.com")
+DB_SEARCH_PATH = os.getenv("DB_SEARCH_PATH", '"SllupMarket",public')
+PARQUET_DIR = os.getenv("PARQUET_DIR")  # snapshot Parquet que a API grava após cada /dbt/run (mesmo disco/volume)
+ANALYTICS_ENGINE = os.getenv("ANALYTICS_ENGINE", "auto")  # auto: DuckDB sobre o snapshot quando houver | postgres
+
+try:
+    import duckdb
+except ImportError:  # opcional: sem duckdb as leituras vão todas ao Postgres
+    duckdb = None
+
+@st.cache_resource
+def get_pool():
+    # Um pool por processo do Streamlit, compartilhado entre sessões e reruns
+    return ConnectionPool(
+        DATABASE_URL,
+        min_size=int(os.getenv("DB_POOL_MIN", "1")),
+        max_size=int(os.getenv("DB_POOL_MAX", "5")),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        kwargs={"row_factory": dict_row, "connect_timeout": 10, "options": "-c search_path=" + DB_SEARCH_PATH.replace(" ", "\\ ")},
+        check=ConnectionPool.check_connection,
+        name="dashboard",
+        open=True,
+    )
+
+def parquet_snapshot():
+    """Manifesto do último snapshot Parquet, ou None se as leituras devem ir ao Postgres."""
+    if ANALYTICS_ENGINE != "auto" or duckdb is None or not PARQUET_DIR:
+        return None
+    try:
+        with open(os.path.join(PARQUET_DIR, "_snapshot.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def duckdb_query(snap, sql, params=None):
+    # Conexão em memória por consulta: nada compartilhado entre sessões; as views só leem o rodapé dos arquivos
+    con = duckdb.connect()
+    try:
+        for t in snap["tables"]:
+            path = os.path.join(PARQUET_DIR, t).replace("'", "''")
+            con.execute(f"CREATE VIEW {t} AS SELECT * FROM read_parquet('{path}/**/*.parquet')")
+        return con.execute(sql.replace("%s", "?"), list(params or ())).fetchdf(date_as_object=True)
+    finally:
+        con.close()
 
 def check_db():
+    if not DATABASE_URL:
+        return False, "DATABASE_URL não configurado"
     try:
-        with psycopg.connect(DATABASE_URL, row_factory=dict_row, connect_timeout=10) as conn:
-            with conn.cursor() as cur0:
-                cur0.execute('SET search_path TO "SllupMarket", public;')
+        with get_pool().connection(timeout=10) as conn:
             with conn.cursor() as cur:
                 cur.execute("select 1")
                 cur.fetchall()
@@ -47,6 +91,8 @@ else:
     c2.caption(str(info_api))
 
 c3.write("Use as abas abaixo para ingestão, exploração e DBT.")
+snap = parquet_snapshot()
+c3.caption(f"Leituras analíticas: DuckDB sobre o snapshot Parquet de {snap['exported_at'][:19]} UTC" if snap else "Leituras analíticas: Postgres")
 
 st.divider()
 
@@ -56,9 +102,13 @@ if not DATABASE_URL:
 
 @st.cache_data(ttl=300)
 def run_query(sql, params=None):
-    with psycopg.connect(DATABASE_URL, row_factory=dict_row) as conn:
-        with conn.cursor() as cur0:
-            cur0.execute('SET search_path TO "SllupMarket", public;')
+    snap = parquet_snapshot()
+    if snap:
+        try:
+            return duckdb_query(snap, sql, params)
+        except Exception as e:  # tabela fora do snapshot, arquivo trocado no meio da leitura...
+            print(f"[duckdb] consulta voltou para o Postgres: {e}", flush=True)
+    with get_pool().connection() as conn:
         with conn.cursor() as cur:
             cur.execute(sql, params or ())
             rows = cur.fetchall()
@@ -70,57 +120,129 @@ tab1, tab2, tab3, tab4, tab5, tab6 = tabs
 with tab1:
     st.subheader("Indicadores")
     try:
-        df_counts = run_query("""
-            select 
-              (select count(*) from dim_cliente) as clientes,
-              (select count(*) from dim_produto) as skus,
-              (select count(*) from fato_venda)  as vendas
-        """);
-        c1, c2, c3 = st.columns(3)
-        c1.metric("Clientes", int(df_counts.iloc[0]["clientes"]))
-        c2.metric("SKUs", int(df_counts.iloc[0]["skus"]))
-        c3.metric("Registros de Venda", int(df_counts.iloc[0]["vendas"]))
+        # Só rollups (mart_kpis, mart_vendas_mes_*): o custo não cresce com o fato_venda
+        df_kpi = run_query("select * from mart_kpis")
+        k = df_kpi.iloc[0]
+        c1, c2, c3, c4, c5 = st.columns(5)
+        c1.metric("Clientes", int(k["clientes"]))
+        c2.metric("SKUs", int(k["skus"]))
+        c3.metric("Registros de Venda", int(k["linhas"] or 0))
+        c4.metric("Faturamento", f"{float(k['total_venda'] or 0):,.2f}")
+        c5.metric("Margem", f"{float(k['margem_pct'] or 0):.1%}")
+        st.caption(f"Vendas de {k['primeira_venda']} a {k['ultima_venda']} | últimos 30 dias: {float(k['total_venda_30d'] or 0):,.2f} "
+                   f"em {int(k['pedidos_30d'] or 0)} pedidos | atualizado em {k['atualizado_em']}")
+        df_mes = run_query("""
+            select mes, sum(total_venda) as total_venda, sum(margem) as margem
+            from mart_vendas_mes_categoria
+            group by mes
+            order by mes
+        """)
+        st.bar_chart(df_mes.set_index("mes")[["total_venda", "margem"]].astype(float))
+        df_fam = run_query("""
+            select familia, sum(total_venda) as total_venda, sum(margem) as margem, sum(margem) / nullif(sum(total_venda), 0) as margem_pct
+            from mart_vendas_mes_categoria
+            where mes >= (select max(mes) from mart_vendas_mes_categoria) - interval '11 months'
+            group by familia
+            order by total_venda desc nulls last
+            limit 15
+        """)
+        st.caption("Famílias – últimos 12 meses")
+        st.dataframe(df_fam, use_container_width=True)
     except Exception as e:
-        st.warning("Não foi possível ler os indicadores. Verifique se as tabelas existem no schema SllupMarket.")
+        st.warning("Não foi possível ler os indicadores. Rode o dbt build (mart_kpis e rollups mart_vendas_*) no schema SllupMarket.")
         st.exception(e)
 
 with tab2:
     st.subheader("Ranking RFM (Top 200)")
     try:
         df_rfm = run_query("""
-            select cod_cliente, ultima_compra::date, freq, valor, r_score, f_score, m_score, 
-                   (r_score + f_score + m_score) as rfm_score
+            select cod_cliente, ultima_compra, recencia_dias, freq, valor, r_score, f_score, m_score, rfm_score
             from mart_rfm
-            order by rfm_score desc
+            order by rfm_score desc, cod_cliente
             limit 200
         """);
         st.dataframe(df_rfm, use_container_width=True)
         cod = st.text_input("Buscar cliente (cod_cliente)", key="rfm_busca_cod")
         if cod:
             df_v = run_query("""
-                with rfm as (select * from mart_rfm where cod_cliente = %s)
-                select c.cod_cliente, c.razao_social, rfm.*
+                select c.cod_cliente, c.razao_social, r.ultima_compra, r.recencia_dias, r.freq, r.valor,
+                       r.r_score, r.f_score, r.m_score, r.rfm_score, r.data_referencia
                 from dim_cliente c
-                left join rfm on rfm.cod_cliente = c.cod_cliente
+                left join mart_rfm r on r.cod_cliente = c.cod_cliente
                 where c.cod_cliente = %s
-            """, (cod, cod));
+            """, (cod,));
             st.dataframe(df_v, use_container_width=True)
     except Exception as e:
         st.warning("⚠️ Não encontrei `mart_rfm`. Rode o dbt build no mesmo banco do dashboard.")
         st.exception(e)
 
+# Explorar Vendas lê os rollups diários/mensais (tabela e colunas vêm daqui, nunca do usuário)
+ROLLUP_VIEWS = {
+    "Cliente": ("cliente", "cod_cliente"),
+    "Família / Sub-família / Marca": ("categoria", "familia, sub_familia, marca"),
+    "SKU": ("sku", "sku, produto"),
+}
+
 with tab3:
-    st.subheader("Vendas recentes")
+    st.subheader("Explorar vendas")
+    ate = pd.Timestamp.today().date()
     try:
-        df_vendas = run_query("""
-            select data, cod_cliente, sku, tam, qtde, total_venda, total_custo, margem, documento_fiscal
-            from fato_venda
-            order by data desc
+        c1, c2, c3 = st.columns([2, 1, 2])
+        visao = c1.selectbox("Agrupar por", list(ROLLUP_VIEWS), key="exp_visao")
+        grao = c2.radio("Granularidade", ["Dia", "Mês"], horizontal=True, key="exp_grao")
+        periodo = c3.date_input("Período", (ate - pd.Timedelta(days=90), ate), key="exp_periodo")
+        ini, fim = (periodo if isinstance(periodo, (tuple, list)) and len(periodo) == 2 else (periodo, periodo))
+        sufixo, cols = ROLLUP_VIEWS[visao]
+        tempo, tabela = ("data", f"mart_vendas_dia_{sufixo}") if grao == "Dia" else ("mes", f"mart_vendas_mes_{sufixo}")
+        df_vendas = run_query(f"""
+            select {tempo}, {cols}, pedidos, qtde, total_venda, total_custo, margem,
+                   margem / nullif(total_venda, 0) as margem_pct
+            from {tabela}
+            where {tempo} between date_trunc('{'day' if grao == 'Dia' else 'month'}', %s::date) and %s
+            order by {tempo} desc, total_venda desc nulls last
             limit 500
-        """);
+        """, (ini, fim))
         st.dataframe(df_vendas, use_container_width=True)
     except Exception as e:
-        st.warning("Não foi possível carregar as vendas recentes. Verifique se `fato_venda` existe.")
+        st.warning("Não foi possível carregar as vendas. Verifique se os rollups `mart_vendas_*` existem (dbt build).")
+        st.exception(e)
+
+    st.subheader("Itens de venda")
+    # Página a página pela API (GET /vendas, keyset): a sessão guarda só a página atual e a pilha de cursores
+    with st.form("vendas_filtros"):
+        f1, f2, f3, f4, f5, f6 = st.columns([2, 1, 1, 1, 1, 1])
+        v_periodo = f1.date_input("Período", (ate - pd.Timedelta(days=90), ate), key="vendas_periodo")
+        v_cliente = f2.text_input("cod_cliente", key="vendas_cliente")
+        v_sku = f3.text_input("sku", key="vendas_sku")
+        v_familia = f4.text_input("familia", key="vendas_familia")
+        v_marca = f5.text_input("marca", key="vendas_marca")
+        v_limit = f6.selectbox("Por página", [50, 100, 250, 500], index=1, key="vendas_limit")
+        aplicar = st.form_submit_button("Aplicar filtros")
+    v_ini, v_fim = (v_periodo if isinstance(v_periodo, (tuple, list)) and len(v_periodo) == 2 else (v_periodo, v_periodo))
+    filtros = {"data_ini": str(v_ini), "data_fim": str(v_fim), "cod_cliente": v_cliente.strip(), "sku": v_sku.strip(),
+               "familia": v_familia.strip(), "marca": v_marca.strip(), "limit": v_limit}
+    filtros = {k: v for k, v in filtros.items() if v}
+    if aplicar or st.session_state.get("vendas_filtros_ativos") != filtros:
+        st.session_state["vendas_filtros_ativos"] = filtros
+        st.session_state["vendas_cursores"] = [None]  # cursor de cada página visitada; o topo é a atual
+    cursores = st.session_state.setdefault("vendas_cursores", [None])
+    vendas_url = api_base.rstrip("/") + "/vendas"
+    try:
+        r = requests.get(vendas_url, params={**filtros, **({"cursor": cursores[-1]} if cursores[-1] else {})}, timeout=60)
+        r.raise_for_status()
+        page = r.json()
+        st.dataframe(pd.DataFrame(page["items"]), use_container_width=True)
+        b1, b2, b3, b4 = st.columns([1, 1, 2, 3])
+        b3.caption(f"Página {len(cursores)} · {page['count']} itens")
+        if b1.button("◀ Anterior", disabled=len(cursores) == 1, key="vendas_prev"):
+            cursores.pop(); st.rerun()
+        if b2.button("Próxima ▶", disabled=not page["has_more"], key="vendas_next") and page["next_cursor"]:
+            cursores.append(page["next_cursor"]); st.rerun()
+        export = {k: v for k, v in filtros.items() if k != "limit"}
+        b4.markdown(f"Exportar com estes filtros: [CSV]({requests.Request('GET', vendas_url, params={**export, 'format': 'csv'}).prepare().url}) · "
+                    f"[NDJSON]({requests.Request('GET', vendas_url, params={**export, 'format': 'ndjson'}).prepare().url})")
+    except Exception as e:
+        st.warning("Não foi possível consultar GET /vendas na API.")
         st.exception(e)
 
 def parse_header_map_json(txt):
@@ -133,13 +255,215 @@ def parse_header_map_json(txt):
         st.error(f"JSON inválido: {e}")
     return None
 
+JOB_POLL_SECONDS = 2
+LOAD_MODES = {
+    "Full replace (TRUNCATE/DELETE + INSERT)": "full",
+    "Append": "append",
+    "Merge (upsert por documento_fiscal, sku, cod_cliente, data)": "merge",
+    "Substituir os dias presentes no arquivo": "replace_dates",
+    "Substituir os meses presentes no arquivo (partições)": "replace_months",
+}
+COPY_BINARY_LABEL = "COPY binário (registros com data/número inválido vão para a tabela de rejeitados em vez de abortar)"
+DATE_FORMAT_OPTIONS = {"Do perfil (ou YYYY-MM-DD)": None, "YYYY-MM-DD": "YYYY-MM-DD", "DD/MM/YYYY": "DD/MM/YYYY"}
+PROFILE_AUTO = "(automático pelo cabeçalho)"
+
+@st.cache_data(ttl=30)
+def list_profiles(api_base):
+    try:
+        r = requests.get(api_base.rstrip("/") + "/ingest/profiles", timeout=10)
+        return [p["id"] for p in r.json()] if r.status_code == 200 else []
+    except requests.RequestException:
+        return []
+
+def profile_select(api_base, key):
+    """Perfil de origem (GET /ingest/profiles); no automático a API procura o perfil pelo cabeçalho do arquivo."""
+    p = st.selectbox("Perfil de origem", [PROFILE_AUTO] + list_profiles(api_base), key=key,
+                     help="Com perfil a API não roda o Sniffer e usa o separador, encoding, header_map, data e decimal salvos")
+    return None if p == PROFILE_AUTO else p
+
+def fill_header_template(api_base, key):
+    """on_click: preenche o header_map com o header_template.json servido pela API."""
+    try:
+        st.session_state[key] = json.dumps(requests.get(api_base.rstrip("/") + "/ingest/header_template", timeout=10).json(), ensure_ascii=False, indent=1)
+    except Exception as e:
+        st.session_state[key + "_erro"] = str(e)
+
+def show_ingest_result(data, via=""):
+    st.success(f"Ingest concluído ✅ Linhas ~{data.get('rows')} | Dialect: {data.get('dialect')} | Staging: {data.get('staging_table')}{via}")
+    stats = [f"{k}: {data[k]}" for k in ("inserted", "updated", "unchanged", "deleted", "duplicates_in_file", "null_key", "null_date", "months", "new_partitions", "copy_format") if data.get(k) not in (None, [])]
+    if stats:
+        st.caption(" | ".join(stats))
+    if data.get("profile_learned"):
+        st.info(f"Novo layout de arquivo: perfil {data['profile_learned']} criado; os próximos imports com este cabeçalho pulam a detecção")
+    elif data.get("profile"):
+        st.caption(f"Perfil de origem: {data['profile']} | data: {data.get('date_format')} | decimal: {data.get('decimal_sep')}")
+    if data.get("rejected"):
+        st.warning(f"{data['rejected']} registro(s) inválido(s) ficaram fora da carga: GET /ingest/rejects?load_id={data.get('load_id')}")
+    with st.expander("Preview (até 5 linhas)", expanded=False):
+        st.code("\n".join([",".join(data.get("preview_header", []))] + [",".join(r) for r in data.get("preview_rows", [])]), language="csv")
+
+UPLOAD_PARALLEL = int(os.getenv("UPLOAD_PARALLEL", "4"))  # partes enviadas ao mesmo tempo
+UPLOAD_PART_RETRIES = 3
+
+def part_retryable(r) -> bool:
+    """5xx ou parte corrompida no caminho (SHA-256 não confere). Os demais 4xx (parte fora do intervalo,
+    tamanho errado, upload expirado ou encerrado) não mudam reenviando."""
+    return r.status_code >= 500 or (r.status_code == 400 and "não confere" in r.text)
+
+def send_part(base, upload_id, n, chunk):
+    """PUT de uma parte com o SHA-256; tenta de novo em erro de rede, 5xx e checksum (reenviar é seguro)."""
+    digest = hashlib.sha256(chunk).hexdigest()
+    for tentativa in range(UPLOAD_PART_RETRIES):
+        try:
+            r = requests.put(f"{base}/ingest/uploads/{upload_id}/parts/{n}", data=chunk, headers={"X-Part-SHA256": digest}, timeout=300)
+        except requests.RequestException:
+            r = None
+        if r is not None:
+            if r.status_code == 200:
+                return n
+            if not part_retryable(r):
+                raise RuntimeError(f"parte {n}: API respondeu {r.status_code}: {r.text}")
+        time.sleep(2 ** tentativa)
+    raise RuntimeError(f"parte {n} falhou {UPLOAD_PART_RETRIES} vezes")
+
+def upload_in_parts(api_base, uploaded, opts, early):
+    """Envia o arquivo pelo protocolo de partes (/ingest/uploads) e devolve o job_id; None se a API não tiver o protocolo.
+    A sessão fica em session_state: clicar de novo depois de uma falha retoma só as partes que faltam."""
+    base = api_base.rstrip("/")
+    ident = (uploaded.name, uploaded.size)
+    sess = st.session_state.get("upload_parts")
+    status = None
+    if sess and sess["ident"] == ident:
+        r = requests.get(f"{base}/ingest/uploads/{sess['upload_id']}", timeout=30)
+        status = r.json() if r.status_code == 200 else None
+    if status is None:
+        r = requests.post(f"{base}/ingest/uploads", json={"filename": uploaded.name, "size": uploaded.size, "early": early, **opts}, timeout=60)
+        if r.status_code in (404, 405):
+            return None
+        if r.status_code != 201:
+            raise RuntimeError(f"API respondeu {r.status_code}: {r.text}")
+        status = r.json()
+        st.session_state["upload_parts"] = {"ident": ident, "upload_id": status["upload_id"]}
+    upload_id, part_size, missing = status["upload_id"], status["part_size"], status["missing"]
+    if status.get("job_id"):
+        st.session_state["job_upload"] = status["job_id"]  # early: o job já está lendo as partes
+    buf = uploaded.getbuffer()
+    bar = st.progress(0.0, text=f"Enviando {len(missing)} de {status['parts']} parte(s)")
+    done = status["parts"] - len(missing)
+    with ThreadPoolExecutor(UPLOAD_PARALLEL) as ex:
+        futs = [ex.submit(send_part, base, upload_id, n, bytes(buf[(n - 1) * part_size:n * part_size])) for n in missing]
+        for f in as_completed(futs):
+            f.result()
+            done += 1
+            bar.progress(done / status["parts"], text=f"{done}/{status['parts']} parte(s)")
+    r = requests.post(f"{base}/ingest/uploads/{upload_id}/complete", timeout=60)
+    if r.status_code != 202:
+        raise RuntimeError(f"API respondeu {r.status_code}: {r.text}")
+    st.session_state.pop("upload_parts", None)
+    return r.json()["job_id"]
+
+def follow_job(api_base, state_key):
+    """Acompanha o job guardado em session_state[state_key] até terminar (sobrevive a reruns)."""
+    job_id = st.session_state.get(state_key)
+    if not job_id:
+        return
+    base = api_base.rstrip("/")
+    if st.button("Cancelar importação", key=f"{state_key}_cancel"):
+        requests.post(f"{base}/ingest/jobs/{job_id}/cancel", timeout=30)
+    st.caption(f"Job {job_id}")
+    bar = st.progress(0.0)
+    status_slot = st.empty()
+    while True:
+        try:
+            r = requests.get(f"{base}/ingest/jobs/{job_id}", timeout=30)
+        except requests.RequestException as e:
+            status_slot.warning(f"Sem resposta da API ({e}); tentando de novo…")
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        if r.status_code != 200:
+            st.error(f"API respondeu {r.status_code}: {r.text}")
+            break
+        j = r.json()
+        if j.get("progress") is not None:
+            bar.progress(float(j["progress"]))
+        status_slot.info(
+            f"Status: {j['status']} | Fase: {j.get('phase')} | Linhas: {j.get('rows_processed', 0):,} | "
+            f"Lidos: {j.get('bytes_read', 0)/1e6:,.1f} MB | {j.get('rows_per_s') or 0:,.0f} linhas/s | {j.get('elapsed_s') or 0:,.0f}s"
+        )
+        if j["status"] == "done":
+            bar.progress(1.0)
+            show_ingest_result(j.get("result") or {})
+            break
+        if j["status"] == "cancelled":
+            st.warning("Importação cancelada; nada foi gravado no staging.")
+            break
+        if j["status"] == "error":
+            st.error(f"Falha no ingest: {j.get('error')}")
+            break
+        time.sleep(JOB_POLL_SECONDS)
+    st.session_state.pop(state_key, None)
+
+def follow_dbt_run(api_base, state_key):
+    """Mostra o log da build em session_state[state_key] pelo stream SSE da API e, no fim, os tempos por modelo."""
+    run_id = st.session_state.get(state_key)
+    if not run_id:
+        return
+    base = api_base.rstrip("/")
+    st.caption(f"Build {run_id}")
+    status_slot = st.empty()
+    log_slot = st.empty()
+    lines, ended, shown = [], False, 0.0
+    while not ended:
+        try:
+            # Last-Event-ID: se a conexão cair, o stream recomeça da linha seguinte
+            with requests.get(f"{base}/dbt/runs/{run_id}/logs", headers={"Last-Event-ID": str(len(lines))}, stream=True, timeout=(10, 60)) as r:
+                if r.status_code != 200:
+                    st.error(f"API respondeu {r.status_code}: {r.text}")
+                    break
+                event = None
+                for raw in r.iter_lines(decode_unicode=True):
+                    if raw.startswith("event:"):
+                        event = raw[6:].strip()
+                    elif raw.startswith("data:"):
+                        if event == "end":
+                            ended = True
+                            break
+                        lines.append(raw[6:])
+                    if time.monotonic() - shown >= 0.5:
+                        log_slot.code("\n".join(lines[-200:]) or "…")
+                        shown = time.monotonic()
+        except requests.RequestException as e:
+            status_slot.warning(f"Sem resposta da API ({e}); tentando de novo…")
+            time.sleep(JOB_POLL_SECONDS)
+    log_slot.code("\n".join(lines[-200:]))
+    st.session_state.pop(state_key, None)
+    if not ended:
+        return
+    r = requests.get(f"{base}/dbt/runs/{run_id}", params={"tail": 0}, timeout=30)
+    if r.status_code != 200:
+        st.error(f"API respondeu {r.status_code}: {r.text}")
+        return
+    j = r.json()
+    if j["status"] == "done":
+        status_slot.success(f"dbt build concluído ✅ em {j.get('elapsed_s') or 0:,.0f}s")
+    else:
+        status_slot.error(f"dbt build falhou: {j.get('error')}")
+    st.caption(" | ".join(f"{s['cmd']}: {s['seconds']}s" for s in j.get("steps") or []))
+    if j.get("models"):
+        st.dataframe(pd.DataFrame(j["models"]), use_container_width=True, hide_index=True)
+
 with tab4:
     st.subheader("Importar por URL (CSV/CSV.GZ) – recomendado p/ arquivos grandes")
     api_base_url = st.text_input("Base URL da API", value=DEFAULT_API, key="api_base_url_url")
     csv_url = st.text_input("URL do arquivo (csv ou csv.gz)", key="csv_url_field")
+    profile = profile_select(api_base_url, "profile_url")
     header_map_txt = st.text_area("header_map (JSON opcional)", height=100, key="header_map_url")
-    mode = st.radio("Modo de carga", ["Full replace (TRUNCATE/DELETE + INSERT)", "Append"], index=0, key="modo_url")
-    date_fmt = st.selectbox("Formato da data (coluna 'data')", ["YYYY-MM-DD", "DD/MM/YYYY"], index=0, key="datefmt_url")
+    st.button("Usar header_template.json", key="tpl_url", on_click=fill_header_template, args=(api_base_url, "header_map_url"))
+    if st.session_state.get("header_map_url_erro"):
+        st.error(f"Falha ao buscar o template: {st.session_state.pop('header_map_url_erro')}")
+    mode = st.radio("Modo de carga", list(LOAD_MODES), index=0, key="modo_url")
+    date_fmt = st.selectbox("Formato da data (coluna 'data')", list(DATE_FORMAT_OPTIONS), index=0, key="datefmt_url")
+    binario = st.checkbox(COPY_BINARY_LABEL, key="binario_url")
 
     if st.button("Importar do URL", key="btn_import_url"):
         hm = parse_header_map_json(header_map_txt)
@@ -147,53 +471,74 @@ with tab4:
             st.error("Preencha a API Base URL e a URL do arquivo.")
         else:
             try:
-                payload = {"url": csv_url, "mode": "full" if mode.startswith("Full") else "append", "date_format": date_fmt, "header_map": hm}
-                resp = requests.post(api_base_url.rstrip("/") + "/ingest/url", json=payload, timeout=900)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    st.success(f"Ingest concluído ✅ Linhas ~{data.get('rows')} | Dialect: {data.get('dialect')} | Staging: {data.get('staging_table')}")
-                    with st.expander("Preview (até 5 linhas)", expanded=False):
-                        st.code("\n".join([",".join(data.get("preview_header", []))] + [",".join(r) for r in data.get("preview_rows", [])]), language="csv")
+                payload = {"url": csv_url, "mode": LOAD_MODES[mode], "date_format": DATE_FORMAT_OPTIONS[date_fmt], "header_map": hm,
+                           "copy_format": "binary" if binario else None, "profile": profile}
+                resp = requests.post(api_base_url.rstrip("/") + "/ingest/jobs/url", json=payload, timeout=60)
+                if resp.status_code == 202:
+                    st.session_state["job_url"] = resp.json()["job_id"]
                 else:
                     st.error(f"API respondeu {resp.status_code}: {resp.text}")
             except Exception as e:
                 st.exception(e)
+    follow_job(api_base_url, "job_url")
 
 with tab5:
-    st.subheader("Upload de CSV (até 64MB) – para arquivos pequenos")
+    st.subheader("Upload de CSV – em partes, retomável")
+    st.caption("O arquivo vai em partes paralelas com checksum; se a conexão cair, clique de novo para enviar só o que falta. "
+               "Acima do limite de upload do Streamlit (server.maxUploadSize), use scripts/upload_chunked.py.")
     api_base_up = st.text_input("Base URL da API", value=DEFAULT_API, key="api_base_url_upload")
     uploaded = st.file_uploader("Escolha um arquivo .csv ou .csv.gz", type=["csv", "gz"], key="uploader_csv")
+    profile_up = profile_select(api_base_up, "profile_upload")
     header_map_up = st.text_area("header_map (JSON opcional)", height=100, key="header_map_upload")
-    mode_up = st.radio("Modo de carga (upload)", ["Full replace (TRUNCATE/DELETE + INSERT)", "Append"], index=0, key="modo_upload")
-    date_fmt_up = st.selectbox("Formato da data (upload)", ["YYYY-MM-DD", "DD/MM/YYYY"], index=0, key="datefmt_upload")
+    st.button("Usar header_template.json", key="tpl_upload", on_click=fill_header_template, args=(api_base_up, "header_map_upload"))
+    if st.session_state.get("header_map_upload_erro"):
+        st.error(f"Falha ao buscar o template: {st.session_state.pop('header_map_upload_erro')}")
+    mode_up = st.radio("Modo de carga (upload)", list(LOAD_MODES), index=0, key="modo_upload")
+    date_fmt_up = st.selectbox("Formato da data (upload)", list(DATE_FORMAT_OPTIONS), index=0, key="datefmt_upload")
+    binario_up = st.checkbox(COPY_BINARY_LABEL, key="binario_upload")
+    early_up = st.checkbox("Começar a importar enquanto as partes chegam", value=False, key="early_upload",
+                           help="Não vale no modo full; cada upload assim ocupa um job de ingest durante todo o envio")
 
     if st.button("Enviar upload", key="btn_upload"):
         if not api_base_up or not uploaded:
             st.error("Informe a API Base URL e selecione um arquivo.")
         else:
             try:
-                files = {"file": (uploaded.name, uploaded, "application/octet-stream")}
-                data = {"mode": "full" if mode_up.startswith("Full") else "append", "date_format": date_fmt_up}
                 hm = parse_header_map_json(header_map_up)
-                if hm is not None:
-                    data["header_map_json"] = json.dumps(hm, ensure_ascii=False)
-                for p in ["/ingest/upload", "/upload", "/ingest/file", "/api/ingest/upload"]:
-                    resp = requests.post(api_base_up.rstrip("/") + p, files=files, data=data, timeout=900)
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        st.success(f"Ingest concluído ✅ Linhas ~{data.get('rows')} | Dialect: {data.get('dialect')} | Staging: {data.get('staging_table')} (via {p})")
-                        with st.expander("Preview (até 5 linhas)", expanded=False):
-                            st.code("\n".join([",".join(data.get("preview_header", []))] + [",".join(r) for r in data.get("preview_rows", [])]), language="csv")
-                        break
+                opts = {"mode": LOAD_MODES[mode_up], "date_format": DATE_FORMAT_OPTIONS[date_fmt_up], "header_map": hm,
+                        "copy_format": "binary" if binario_up else None, "profile": profile_up}
+                job_id = upload_in_parts(api_base_up, uploaded, opts, early_up)
+                if job_id:
+                    st.session_state["job_upload"] = job_id
                 else:
-                    st.error("Nenhuma rota de upload funcionou (404). Verifique a API.")
+                    # API antiga, sem upload em partes: multipart inteiro (job, senão síncrono)
+                    files = {"file": (uploaded.name, uploaded, "application/octet-stream")}
+                    data = {k: v for k, v in opts.items() if v is not None and k != "header_map"}
+                    if hm is not None:
+                        data["header_map_json"] = json.dumps(hm, ensure_ascii=False)
+                    uploaded.seek(0)
+                    resp = requests.post(api_base_up.rstrip("/") + "/ingest/jobs/upload", files=files, data=data, timeout=900)
+                    if resp.status_code == 404:
+                        uploaded.seek(0)
+                        resp = requests.post(api_base_up.rstrip("/") + "/ingest/upload", files=files, data=data, timeout=900)
+                        if resp.status_code == 200:
+                            show_ingest_result(resp.json())
+                    if resp.status_code == 202:
+                        st.session_state["job_upload"] = resp.json()["job_id"]
+                    elif resp.status_code not in (200, 202):
+                        st.error(f"API respondeu {resp.status_code}: {resp.text}")
             except Exception as e:
-                st.exception(e)
+                st.error(f"Upload interrompido: {e}. Clique em Enviar de novo para retomar.")
+    follow_job(api_base_up, "job_upload")
 
 with tab6:
     st.subheader("DBT – Build local via API")
-    st.caption("A API executa 'dbt deps' e 'dbt build --fail-fast' dentro do diretório dbt_project.")
+    st.caption("A API executa 'dbt build --fail-fast' em background dentro do diretório dbt_project (fato e dimensões são incrementais); uma build por vez por target.")
     api_base_dbt = st.text_input("Base URL da API", value=DEFAULT_API, key="api_base_url_dbt")
+    dbt_select = st.text_input("Seleção (--select, opcional)", placeholder="state:modified+  ou  fato_venda+", key="dbt_select")
+    colC, colD = st.columns([1,1])
+    dbt_full_refresh = colC.checkbox("--full-refresh (reconstrói incrementais do zero)", key="dbt_full_refresh")
+    dbt_clean = colD.checkbox("dbt clean antes", key="dbt_clean")
     colA, colB = st.columns([1,1])
     if colA.button("Ver /health da API", key="btn_health_api"):
         try:
@@ -206,8 +551,25 @@ with tab6:
             st.error("Preencha a API Base URL")
         else:
             try:
-                r = requests.post(api_base_dbt.rstrip("/") + "/dbt/run", timeout=1800)
-                st.write(f"Status: {r.status_code}")
-                st.code(r.text[:4000], language="json")
+                payload = {"select": dbt_select or None, "full_refresh": dbt_full_refresh, "clean": dbt_clean}
+                r = requests.post(api_base_dbt.rstrip("/") + "/dbt/run", json=payload, timeout=30)
+                if r.status_code == 202:
+                    st.session_state["dbt_run"] = r.json()["run_id"]
+                elif r.status_code == 409:
+                    st.warning("Já há um dbt build rodando neste target; acompanhando essa build.")
+                    st.session_state["dbt_run"] = r.json()["detail"].get("run_id")
+                else:
+                    st.error(f"API respondeu {r.status_code}: {r.text}")
+            except Exception as e:
+                st.exception(e)
+    follow_dbt_run(api_base_dbt, "dbt_run")
+    with st.expander("Histórico de builds", expanded=False):
+        if st.button("Carregar histórico", key="btn_dbt_runs"):
+            try:
+                r = requests.get(api_base_dbt.rstrip("/") + "/dbt/runs", params={"limit": 20}, timeout=30)
+                r.raise_for_status()
+                runs = pd.DataFrame([{"início": x["created_at"], "status": x["status"], "segundos": x["elapsed_s"],
+                                      "select": (x.get("params") or {}).get("select"), "erro": x.get("error"), "run_id": x["id"]} for x in r.json()])
+                st.dataframe(runs, use_container_width=True, hide_index=True)
             except Exception as e:
                 st.exception(e)
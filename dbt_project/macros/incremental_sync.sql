@@ -0,0 +1,57 @@
+{#
+  Pre_hooks dos incrementais (fato_venda, rollups e dimensões), para mudanças que não trazem linhas novas:
+
+  truncate_if_source_replaced: um full replace na origem (todas as linhas acima da marca d'água de
+  {{ this }}) esvazia a tabela, que é reconstruída inteira no mesmo run.
+
+  delete_vanished_days: nos meses que receberam linhas novas, apaga os dias que não existem mais na
+  origem (o modo replace_months do ingest troca o mês inteiro e pode remover dias).
+
+  delete_changed_null_dates: apaga as linhas sem data se alguma chegou na origem depois da marca d'água
+  ou se a contagem não bate mais (linhas removidas); o modelo as reinsere todas no mesmo run.
+#}
+{% macro truncate_if_source_replaced(source, relation=this) -%}
+  do $$ begin
+    if (select min(_loaded_at) from {{ source }}) > {{ incremental_watermark(relation) }} then
+      truncate table {{ relation }};
+    end if;
+  end $$
+{%- endmacro %}
+
+{% macro delete_vanished_days(source, relation=this) -%}
+  delete from {{ relation }} t
+  using (
+    select distinct date_trunc('month', data)::date as m
+    from {{ source }}
+    where data is not null and _loaded_at > {{ incremental_watermark(relation) }}
+  ) d
+  where t.data >= d.m and t.data < d.m + interval '1 month'
+    and not exists (select 1 from {{ source }} s where s.data = t.data)
+{%- endmacro %}
+
+{% macro delete_changed_null_dates(source, relation=this) -%}
+  delete from {{ relation }}
+  where data is null
+    and (exists (select 1 from {{ source }} where data is null and _loaded_at > {{ incremental_watermark(relation) }})
+         or (select count(*) from {{ relation }} where data is null) <> (select count(*) from {{ source }} where data is null))
+{%- endmacro %}
+
+{#
+  delete_vanished_keys (dimensões): apaga as chaves cuja primeira ou última venda caía num mês que
+  recebeu linhas novas e que não existem mais na origem. Só essas podem ter sumido: uma chave que
+  some por replace_dates/replace_months tinha todas as linhas nos dias trocados.
+#}
+{% macro delete_vanished_keys(source, key, first_col, last_col, relation=this) -%}
+  {%- if first_col not in adapter.get_columns_in_relation(relation) | map(attribute='name') | list -%}
+  select 1  -- tabela de antes da coluna: o modelo a recalcula inteira neste run
+  {%- else -%}
+  delete from {{ relation }} t
+  using (
+    select distinct date_trunc('month', data)::date as m
+    from {{ source }}
+    where data is not null and _loaded_at > {{ incremental_watermark(relation) }}
+  ) d
+  where (date_trunc('month', t.{{ first_col }}) = d.m or date_trunc('month', t.{{ last_col }}) = d.m)
+    and not exists (select 1 from {{ source }} s where s.{{ key }} = t.{{ key }})
+  {%- endif -%}
+{%- endmacro %}
@@ -0,0 +1,34 @@
+{#
+  Marca d'água dos modelos incrementais, por modelo, em staging.dbt_watermarks (ver sql/ddl.sql).
+
+  O _loaded_at de uma carga é o now() da transação do ingest, isto é, o início e não o commit: uma carga
+  longa fica visível depois de um run que já processou cargas mais novas. Por isso o limite não é o
+  max(_loaded_at) lido, e sim o menor entre ele e o início da transação de escrita mais antiga ainda
+  aberta (pg_stat_activity). watermark_begin (1º pre_hook) calcula esse limite antes de o modelo ler a
+  origem; watermark_commit (post_hook) o grava na mesma transação do modelo. Sem marca (primeiro run,
+  ou instalação antiga) a marca é -infinity e o modelo processa tudo.
+
+  O usuário do dbt precisa enxergar as sessões de ingest em pg_stat_activity: mesmo role da API ou
+  pg_read_all_stats (sessões de outros roles aparecem sem backend_xid e não seguram a marca).
+#}
+{% macro incremental_watermark(relation=this) -%}
+  (select coalesce(max(loaded_until), '-infinity'::timestamptz) from staging.dbt_watermarks where model = '{{ relation.identifier }}')
+{%- endmacro %}
+
+{% macro watermark_begin(source, relation=this) -%}
+  do $$
+  declare abertas timestamptz; visivel timestamptz;
+  begin
+    -- nesta ordem: transação que já não aparece aberta fez commit (ou rollback), e a leitura seguinte a enxerga
+    perform pg_stat_clear_snapshot();  -- pg_stat_activity fica em cache até o fim da transação
+    select min(xact_start) into abertas from pg_stat_activity
+     where backend_type = 'client backend' and backend_xid is not null and pid <> pg_backend_pid();
+    select max(_loaded_at) into visivel from {{ source }};
+    insert into staging.dbt_watermarks (model, pending) values ('{{ relation.identifier }}', least(visivel, abertas - interval '1 microsecond'))
+    on conflict (model) do update set pending = excluded.pending;
+  end $$
+{%- endmacro %}
+
+{% macro watermark_commit(relation=this) -%}
+  update staging.dbt_watermarks set loaded_until = coalesce(pending, loaded_until), updated_at = now() where model = '{{ relation.identifier }}'
+{%- endmacro %}
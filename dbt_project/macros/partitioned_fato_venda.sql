@@ -0,0 +1,87 @@
+{#
+  fato_venda é particionada por mês em data (RANGE), o que o adapter do Postgres não cria sozinho.
+  Este hook (on-run-start) cria a tabela particionada vazia, com a partição DEFAULT, garante os índices e
+  registra a relação no cache do dbt: o modelo incremental passa a só inserir nela (full_refresh=false
+  no modelo), e as partições de cada mês são criadas no pre_hook com staging.ensure_month_partition.
+  Uma fato_venda antiga (tabela comum) é descartada e reconstruída do staging; --full-refresh esvazia
+  a tabela (TRUNCATE) em vez de recriá-la.
+#}
+{% macro create_partitioned_fato_venda() %}
+  {% if execute %}
+    {%- set node = graph.nodes.values() | selectattr('resource_type', 'equalto', 'model') | selectattr('name', 'equalto', 'fato_venda') | first -%}
+    {%- set rel = api.Relation.create(database=node.database, schema=node.schema, identifier=node.alias, type='table') -%}
+    {%- set fqn = rel.include(database=false) -%}
+    {% call statement('fato_venda_partitioned', fetch_result=True) %}
+      select relkind from pg_class where oid = to_regclass('{{ fqn }}')
+    {% endcall %}
+    {%- set res = load_result('fato_venda_partitioned')['data'] -%}
+    {%- set relkind = res[0][0] if res else none -%}
+    {% do adapter.cache_added(rel) %}
+    {#- o SQL devolvido roda como o próprio hook; o commit explícito é porque o dbt faz ROLLBACK na conexão master ao fim dos hooks -#}
+    {% if relkind == 'r' %}
+      {% do log("fato_venda não particionada: recriando como tabela particionada por mês", info=True) %}
+      drop table {{ fqn }};
+    {% endif %}
+    {% if relkind != 'p' %}
+      {{ create_partitioned_fato_venda_sql(rel, fqn) }}
+    {% elif flags.FULL_REFRESH and node.unique_id in selected_resources %}
+      truncate table {{ fqn }};
+    {% endif %}
+    {{ fato_venda_indexes_sql(rel, fqn) }}
+    commit;
+  {% endif %}
+{% endmacro %}
+
+{% macro create_partitioned_fato_venda_sql(rel, fqn) %}
+  create table if not exists {{ fqn }} (
+    id_fato_venda    text,
+    data             date,
+    produto          text,
+    sku              text,
+    familia          text,
+    sub_familia      text,
+    cor              text,
+    tam              text,
+    marca            text,
+    cod_cliente      text,
+    razao_social     text,
+    qtde             numeric,
+    preco_unit       numeric,
+    total_venda      numeric,
+    total_custo      numeric,
+    margem           numeric,
+    documento_fiscal text,
+    _loaded_at       timestamptz
+  ) partition by range (data);
+  create table if not exists {{ adapter.quote(rel.schema) }}.{{ adapter.quote(rel.identifier ~ '_default') }} partition of {{ fqn }} default;
+{% endmacro %}
+
+{#- Índices rodam a cada hook (if not exists): tabelas já existentes também recebem os novos. Os de
+    (…, data, id_fato_venda) atendem a paginação keyset do GET /vendas da API. -#}
+{% macro fato_venda_indexes_sql(rel, fqn) %}
+  -- índice único em tabela particionada precisa conter a chave de partição
+  create unique index if not exists {{ rel.identifier }}_id_idx on {{ fqn }} (id_fato_venda, data);
+  create index if not exists {{ rel.identifier }}_data_id_idx on {{ fqn }} (data, id_fato_venda);
+  create index if not exists {{ rel.identifier }}_loaded_at_idx on {{ fqn }} (_loaded_at);
+  create index if not exists {{ rel.identifier }}_cliente_data_id_idx on {{ fqn }} (cod_cliente, data, id_fato_venda);
+  create index if not exists {{ rel.identifier }}_sku_data_id_idx on {{ fqn }} (sku, data, id_fato_venda);
+  -- substituídos pelos de cima
+  drop index if exists {{ adapter.quote(rel.schema) }}.{{ rel.identifier }}_data_idx;
+  drop index if exists {{ adapter.quote(rel.schema) }}.{{ rel.identifier }}_cliente_data_idx;
+{% endmacro %}
+
+{#
+  Pre_hook: garante as partições de `relation` para os meses com linhas novas em `source` (acima da
+  marca d'água), uma chamada a staging.ensure_month_partition por mês. Os meses são lidos antes, numa
+  consulta à parte: o ATTACH falha se a sessão ainda tem uma consulta aberta sobre a tabela.
+#}
+{% macro ensure_month_partitions(relation, source) %}
+  {%- if execute -%}
+    {%- set months_sql -%}
+      select distinct date_trunc('month', data)::date from {{ source }} where data is not null and _loaded_at > {{ incremental_watermark(relation) }}
+    {%- endset -%}
+    {%- for m in run_query(months_sql).columns[0].values() %}
+    select staging.ensure_month_partition('{{ relation.include(database=false) }}'::regclass, '{{ m }}'::date);
+    {%- endfor %}
+  {%- endif -%}
+{% endmacro %}
@@ -0,0 +1,44 @@
+-- dim_cliente: incremental por cod_cliente. Cada cliente que aparece nos dias reconstruídos do fato (ou cuja
+-- primeira/última compra caía num mês refeito) é recalculado com todo o seu histórico no fato_venda, pelo
+-- índice (cod_cliente, data); clientes que sumiram da origem saem no pre_hook delete_vanished_keys.
+{{ config(
+    materialized='incremental',
+    unique_key='cod_cliente',
+    incremental_strategy='merge',
+    indexes=[{'columns': ['cod_cliente'], 'unique': True}],
+    pre_hook=[
+      "{{ watermark_begin(ref('fato_venda')) }}",
+      "{% if is_incremental() %}{{ truncate_if_source_replaced(ref('fato_venda')) }}{% endif %}",
+      "{% if is_incremental() %}{{ delete_vanished_keys(ref('fato_venda'), 'cod_cliente', 'primeira_compra', 'ultima_compra') }}{% endif %}",
+    ],
+    post_hook="{{ watermark_commit() }}"
+) }}
+
+{% if is_incremental() %}
+with meses as (
+  select distinct date_trunc('month', data)::date as m
+  from {{ ref('fato_venda') }}
+  where data is not null and _loaded_at > {{ incremental_watermark() }}
+),
+
+chaves as (
+  select cod_cliente from {{ ref('fato_venda') }}
+  where _loaded_at > {{ incremental_watermark() }}
+  union
+  select t.cod_cliente from {{ this }} t
+  join meses d on date_trunc('month', t.primeira_compra) = d.m or date_trunc('month', t.ultima_compra) = d.m
+)
+{% endif %}
+
+select
+  cod_cliente,
+  max(razao_social) as razao_social,
+  min(data)         as primeira_compra,
+  max(data)         as ultima_compra,
+  max(_loaded_at)   as _loaded_at
+from {{ ref('fato_venda') }}
+where cod_cliente is not null
+{% if is_incremental() %}
+  and cod_cliente in (select cod_cliente from chaves)
+{% endif %}
+group by 1
@@ -0,0 +1,50 @@
+-- dim_produto: incremental por sku, como dim_cliente: cada SKU dos dias reconstruídos do fato (ou cuja
+-- primeira/última venda caía num mês refeito) é recalculado com todo o seu histórico no fato_venda, pelo
+-- índice (sku, data); SKUs que sumiram da origem saem no pre_hook delete_vanished_keys.
+{{ config(
+    materialized='incremental',
+    unique_key='sku',
+    incremental_strategy='merge',
+    on_schema_change='append_new_columns',
+    indexes=[{'columns': ['sku'], 'unique': True}],
+    pre_hook=[
+      "{{ watermark_begin(ref('fato_venda')) }}",
+      "{% if is_incremental() %}{{ truncate_if_source_replaced(ref('fato_venda')) }}{% endif %}",
+      "{% if is_incremental() %}{{ delete_vanished_keys(ref('fato_venda'), 'sku', 'primeira_venda', 'ultima_venda') }}{% endif %}",
+    ],
+    post_hook="{{ watermark_commit() }}"
+) }}
+
+{#- dim_produto de antes de primeira_venda/ultima_venda: recalcula todos os SKUs uma vez -#}
+{%- set incremental = is_incremental() and 'primeira_venda' in (adapter.get_columns_in_relation(this) | map(attribute='name') | list) %}
+{% if incremental %}
+with meses as (
+  select distinct date_trunc('month', data)::date as m
+  from {{ ref('fato_venda') }}
+  where data is not null and _loaded_at > {{ incremental_watermark() }}
+),
+
+chaves as (
+  select sku from {{ ref('fato_venda') }}
+  where _loaded_at > {{ incremental_watermark() }}
+  union
+  select t.sku from {{ this }} t
+  join meses d on date_trunc('month', t.primeira_venda) = d.m or date_trunc('month', t.ultima_venda) = d.m
+)
+{% endif %}
+
+select
+  sku,
+  max(produto)      as produto,
+  max(familia)      as familia,
+  max(sub_familia)  as sub_familia,
+  max(marca)        as marca,
+  min(data)         as primeira_venda,
+  max(data)         as ultima_venda,
+  max(_loaded_at)   as _loaded_at
+from {{ ref('fato_venda') }}
+where sku is not null
+{% if incremental %}
+  and sku in (select sku from chaves)
+{% endif %}
+group by 1
@@ -0,0 +1,39 @@
+-- Indicadores gerais (uma linha) para a Visão Geral do dashboard. Lê só os rollups mensais/diários
+-- e as dimensões: o custo de reconstruir a cada run não cresce com o fato_venda.
+{{ config(materialized='table') }}
+
+with mes as (
+  select
+    sum(pedidos)     as pedidos,
+    sum(linhas)      as linhas,
+    sum(qtde)        as qtde,
+    sum(total_venda) as total_venda,
+    sum(total_custo) as total_custo,
+    sum(margem)      as margem
+  from {{ ref('mart_vendas_mes_cliente') }}
+),
+
+dias as (
+  select min(data) as primeira_venda, max(data) as ultima_venda
+  from {{ ref('mart_vendas_dia_cliente') }}
+),
+
+ult30 as (
+  select
+    sum(d.total_venda) as total_venda_30d,
+    sum(d.margem)      as margem_30d,
+    sum(d.pedidos)     as pedidos_30d
+  from {{ ref('mart_vendas_dia_cliente') }} d, dias
+  where d.data > dias.ultima_venda - 30
+)
+
+select
+  (select count(*) from {{ ref('dim_cliente') }}) as clientes,
+  (select count(*) from {{ ref('dim_produto') }}) as skus,
+  mes.*,
+  mes.margem / nullif(mes.total_venda, 0)         as margem_pct,
+  dias.primeira_venda,
+  dias.ultima_venda,
+  ult30.*,
+  now()                                           as atualizado_em
+from mes, dias, ult30
@@ -1 +1,63 @@
-with x as (select 1) select * from x;
\ No newline at end of file
+{#
+  RFM por cliente sobre fato_venda, numa janela de var('rfm_window_days') dias até
+  var('rfm_ref_date') (padrão: hoje). Scores 1..5 por NTILE; rfm_score já vem calculado e indexado
+  para o ranking (top-N) e a busca por cliente serem index scans.
+#}
+{{ config(
+    materialized='table',
+    indexes=[
+      {'columns': ['cod_cliente'], 'unique': True},
+      {'columns': ['rfm_score desc', 'cod_cliente']},
+    ],
+    post_hook="analyze {{ this }}"
+) }}
+
+{% set ref_date = var('rfm_ref_date', none) %}
+
+with params as (
+  select {% if ref_date %}'{{ ref_date }}'::date{% else %}current_date{% endif %} as data_referencia
+),
+
+vendas as (
+  select f.cod_cliente, f.data, f.documento_fiscal, f.total_venda
+  from {{ ref('fato_venda') }} f
+  cross join params p
+  where f.cod_cliente is not null
+    and f.data <= p.data_referencia
+    and f.data > p.data_referencia - {{ var('rfm_window_days', 365) }}
+),
+
+agg as (
+  select
+    cod_cliente,
+    max(data)                         as ultima_compra,
+    count(distinct documento_fiscal)  as freq,
+    coalesce(sum(total_venda), 0)     as valor
+  from vendas
+  group by 1
+),
+
+scored as (
+  select
+    a.*,
+    p.data_referencia - a.ultima_compra            as recencia_dias,
+    ntile(5) over (order by a.ultima_compra, a.cod_cliente)  as r_score,  -- compra mais recente = 5
+    ntile(5) over (order by a.freq, a.cod_cliente)           as f_score,
+    ntile(5) over (order by a.valor, a.cod_cliente)          as m_score,
+    p.data_referencia
+  from agg a
+  cross join params p
+)
+
+select
+  cod_cliente,
+  ultima_compra,
+  recencia_dias,
+  freq,
+  valor,
+  r_score,
+  f_score,
+  m_score,
+  r_score + f_score + m_score as rfm_score,
+  data_referencia
+from scored
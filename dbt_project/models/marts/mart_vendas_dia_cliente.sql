@@ -0,0 +1,37 @@
+-- Vendas por dia e cliente. Incremental por dia: só os dias com linhas novas no fato_venda são recalculados.
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key='data',
+    indexes=[
+      {'columns': ['data']},
+      {'columns': ['cod_cliente', 'data']},
+      {'columns': ['_loaded_at']},
+    ],
+    pre_hook=[
+      "{{ watermark_begin(ref('fato_venda')) }}",
+      "{% if is_incremental() %}{{ truncate_if_source_replaced(ref('fato_venda')) }}{% endif %}",
+      "{% if is_incremental() %}{{ delete_vanished_days(ref('fato_venda')) }}{% endif %}",
+    ],
+    post_hook="{{ watermark_commit() }}"
+) }}
+
+select
+  data,
+  cod_cliente,
+  count(distinct documento_fiscal) as pedidos,
+  count(*)                         as linhas,
+  sum(qtde)                        as qtde,
+  sum(total_venda)                 as total_venda,
+  sum(total_custo)                 as total_custo,
+  sum(margem)                      as margem,
+  max(_loaded_at)                  as _loaded_at
+from {{ ref('fato_venda') }}
+where data is not null
+{% if is_incremental() %}
+  and data in (
+    select distinct data from {{ ref('fato_venda') }}
+    where _loaded_at > {{ incremental_watermark() }}
+  )
+{% endif %}
+group by 1, 2
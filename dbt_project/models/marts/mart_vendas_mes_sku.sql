@@ -0,0 +1,35 @@
+-- Consolidação mensal de mart_vendas_dia_sku. Incremental por mês: recalcula só os meses com dias novos no rollup diário.
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key='mes',
+    indexes=[
+      {'columns': ['mes']},
+      {'columns': ['sku', 'mes']},
+    ],
+    pre_hook=[
+      "{{ watermark_begin(ref('mart_vendas_dia_sku')) }}",
+      "{% if is_incremental() %}{{ truncate_if_source_replaced(ref('mart_vendas_dia_sku')) }}{% endif %}",
+    ],
+    post_hook="{{ watermark_commit() }}"
+) }}
+
+select
+  date_trunc('month', data)::date as mes,
+  sku,
+  max(produto)                    as produto,
+  sum(pedidos)                    as pedidos,
+  sum(linhas)                     as linhas,
+  sum(qtde)                       as qtde,
+  sum(total_venda)                as total_venda,
+  sum(total_custo)                as total_custo,
+  sum(margem)                     as margem,
+  max(_loaded_at)                 as _loaded_at
+from {{ ref('mart_vendas_dia_sku') }}
+{% if is_incremental() %}
+where date_trunc('month', data) in (
+  select distinct date_trunc('month', data) from {{ ref('mart_vendas_dia_sku') }}
+  where _loaded_at > {{ incremental_watermark() }}
+)
+{% endif %}
+group by 1, 2
@@ -1 +1,21 @@
-select * from staging.raw_vendas_achatado;
\ No newline at end of file
+-- View tipada sobre o staging: os modelos incrementais filtram por _loaded_at direto no índice do staging
+{{ config(materialized='view') }}
+select
+  data::date             as data,
+  produto,
+  sku,
+  familia,
+  sub_familia,
+  cor,
+  tam,
+  marca,
+  cod_cliente,
+  razao_social,
+  qtde::numeric          as qtde,
+  preco_unit::numeric    as preco_unit,
+  total_venda::numeric   as total_venda,
+  total_custo::numeric   as total_custo,
+  margem::numeric        as margem,
+  documento_fiscal,
+  _loaded_at
+from {{ source('staging', 'raw_vendas_achatado') }}
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Teste de carga simples: latência p50/p99 de uma rota da API sob concorrência.
+
+Uso (antes/depois do pool):
+    DB_POOL_MAX=0  uvicorn main:app ...   # uma conexão por chamada
+    DB_POOL_MAX=10 uvicorn main:app ...   # pool
+    python scripts/bench_api_latency.py --url "http://localhost:10000/health?db=true" -n 2000 -c 16
+
+Rotas cacheadas (/clientes/{cod}/visao, /insights/churn); --revalidate manda o ETag da primeira
+resposta em If-None-Match, como faz o cliente do CRM (respostas 304):
+    python scripts/bench_api_latency.py --url "http://localhost:10000/insights/churn" -n 5000 -c 32 --revalidate
+"""
+import argparse, json, statistics, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+def percentile(values, p):
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", required=True)
+    ap.add_argument("-n", "--requests", type=int, default=1000)
+    ap.add_argument("-c", "--concurrency", type=int, default=8)
+    ap.add_argument("--header", action="append", default=[], help="Nome: valor (repetível)")
+    ap.add_argument("--json", action="store_true", help="imprime o resultado em JSON")
+    ap.add_argument("--revalidate", action="store_true", help="envia If-None-Match com o ETag da primeira resposta")
+    ap.add_argument("--p99-max", type=float, help="falha (exit 1) se o p99 em ms passar deste alvo")
+    a = ap.parse_args()
+    headers = dict(h.split(":", 1) for h in a.header)
+    headers = {k.strip(): v.strip() for k, v in headers.items()}
+    if a.revalidate:
+        etag = requests.get(a.url, headers=headers, timeout=60).headers.get("ETag")
+        if etag: headers["If-None-Match"] = etag
+    sessions = {}
+
+    def one(_):
+        s = sessions.setdefault(threading.get_ident(), requests.Session())
+        t0 = time.perf_counter(); r = s.get(a.url, headers=headers, timeout=60)
+        return (time.perf_counter() - t0) * 1000, r.status_code
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=a.concurrency) as ex:
+        res = list(ex.map(one, range(a.requests)))
+    wall = time.perf_counter() - t0
+    lat = [ms for ms, _ in res]; errors = sum(1 for _, code in res if code >= 400)
+    out = {"url": a.url, "requests": a.requests, "concurrency": a.concurrency, "errors": errors, "rps": round(a.requests / wall, 1),
+           "p50_ms": round(percentile(lat, 50), 2), "p90_ms": round(percentile(lat, 90), 2), "p99_ms": round(percentile(lat, 99), 2),
+           "mean_ms": round(statistics.mean(lat), 2), "max_ms": round(max(lat), 2),
+           "not_modified": sum(1 for _, code in res if code == 304)}
+    if a.json: json.dump(out, sys.stdout); print()
+    else: print(" ".join(f"{k}={v}" for k, v in out.items()))
+    if a.p99_max is not None and out["p99_ms"] > a.p99_max:
+        print(f"p99 {out['p99_ms']} ms acima do alvo de {a.p99_max} ms", file=sys.stderr); return 1
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Benchmark da carga no banco: COPY texto vs COPY binário tipado, e o tamanho de tabela/índices resultante.
+
+Uso:
+    DATABASE_URL=postgresql://... python scripts/bench_copy.py --rows 1000000 --workers 1
+
+Carrega o mesmo CSV (gerado como no bench_ingest) pelo caminho real da API (prepare_ingest +
+copy_into_db, modo full) em tabelas de rascunho no schema bench_copy, que é apagado ao final
+(--keep mantém):
+  text/legado  COPY texto numa tabela só com colunas text (layout antigo do staging)
+  text/tipado  COPY texto na tabela tipada (o Postgres converte datas e números)
+  binary       COPY binário na tabela tipada (conversão em Python, com rejeitados)
+"""
+import argparse, io, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "apps", "api"))
+import main  # noqa: E402
+from bench_ingest import gen_csv  # noqa: E402
+
+SCHEMA = "bench_copy"
+TEXT_COLS = ", ".join(f"{c} text" for c in main.REQ_COLS)
+TYPED_COLS = ", ".join(f"{c} {t}" for c, t in zip(main.REQ_COLS, main.COPY_TYPES))
+CONFIGS = [("text/legado", "text", "legado"), ("text/tipado", "text", "tipado"), ("binary", "binary", "tipado")]
+
+def reset_table(name: str, cols: str) -> str:
+    table = f"{SCHEMA}.{name}"
+    with main.get_conn() as conn:
+        conn.execute(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}")
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(f"CREATE TABLE {table} ({cols}, _loaded_at timestamptz NOT NULL DEFAULT now())")
+        # mesmos índices do staging (sql/ddl.sql)
+        conn.execute(f"CREATE INDEX ON {table} (documento_fiscal, sku, cod_cliente, data)")
+        conn.execute(f"CREATE INDEX ON {table} (data)")
+        conn.execute(f"CREATE INDEX ON {table} (_loaded_at)")
+    return table
+
+def sizes(table: str):
+    with main.psycopg.connect(main.DATABASE_URL, autocommit=True, **main.DB_CONN_KWARGS) as conn:  # VACUUM fora de transação
+        conn.execute(f"VACUUM ANALYZE {table}")
+        return conn.execute("SELECT pg_table_size(%s) AS t, pg_indexes_size(%s) AS i", (table, table)).fetchone()
+
+def run(data: str, table: str, copy_format: str, workers: int):
+    main.STAGING_TABLE = table
+    t0 = time.perf_counter()
+    proc = main.prepare_ingest(io.StringIO(data, newline=""), "DD/MM/YYYY", None, workers=workers, copy_format=copy_format)
+    stats = main.copy_into_db(proc["rows"], "full", copy_format=copy_format)
+    return stats, time.perf_counter() - t0
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=500000)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--keep", action="store_true", help="não apaga o schema bench_copy ao final")
+    a = ap.parse_args()
+    if not main.DATABASE_URL: sys.exit("defina DATABASE_URL")
+    data = gen_csv(a.rows)
+    try:
+        for label, copy_format, layout in CONFIGS:
+            table = reset_table(layout, TEXT_COLS if layout == "legado" else TYPED_COLS)
+            stats, dt = run(data, table, copy_format, a.workers)
+            sz = sizes(table)
+            print(f"{label:<12} rows={stats['rows']:<10} rejected={stats.get('rejected', 0):<6} {dt:8.2f}s {stats['rows']/dt:12,.0f} rows/s"
+                  f"  tabela={sz['t']/2**20:8.1f} MB  índices={sz['i']/2**20:8.1f} MB")
+    finally:
+        if not a.keep:
+            with main.get_conn() as conn: conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Benchmark do ingest: sniff -> normalização -> COPY, com linhas/s, pico de RSS e disco por etapa.
+
+Uso:
+    python scripts/bench_ingest.py --rows 500000 --workers 1,2,4 --engines python,arrow --check
+    DATABASE_URL=postgresql://... python scripts/bench_ingest.py --db --rows 10k,1m --delimiters ";," \\
+        --headers erp,aliases --gzip off,on --copy-formats text,binary --json atual.json --compare base.json
+
+Os CSVs são gerados (semente fixa, portanto reprodutíveis) em --data-dir e reaproveitados entre
+execuções: vendas achatadas no formato do ERP, com `1.234,56`, datas DD/MM/AAAA, campos com aspas,
+delimitador e quebra de linha, custo vazio; cabeçalho do ERP ou com apelidos sorteados de ALIASES;
+gzip opcional. Cada configuração roda num processo novo (pico de RSS limpo).
+
+--check é o teste diferencial: toda combinação engine/workers precisa gerar exatamente o mesmo
+conteúdo de COPY que o caminho serial linha a linha (só sem --db e com copy_format text).
+
+--db carrega num staging de rascunho (schema bench_ingest, LIKE staging.raw_vendas_achatado,
+particionado; exige sql/ddl.sql aplicado) pelo copy_into_db da API — use um Postgres descartável.
+Etapas: sniff (sniff + cabeçalho + preview), normalize (tempo esperando o gerador de linhas; com
+workers>1 é a espera pelo pool), copy (tempo no COPY) e finalize (fim do COPY, partições, commit).
+Disco: tamanho do arquivo de entrada, WAL gerado e temp_bytes do Postgres (o ingest não grava
+arquivo temporário no cliente).
+
+--json grava o resultado; --compare compara linhas/s com um JSON anterior e sai com código 1 se
+alguma configuração piorar mais que --max-regression (use --repeat para reduzir o ruído).
+"""
+import argparse, gzip, hashlib, json, multiprocessing, os, platform, random, resource, subprocess, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "apps", "api"))
+import main  # noqa: E402
+
+HEADER = ["Data","Produto","SKU","Família","Sub-família","Cor","Tam","Marca","Cód. Cliente","Razão social","Qtde","Preço unit","Total venda","Total custo","Margem","Documento Fiscal"]
+SCRATCH = "bench_ingest.raw_vendas_achatado"
+KEY = ("rows", "delimiter", "headers", "gzip", "engine", "workers", "copy_format", "mode")
+
+def br_decimal(v: float) -> str:
+    inteiro, dec = f"{v:.2f}".split(".")
+    return f"{int(inteiro):,}".replace(",", ".") + "," + dec
+
+def gen_records(rows: int, seed: int = 42):
+    """Registros crus (antes das aspas do CSV), na ordem de HEADER."""
+    rnd = random.Random(seed)
+    for i in range(rows):
+        qt = rnd.randint(1, 50); pu = rnd.uniform(5, 2500); tv = qt * pu; tc = tv * rnd.uniform(0.4, 0.9)
+        razao = f"Cliente {i % 20011}" if i % 101 else f"Cliente {i % 20011}\nfilial\\{i % 3}"  # quebra de linha e barra
+        yield [
+            f"{rnd.randint(1,28):02d}/{rnd.randint(1,12):02d}/{rnd.choice((2023,2024))}",
+            f'Produto {i % 997}; cor "{i % 7}"', f"SKU{i % 5003}", f"F{i % 11}", f"S{i % 37}",
+            rnd.choice(("azul","preto","branco")), rnd.choice(("P","M","G")), f"M{i % 23}",
+            f"C{i % 20011}", razao, str(qt), br_decimal(pu), br_decimal(tv), br_decimal(tc) if i % 53 else "",
+            br_decimal(tv - tc), f"NF{i // 3}",
+        ]
+
+def csv_line(values, delimiter: str) -> str:
+    return delimiter.join(f'"{v.replace(chr(34), chr(34)*2)}"' if delimiter in v or '"' in v or "\n" in v else v for v in values) + "\r\n"
+
+def alias_header(seed: int = 42) -> list:
+    """Cabeçalho com um apelido de ALIASES por coluna, sorteado até o mapeamento da API ser inequívoco."""
+    rnd = random.Random(seed); expected = {c: i for i, c in enumerate(main.REQ_COLS)}
+    while True:
+        h = [rnd.choice(main.ALIASES[c]).replace("_", " ").title() for c in main.REQ_COLS]
+        if main.build_alias_map(h) == expected: return h
+
+def iter_csv(rows: int, delimiter: str = ";", header=None, seed: int = 42, chunk_rows: int = 10000):
+    buf = [csv_line(header or HEADER, delimiter)]
+    for rec in gen_records(rows, seed):
+        buf.append(csv_line(rec, delimiter))
+        if len(buf) >= chunk_rows: yield "".join(buf); buf = []
+    if buf: yield "".join(buf)
+
+def gen_csv(rows: int, delimiter: str = ";", seed: int = 42) -> str:
+    return "".join(iter_csv(rows, delimiter, seed=seed))
+
+def data_file(data_dir: str, rows: int, delimiter: str, headers: str, gz: bool) -> str:
+    """Gera (ou reaproveita) o CSV da combinação em disco, em streaming: serve para 50M linhas."""
+    name = f"vendas_{rows}_{'semicolon' if delimiter == ';' else 'comma'}_{headers}.csv" + (".gz" if gz else "")
+    path = os.path.join(data_dir, name)
+    if os.path.exists(path): return path
+    os.makedirs(data_dir, exist_ok=True)
+    tmp = path + ".tmp"
+    with (gzip.open(tmp, "wt", encoding="utf-8", newline="", compresslevel=6) if gz else open(tmp, "w", encoding="utf-8", newline="")) as out:
+        for chunk in iter_csv(rows, delimiter, alias_header() if headers == "aliases" else HEADER): out.write(chunk)
+    os.replace(tmp, path)
+    return path
+
+class TimedRows:
+    """Envolve o gerador de linhas do prepare_ingest e acumula o tempo gasto produzindo cada item."""
+    def __init__(self, rows): self.rows = iter(rows); self.busy = 0.0; self.done_at = None
+    def __iter__(self):
+        while True:
+            t = time.perf_counter()
+            try: item = next(self.rows)
+            except StopIteration:
+                self.done_at = time.perf_counter(); self.busy += self.done_at - t; return
+            self.busy += time.perf_counter() - t
+            yield item
+
+def reset_scratch():
+    with main.get_conn() as conn:
+        conn.execute("DROP SCHEMA IF EXISTS bench_ingest CASCADE")
+        conn.execute("CREATE SCHEMA bench_ingest")
+        conn.execute(f"CREATE TABLE {SCRATCH} (LIKE staging.raw_vendas_achatado INCLUDING DEFAULTS INCLUDING INDEXES) PARTITION BY RANGE (data)")
+        conn.execute(f"CREATE TABLE {SCRATCH}_default PARTITION OF {SCRATCH} DEFAULT")
+
+def db_counters():
+    with main.get_conn() as conn:
+        return conn.execute("""SELECT pg_current_wal_lsn()::text AS lsn, temp_bytes FROM pg_stat_database WHERE datname = current_database()""").fetchone()
+
+def db_usage(before):
+    time.sleep(1.1)  # o Postgres publica as estatísticas da sessão com até 1s de atraso
+    with main.get_conn() as conn:
+        row = conn.execute("""SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s::pg_lsn)::bigint AS wal, temp_bytes - %s AS temp
+                              FROM pg_stat_database WHERE datname = current_database()""", (before["lsn"], before["temp_bytes"])).fetchone()
+        size = conn.execute("""SELECT coalesce(sum(pg_table_size(relid)), 0)::bigint AS t, coalesce(sum(pg_indexes_size(relid)), 0)::bigint AS i
+                               FROM pg_partition_tree(%s::regclass) WHERE isleaf""", (SCRATCH,)).fetchone()
+    return {"wal_bytes": row["wal"], "pg_temp_bytes": row["temp"], "table_bytes": size["t"], "index_bytes": size["i"]}
+
+def run_one(cfg):
+    """Uma configuração, do arquivo em disco até o commit (ou só até a normalização, sem --db)."""
+    main.INGEST_BLOCK_ROWS = cfg["block_rows"]
+    if cfg["db"]:
+        main.STAGING_TABLE = SCRATCH; reset_scratch(); before = db_counters()
+    res = {k: cfg[k] for k in KEY}; res["input_bytes"] = os.path.getsize(cfg["path"])
+    digest = hashlib.md5() if cfg["check"] else None
+    t0 = time.perf_counter()
+    with open(cfg["path"], "rb") as fbin, main.open_text_stream(fbin, gz=cfg["gzip"]) as ftxt:
+        proc = main.prepare_ingest(ftxt, "DD/MM/YYYY", None, workers=cfg["workers"], engine=cfg["engine"], copy_format=cfg["copy_format"])
+        t_sniff = time.perf_counter(); rows = TimedRows(proc["rows"])
+        if cfg["db"]:
+            stats = main.copy_into_db(rows, cfg["mode"], copy_format=proc["copy_format"])
+            n = stats["rows"]; res["rejected"] = stats.get("rejected", 0)
+        else:
+            n = 0
+            for item in rows:  # sem banco, cada item ainda vira o que o COPY receberia
+                text = None
+                if isinstance(item, main.CopyBlock): n += item.rows; text = item.text
+                elif isinstance(item, main.TypedBlock): n += len(item.rows)
+                elif cfg["copy_format"] == "binary":
+                    try: main.typed_row(item); n += 1
+                    except main.RejectedValue: pass
+                else: n += 1; text = main.copy_text_line(item) + "\n"
+                if digest and text: digest.update(text.encode())
+    t_end = time.perf_counter()
+    total = t_end - t0
+    res.update(rows_loaded=n, sniff_s=round(t_sniff - t0, 4), normalize_s=round(rows.busy if cfg["db"] else t_end - t_sniff, 4),
+               total_s=round(total, 4), rows_per_s=round(n / total, 1) if total else None)
+    if cfg["db"]:
+        res.update(copy_s=round(rows.done_at - t_sniff - rows.busy, 4), finalize_s=round(t_end - rows.done_at, 4), **db_usage(before))
+    if digest: res["output_md5"] = digest.hexdigest()
+    for ex in main._pools.values(): ex.shutdown()  # encerra os workers: entram no RUSAGE_CHILDREN
+    res["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    res["peak_rss_workers_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1) if cfg["workers"] > 1 else None
+    return res
+
+def _child(cfg, q):
+    try: q.put(run_one(cfg))
+    except BaseException as e: q.put({"error": f"{type(e).__name__}: {getattr(e, 'detail', e)}"})
+
+def run_isolated(cfg):
+    ctx = multiprocessing.get_context("spawn"); q = ctx.Queue()
+    p = ctx.Process(target=_child, args=(cfg, q)); p.start()
+    res = q.get(); p.join()
+    if "error" in res: raise SystemExit(f"falhou {cfg}: {res['error']}")
+    return res
+
+def parse_count(s: str) -> int:
+    s = s.strip().lower(); mult = {"k": 10**3, "m": 10**6}.get(s[-1:], 1)
+    return int(float(s[:-1] if mult > 1 else s) * mult)
+
+def split(s: str, conv=str):
+    return [conv(x) for x in s.split(",") if x.strip()]
+
+def compare(results, baseline_path: str, max_regression: float) -> bool:
+    with open(baseline_path) as f: base = {tuple(r[k] for k in KEY): r for r in json.load(f)["results"]}
+    ok = True
+    for r in results:
+        b = base.get(tuple(r[k] for k in KEY))
+        if not b or not b.get("rows_per_s"): continue
+        delta = r["rows_per_s"] / b["rows_per_s"] - 1
+        flag = "REGRESSÃO" if delta < -max_regression else ""
+        ok &= not flag
+        print(f"{' '.join(str(r[k]) for k in KEY):<60} {b['rows_per_s']:12,.0f} -> {r['rows_per_s']:12,.0f} rows/s {delta:+7.1%} {flag}")
+    return ok
+
+def git_sha():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception: return None
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", default="200000", help="lista, aceita sufixos k/m (ex.: 10k,1m,50m)")
+    ap.add_argument("--delimiters", default=";", help='um ou mais caracteres, ex.: ";," gera os dois')
+    ap.add_argument("--headers", default="erp", help="erp,aliases")
+    ap.add_argument("--gzip", default="off", help="off,on")
+    ap.add_argument("--workers", default="1,2,4")
+    ap.add_argument("--engines", default="python")
+    ap.add_argument("--copy-formats", default="text", help="text,binary")
+    ap.add_argument("--modes", default="full", help="com --db; o staging de rascunho começa vazio em cada configuração")
+    ap.add_argument("--block-rows", type=int, default=main.INGEST_BLOCK_ROWS)
+    ap.add_argument("--db", action="store_true", help="carrega no Postgres de DATABASE_URL (schema bench_ingest)")
+    ap.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "bench_ingest"))
+    ap.add_argument("--check", action="store_true", help="compara a saída de cada configuração com a serial")
+    ap.add_argument("--json", help="grava os resultados neste arquivo")
+    ap.add_argument("--compare", help="JSON de uma execução anterior para comparar linhas/s")
+    ap.add_argument("--max-regression", type=float, default=0.10)
+    ap.add_argument("--repeat", type=int, default=1, help="roda cada configuração N vezes e fica com a melhor (menos ruído no --compare)")
+    a = ap.parse_args()
+    if a.db and not main.DATABASE_URL: sys.exit("--db exige DATABASE_URL")
+    results = []
+    for rows in split(a.rows, parse_count):
+        for delimiter in dict.fromkeys(a.delimiters):
+            for headers in split(a.headers):
+                for gz in [g == "on" for g in split(a.gzip)]:
+                    path = data_file(a.data_dir, rows, delimiter, headers, gz)
+                    baseline = None
+                    for engine in split(a.engines):
+                        for copy_format in split(a.copy_formats):
+                            if copy_format == "binary" and engine != "python": continue
+                            for w in split(a.workers, int):
+                                for mode in split(a.modes) if a.db else ["-"]:
+                                    cfg = dict(rows=rows, delimiter=delimiter, headers=headers, gzip=gz, engine=engine, workers=w,
+                                               copy_format=copy_format, mode=mode, path=path, db=a.db, block_rows=a.block_rows,
+                                               check=a.check and not a.db and copy_format == "text")
+                                    if cfg["check"] and baseline is None:
+                                        baseline = run_isolated({**cfg, "engine": "python", "workers": 1})["output_md5"]
+                                    r = max((run_isolated(cfg) for _ in range(a.repeat)), key=lambda x: x["rows_per_s"] or 0); results.append(r)
+                                    if cfg["check"]: assert r["output_md5"] == baseline, f"saída de engine={engine} workers={w} difere da serial ({path})"
+                                    line = (f"rows={rows:<9} {'semicolon' if delimiter == ';' else 'comma':<9} {headers:<7} gz={'on' if gz else 'off':<3} "
+                                            f"engine={engine:<6} workers={w:<2} {copy_format:<6} {mode:<6} {r['total_s']:8.2f}s {r['rows_per_s']:12,.0f} rows/s "
+                                            f"sniff={r['sniff_s']:.3f}s normalize={r['normalize_s']:.2f}s")
+                                    if a.db: line += f" copy={r['copy_s']:.2f}s finalize={r['finalize_s']:.2f}s wal={r['wal_bytes']/2**20:,.0f}MB temp={r['pg_temp_bytes']/2**20:,.0f}MB"
+                                    print(line + f" rss={r['peak_rss_mb']:,.0f}MB", flush=True)
+    if a.json:
+        pg = None
+        if a.db:
+            with main.get_conn() as conn: pg = conn.execute("SHOW server_version").fetchone()["server_version"]
+        meta = {"git": git_sha(), "python": platform.python_version(), "postgres": pg, "cpus": os.cpu_count(), "platform": platform.platform(),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "argv": sys.argv[1:]}
+        with open(a.json, "w") as f: json.dump({"meta": meta, "results": results}, f, indent=2, ensure_ascii=False)
+    if a.db:
+        with main.get_conn() as conn: conn.execute("DROP SCHEMA IF EXISTS bench_ingest CASCADE")
+    if a.compare and not compare(results, a.compare, a.max_regression): sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
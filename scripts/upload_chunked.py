@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Envia um CSV (ou .csv.gz) grande para a API pelo upload em partes (/ingest/uploads) e acompanha o job.
+
+Uso:
+    python scripts/upload_chunked.py vendas.csv.gz --api http://localhost:10000 --mode replace_months --date-format DD/MM/YYYY
+    python scripts/upload_chunked.py vendas.csv.gz --api ... --resume <upload_id>   # depois de uma queda: só as partes que faltam
+
+As partes (--part-mb) saem em paralelo (--parallel), cada uma com o SHA-256 no X-Part-SHA256, lidas
+direto do disco (o arquivo não é carregado em memória). Com --early o ingest começa na API enquanto
+as partes chegam. O upload_id é impresso no início; sem --resume, uma queda recomeça do zero.
+"""
+import argparse, hashlib, json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+RETRIES = 3
+
+def send_part(api: str, upload_id: str, path: str, n: int, part_size: int) -> int:
+    with open(path, "rb") as f:
+        f.seek((n - 1) * part_size)
+        chunk = f.read(part_size)
+    digest = hashlib.sha256(chunk).hexdigest()
+    for tentativa in range(RETRIES):
+        try:
+            r = requests.put(f"{api}/ingest/uploads/{upload_id}/parts/{n}", data=chunk, headers={"X-Part-SHA256": digest}, timeout=600)
+            if r.status_code == 200:
+                return len(chunk)
+            if r.status_code == 404:
+                sys.exit(f"upload {upload_id} não existe mais na API (expirou ou foi cancelado)")
+            if r.status_code == 409:
+                sys.exit(f"upload {upload_id}: {r.json().get('detail')}")
+            if r.status_code < 500 and not (r.status_code == 400 and "não confere" in r.text):
+                sys.exit(f"parte {n}: API respondeu {r.status_code}: {r.text}")  # de 4xx, só o checksum (corrompida no caminho) vale reenviar
+            print(f"parte {n}: {r.status_code} {r.text[:200]}", file=sys.stderr)
+        except requests.RequestException as e:
+            print(f"parte {n}: {e}", file=sys.stderr)
+        time.sleep(2 ** tentativa)
+    raise RuntimeError(f"parte {n} falhou {RETRIES} vezes; retome com --resume {upload_id}")
+
+def follow(api: str, job_id: str):
+    while True:
+        j = requests.get(f"{api}/ingest/jobs/{job_id}", timeout=30).json()
+        prog = f"{j['progress']:.0%}" if j.get("progress") is not None else "-"
+        print(f"job {job_id}: {j['status']}/{j['phase']} linhas={j['rows_processed']:,} lido={prog}", flush=True)
+        if j["status"] in ("done", "error", "cancelled"):
+            return j
+        time.sleep(5)
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("path")
+    ap.add_argument("--api", default=os.getenv("API_BASE_URL", "http://localhost:10000"))
+    ap.add_argument("--mode", default="full")
+    ap.add_argument("--date-format")
+    ap.add_argument("--profile")
+    ap.add_argument("--header-map", help="JSON com coluna canônica -> cabeçalho do arquivo")
+    ap.add_argument("--copy-format", choices=("text", "binary"))
+    ap.add_argument("--part-mb", type=float, default=16)
+    ap.add_argument("--parallel", type=int, default=4)
+    ap.add_argument("--early", action="store_true", help="o ingest começa enquanto as partes chegam (ignorado no --mode full)")
+    ap.add_argument("--resume", metavar="UPLOAD_ID")
+    ap.add_argument("--no-wait", action="store_true", help="não acompanha o job")
+    a = ap.parse_args()
+    api = a.api.rstrip("/")
+    size = os.path.getsize(a.path)
+
+    if a.resume:
+        r = requests.get(f"{api}/ingest/uploads/{a.resume}", timeout=30)
+    else:
+        r = requests.post(f"{api}/ingest/uploads", timeout=60, json={
+            "filename": os.path.basename(a.path), "size": size, "part_size": int(a.part_mb * 2**20), "early": a.early,
+            "mode": a.mode, "date_format": a.date_format, "profile": a.profile, "copy_format": a.copy_format,
+            "header_map": json.loads(a.header_map) if a.header_map else None})
+    if r.status_code not in (200, 201):
+        sys.exit(f"API respondeu {r.status_code}: {r.text}")
+    st = r.json()
+    if st["size"] != size:
+        sys.exit(f"o upload {st['upload_id']} é de um arquivo com {st['size']} bytes, não {size}")
+    print(f"upload_id={st['upload_id']} partes={st['parts']} faltando={len(st['missing'])}", flush=True)
+
+    t0 = time.perf_counter(); sent = 0
+    with ThreadPoolExecutor(a.parallel) as ex:
+        futs = [ex.submit(send_part, api, st["upload_id"], a.path, n, st["part_size"]) for n in st["missing"]]
+        for i, f in enumerate(as_completed(futs), 1):
+            sent += f.result()
+            dt = time.perf_counter() - t0
+            print(f"\r{i}/{len(futs)} parte(s) {sent / 2**20:,.0f} MB {sent / 2**20 / dt:,.1f} MB/s", end="", flush=True)
+    print()
+    r = requests.post(f"{api}/ingest/uploads/{st['upload_id']}/complete", timeout=60)
+    if r.status_code != 202:
+        sys.exit(f"complete: API respondeu {r.status_code}: {r.text}")
+    job_id = r.json()["job_id"]
+    if a.no_wait:
+        print(f"job_id={job_id}")
+        return
+    j = follow(api, job_id)
+    print(json.dumps(j.get("result") or j.get("error"), ensure_ascii=False, indent=1, default=str))
+    sys.exit(0 if j["status"] == "done" else 1)
+
+if __name__ == "__main__":
+    main_cli()
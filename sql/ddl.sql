@@ -1 +1,231 @@
-CREATE SCHEMA IF NOT EXISTS staging;
\ No newline at end of file
+CREATE SCHEMA IF NOT EXISTS staging;
+
+-- Jobs de ingest em background (API: /ingest/jobs/*)
+CREATE TABLE IF NOT EXISTS staging.ingest_jobs (
+  id               uuid PRIMARY KEY,
+  source           text NOT NULL,                    -- url | upload
+  params           jsonb NOT NULL DEFAULT '{}',
+  status           text NOT NULL DEFAULT 'queued',   -- queued | running | done | error | cancelled
+  phase            text,                             -- queued | download | sniff | copy | done
+  rows_processed   bigint NOT NULL DEFAULT 0,
+  bytes_read       bigint NOT NULL DEFAULT 0,
+  bytes_total      bigint,
+  cancel_requested boolean NOT NULL DEFAULT false,
+  result           jsonb,
+  error            text,
+  owner            text,                             -- host:pid do processo da API que executa o job
+  created_at       timestamptz NOT NULL DEFAULT now(),
+  started_at       timestamptz,
+  updated_at       timestamptz NOT NULL DEFAULT now(),
+  heartbeat_at     timestamptz NOT NULL DEFAULT now(),
+  finished_at      timestamptz
+);
+CREATE INDEX IF NOT EXISTS ingest_jobs_created_idx ON staging.ingest_jobs (created_at DESC);
+CREATE INDEX IF NOT EXISTS ingest_jobs_active_idx ON staging.ingest_jobs (heartbeat_at) WHERE status IN ('queued','running');
+
+-- Builds dbt em background (API: POST /dbt/run, GET /dbt/runs/*). Uma por target: advisory lock na API
+CREATE TABLE IF NOT EXISTS staging.dbt_runs (
+  id           uuid PRIMARY KEY,
+  target       text NOT NULL,                    -- chave do advisory lock
+  params       jsonb NOT NULL DEFAULT '{}',      -- select | full_refresh | clean
+  status       text NOT NULL DEFAULT 'queued',   -- queued | running | done | error
+  step         text,                             -- comando dbt em execução (ou o que falhou)
+  steps        jsonb NOT NULL DEFAULT '[]',      -- [{cmd, seconds, exit_code}]
+  models       jsonb,                            -- tempo/status por nó, do target/run_results.json
+  log          text NOT NULL DEFAULT '',
+  error        text,
+  owner        text,                             -- host:pid do processo da API que executa a build
+  created_at   timestamptz NOT NULL DEFAULT now(),
+  started_at   timestamptz,
+  heartbeat_at timestamptz NOT NULL DEFAULT now(),
+  finished_at  timestamptz
+);
+CREATE INDEX IF NOT EXISTS dbt_runs_created_idx ON staging.dbt_runs (created_at DESC);
+
+-- Marca d'água dos modelos incrementais do dbt (macros/incremental_watermark.sql): até onde cada modelo
+-- já processou a origem. pending é o limite calculado no pre_hook, promovido a loaded_until no post_hook.
+CREATE TABLE IF NOT EXISTS staging.dbt_watermarks (
+  model        text PRIMARY KEY,
+  loaded_until timestamptz,
+  pending      timestamptz,
+  updated_at   timestamptz NOT NULL DEFAULT now()
+);
+
+-- Perfis de origem do ingest (API: /ingest/profiles): com perfil o Sniffer não roda
+CREATE TABLE IF NOT EXISTS staging.source_profiles (
+  id           text PRIMARY KEY,
+  fingerprint  text UNIQUE,                      -- hash da linha de cabeçalho crua (casa o perfil sem o parâmetro profile)
+  header       jsonb,
+  dialect      jsonb,                            -- {delimiter, quotechar, ...}; NULL: usa o Sniffer
+  encoding     text NOT NULL DEFAULT 'utf-8',
+  header_map   jsonb,                            -- coluna canônica -> nome no arquivo
+  date_format  text,                             -- YYYY-MM-DD | DD/MM/YYYY
+  decimal_sep  text NOT NULL DEFAULT 'auto',     -- auto | comma | dot
+  auto_learned boolean NOT NULL DEFAULT false,
+  uses         bigint NOT NULL DEFAULT 0,
+  last_used_at timestamptz,
+  created_at   timestamptz NOT NULL DEFAULT now(),
+  updated_at   timestamptz NOT NULL DEFAULT now()
+);
+-- Perfil aprendido fica em auto: um valor "12,5" no preview não prova que o arquivo nunca traz "10.5"
+-- (comma/dot só por PUT /ingest/profiles, que zera auto_learned). Corrige os aprendidos antes disso.
+UPDATE staging.source_profiles SET decimal_sep = 'auto', updated_at = now() WHERE auto_learned AND decimal_sep <> 'auto';
+
+-- Registros recusados nas cargas com copy_format=binary (API: GET /ingest/rejects) e na migração do staging tipado
+CREATE TABLE IF NOT EXISTS staging.ingest_rejects (
+  id         bigserial PRIMARY KEY,
+  load_id    uuid,                                   -- devolvido pelo ingest junto com `rejected`
+  linha      bigint,                                 -- nº do registro no arquivo (1 = primeiro após o cabeçalho)
+  coluna     text,
+  valor      text,
+  erro       text NOT NULL,
+  registro   jsonb,                                  -- registro normalizado completo
+  created_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ingest_rejects_load_idx ON staging.ingest_rejects (load_id);
+
+-- Texto que o cast ::numeric aceita (migração das colunas de valor para numeric)
+CREATE OR REPLACE FUNCTION staging.is_numeric_text(v text) RETURNS boolean
+LANGUAGE sql IMMUTABLE AS $$ SELECT v IS NULL OR v ~ '^\s*[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?\s*$' $$;
+
+-- Data em texto -> date (migração do staging antigo): AAAA-MM-DD (com hora opcional) ou DD/MM/AAAA.
+-- NULL se não for uma data válida (inclusive 2024-02-30), sem abortar a migração.
+CREATE OR REPLACE FUNCTION staging.safe_date(v text) RETURNS date
+LANGUAGE plpgsql IMMUTABLE AS $$
+DECLARE iso text[] := regexp_match(v, '^\s*(\d{4})-(\d{1,2})-(\d{1,2})([ T][0-9:.+-]*)?\s*$');
+        br  text[] := regexp_match(v, '^\s*(\d{1,2})/(\d{1,2})/(\d{4})\s*$');
+BEGIN
+  IF iso IS NOT NULL THEN RETURN make_date(iso[1]::int, iso[2]::int, iso[3]::int); END IF;
+  IF br IS NOT NULL THEN RETURN make_date(br[3]::int, br[2]::int, br[1]::int); END IF;
+  RETURN NULL;
+EXCEPTION WHEN datetime_field_overflow OR invalid_datetime_format OR numeric_value_out_of_range THEN
+  RETURN NULL;
+END $$;
+
+-- Partições mensais (RANGE em data) para staging e fato_venda.
+-- Cria <tabela>_AAAAMM para o mês de `mes` se ainda não existir: monta a tabela solta, move para ela
+-- as linhas desse mês que tenham caído na partição DEFAULT e faz ATTACH (o CHECK igual ao limite
+-- deixa o ATTACH sem varrer a tabela). Seguro com chamadas concorrentes (advisory lock por partição).
+CREATE OR REPLACE FUNCTION staging.ensure_month_partition(parent regclass, mes date) RETURNS regclass
+LANGUAGE plpgsql AS $$
+DECLARE
+  ini  date := date_trunc('month', mes)::date;
+  fim  date := (date_trunc('month', mes) + interval '1 month')::date;
+  nsp  text; rel text; part text; def regclass;
+BEGIN
+  SELECT n.nspname, c.relname INTO nsp, rel FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.oid = parent;
+  part := format('%I.%I', nsp, rel || '_' || to_char(ini, 'YYYYMM'));
+  IF to_regclass(part) IS NOT NULL THEN RETURN to_regclass(part); END IF;
+  PERFORM pg_advisory_xact_lock(hashtext(part));
+  IF to_regclass(part) IS NOT NULL THEN RETURN to_regclass(part); END IF;
+
+  SELECT i.inhrelid::regclass INTO def FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+   WHERE i.inhparent = parent AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT';
+  EXECUTE format('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS, CONSTRAINT %I CHECK (data IS NOT NULL AND data >= %L AND data < %L))',
+                 part, parent, 'bound_' || to_char(ini, 'YYYYMM'), ini, fim);
+  IF def IS NOT NULL THEN
+    EXECUTE format('WITH m AS (DELETE FROM %s WHERE data >= %L AND data < %L RETURNING *) INSERT INTO %s SELECT * FROM m', def, ini, fim, part);
+  END IF;
+  EXECUTE format('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%L) TO (%L)', parent, part, ini, fim);
+  EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', part, 'bound_' || to_char(ini, 'YYYYMM'));
+  RETURN part::regclass;
+END $$;
+
+-- Move para partições mensais tudo o que estiver na DEFAULT com data preenchida (meses novos numa carga).
+CREATE OR REPLACE FUNCTION staging.split_default_partition(parent regclass) RETURNS SETOF regclass
+LANGUAGE plpgsql AS $$
+DECLARE def regclass; meses date[]; m date;
+BEGIN
+  SELECT i.inhrelid::regclass INTO def FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+   WHERE i.inhparent = parent AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT';
+  IF def IS NULL THEN RETURN; END IF;
+  -- meses lidos antes num array: ATTACH não roda com uma consulta ainda aberta sobre a tabela
+  EXECUTE format('SELECT array_agg(DISTINCT date_trunc(''month'', data)::date) FROM %s WHERE data IS NOT NULL', def) INTO meses;
+  FOREACH m IN ARRAY coalesce(meses, '{}') LOOP
+    RETURN NEXT staging.ensure_month_partition(parent, m);
+  END LOOP;
+END $$;
+
+-- Instalações antigas: staging era uma tabela comum com data em texto. Renomeia para migrar abaixo.
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('staging.raw_vendas_achatado') AND relkind = 'r') THEN
+    ALTER TABLE staging.raw_vendas_achatado ADD COLUMN IF NOT EXISTS _loaded_at timestamptz NOT NULL DEFAULT now();
+    ALTER TABLE staging.raw_vendas_achatado RENAME TO raw_vendas_achatado_heap;
+    DROP INDEX IF EXISTS staging.raw_vendas_achatado_nk_idx, staging.raw_vendas_achatado_data_idx, staging.raw_vendas_achatado_loaded_at_idx;
+  END IF;
+END $$;
+
+-- Staging achatado (uma linha por item de venda, valores já normalizados e tipados), particionado por mês.
+-- _loaded_at é a marca d'água dos modelos incrementais do dbt (fato_venda, dimensões).
+CREATE TABLE IF NOT EXISTS staging.raw_vendas_achatado (
+  data date, produto text, sku text, familia text, sub_familia text, cor text, tam text, marca text,
+  cod_cliente text, razao_social text, qtde numeric, preco_unit numeric, total_venda numeric, total_custo numeric,
+  margem numeric, documento_fiscal text,
+  _loaded_at timestamptz NOT NULL DEFAULT now()
+) PARTITION BY RANGE (data);
+-- Linhas sem data e meses ainda sem partição (a API separa os meses novos ao fim de cada carga)
+CREATE TABLE IF NOT EXISTS staging.raw_vendas_achatado_default PARTITION OF staging.raw_vendas_achatado DEFAULT;
+-- Chave natural padrão do modo merge (MERGE_KEY), com NULL trocado pelo mesmo sentinela do merge_key_expr da
+-- API (NULL casa com NULL no reenvio), e janela de datas do modo replace_dates.
+-- Instalações antigas têm o índice nas colunas puras, que o merge não usa mais: recria.
+DO $$
+BEGIN
+  IF position('COALESCE' IN upper(coalesce(pg_get_indexdef(to_regclass('staging.raw_vendas_achatado_nk_idx')), 'COALESCE'))) = 0 THEN
+    DROP INDEX staging.raw_vendas_achatado_nk_idx;
+  END IF;
+END $$;
+CREATE INDEX IF NOT EXISTS raw_vendas_achatado_nk_idx ON staging.raw_vendas_achatado
+  ((coalesce(documento_fiscal, '')), (coalesce(sku, '')), (coalesce(cod_cliente, '')), (coalesce(data, '-infinity'::date)));
+CREATE INDEX IF NOT EXISTS raw_vendas_achatado_data_idx ON staging.raw_vendas_achatado (data);
+CREATE INDEX IF NOT EXISTS raw_vendas_achatado_loaded_at_idx ON staging.raw_vendas_achatado (_loaded_at);
+
+DO $$
+BEGIN
+  IF to_regclass('staging.raw_vendas_achatado_heap') IS NOT NULL THEN
+    PERFORM staging.ensure_month_partition('staging.raw_vendas_achatado', m)
+       FROM (SELECT DISTINCT date_trunc('month', staging.safe_date(data))::date AS m FROM staging.raw_vendas_achatado_heap) s
+      WHERE m IS NOT NULL;
+    -- data preenchida que não converte vai para ingest_rejects, como os valores numéricos (data vazia fica NULL)
+    INSERT INTO staging.ingest_rejects (coluna, valor, erro, registro)
+    SELECT 'data', data, 'migração: data inválida', to_jsonb(h) FROM staging.raw_vendas_achatado_heap h
+     WHERE coalesce(btrim(data), '') <> '' AND staging.safe_date(data) IS NULL;
+    INSERT INTO staging.ingest_rejects (erro, registro)
+    SELECT 'migração: valor numérico inválido', to_jsonb(h) FROM staging.raw_vendas_achatado_heap h
+     WHERE NOT (staging.is_numeric_text(qtde) AND staging.is_numeric_text(preco_unit) AND staging.is_numeric_text(total_venda)
+                AND staging.is_numeric_text(total_custo) AND staging.is_numeric_text(margem))
+       AND NOT (coalesce(btrim(data), '') <> '' AND staging.safe_date(data) IS NULL);
+    INSERT INTO staging.raw_vendas_achatado
+    SELECT staging.safe_date(data), produto, sku, familia, sub_familia, cor, tam, marca,
+           cod_cliente, razao_social, qtde::numeric, preco_unit::numeric, total_venda::numeric, total_custo::numeric, margem::numeric,
+           documento_fiscal, _loaded_at
+      FROM staging.raw_vendas_achatado_heap
+     WHERE staging.is_numeric_text(qtde) AND staging.is_numeric_text(preco_unit) AND staging.is_numeric_text(total_venda)
+       AND staging.is_numeric_text(total_custo) AND staging.is_numeric_text(margem)
+       AND NOT (coalesce(btrim(data), '') <> '' AND staging.safe_date(data) IS NULL);
+    DROP TABLE staging.raw_vendas_achatado_heap CASCADE;  -- leva junto a view stg_vendas do dbt; o próximo dbt run a recria
+  END IF;
+END $$;
+
+-- Instalações com o staging particionado ainda em texto: valores inválidos vão para ingest_rejects e as
+-- colunas de valor passam a numeric (reescreve as partições; as views dependentes são recriadas pelo dbt).
+DO $$
+DECLARE v regclass;
+BEGIN
+  IF (SELECT atttypid = 'text'::regtype FROM pg_attribute WHERE attrelid = 'staging.raw_vendas_achatado'::regclass AND attname = 'qtde') THEN
+    WITH r AS (
+      DELETE FROM staging.raw_vendas_achatado
+       WHERE NOT (staging.is_numeric_text(qtde) AND staging.is_numeric_text(preco_unit) AND staging.is_numeric_text(total_venda)
+                  AND staging.is_numeric_text(total_custo) AND staging.is_numeric_text(margem))
+      RETURNING *)
+    INSERT INTO staging.ingest_rejects (erro, registro) SELECT 'migração: valor numérico inválido', to_jsonb(r) FROM r;
+    FOR v IN SELECT DISTINCT rw.ev_class::regclass FROM pg_depend d JOIN pg_rewrite rw ON rw.oid = d.objid
+              WHERE d.refobjid = 'staging.raw_vendas_achatado'::regclass AND rw.ev_class <> d.refobjid LOOP
+      EXECUTE format('DROP VIEW IF EXISTS %s CASCADE', v);
+    END LOOP;
+    ALTER TABLE staging.raw_vendas_achatado
+      ALTER COLUMN qtde TYPE numeric USING qtde::numeric, ALTER COLUMN preco_unit TYPE numeric USING preco_unit::numeric,
+      ALTER COLUMN total_venda TYPE numeric USING total_venda::numeric, ALTER COLUMN total_custo TYPE numeric USING total_custo::numeric,
+      ALTER COLUMN margem TYPE numeric USING margem::numeric;
+  END IF;
+END $$;